@@ -8,4 +8,8 @@ if os.path.join(os.getcwd(), "src") not in sys.path:
 from src.cli.cli import FlowlogParserCLI
 
 if __name__ == '__main__':
-    FlowlogParserCLI().cmdloop()
+    if len(sys.argv) > 1:
+        # run a single command, e.g. `zcat flows.gz | python3 main.py stream -`
+        FlowlogParserCLI().onecmd(" ".join(sys.argv[1:]))
+    else:
+        FlowlogParserCLI().cmdloop()
@@ -1,29 +1,245 @@
+import cProfile
 import cmd
+import pstats
+import re
+import tracemalloc
+import flowparser.batch as batch
+import flowparser.export as export
+import flowparser.rollup as rollup
+import flowparser.stats as stats
 from flowparser.parser import Parser
+from flowparser.query import QueryError, parse_time
+from flowparser.server import DEFAULT_PORT, QueryServer
+from flowparser.store import RowSet
 import flowparser.constants as constants
 import ipaddress as ip
 import json
+import threading
+import time
 
 class SchemaError(Exception):
     pass
 
+def parse_options(arg: str, option_types: dict) -> tuple[str, dict]:
+    # Split "<positional> key=value ..." into the positional argument and typed options
+    positional, options = [], {}
+    for token in arg.split():
+        key, sep, value = token.partition('=')
+        if not sep and option_types.get(token) is bool:
+            options[token] = True
+        elif sep and key in option_types:
+            options[key] = option_types[key](value)
+        elif sep:
+            raise ValueError(f'unknown option {key!r}')
+        else:
+            positional.append(token)
+    if len(positional) != 1:
+        raise ValueError('expected exactly one path')
+    return positional[0], options
+
+# results up to this many rows keep their printed and exported text in the parser's result cache,
+# larger ones are streamed row by row every time
+RENDER_CACHE_ROWS = 10000
+
+# result options shared by the search commands and QUERY
+OUTPUT_OPTIONS = {"format": str, "limit": int, "offset": int, "quiet": bool, "count": bool}
+OUTPUT_USAGE = '[format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]'
+
+def split_output_options(arg: str) -> tuple[str, dict]:
+    # Pull result options out of the arguments, everything else is returned in order
+    rest, options = [], {}
+    for token in arg.split():
+        key, sep, value = token.partition('=')
+        if sep and key in OUTPUT_OPTIONS and OUTPUT_OPTIONS[key] is not bool:
+            options[key] = OUTPUT_OPTIONS[key](value)
+        elif not sep and OUTPUT_OPTIONS.get(token) is bool:
+            options[token] = True
+        else:
+            rest.append(token)
+    if options.get("format", "json") not in export.FORMATS:
+        raise ValueError(f'unknown format {options["format"]!r}')
+    if options.get("limit", 0) < 0 or options.get("offset", 0) < 0:
+        raise ValueError('limit and offset must not be negative')
+    return ' '.join(rest), options
+
+def validate_address(value: str) -> None:
+    # Accepts a single IP address or a CIDR block such as 10.0.1.0/24, raises ValueError otherwise
+    if "/" in value:
+        ip.ip_network(value, strict=False)
+    else:
+        ip.ip_address(value)
+
+def split_clause(arg: str, keyword: str) -> tuple[str, str]:
+    # "<before> KEYWORD <after>" -> (before, after), keyword is case-insensitive and after is None without it
+    parts = re.split(rf'\s+{keyword}\s+', f' {arg} ', maxsplit=1, flags=re.IGNORECASE)
+    if len(parts) == 1:
+        return arg.strip(), None
+    return parts[0].strip(), parts[1].strip()
+
 class FlowlogParserCLI(cmd.Cmd):
     intro = 'Welcome to the flowlog parser shell.   Type help or ? to list commands.\n'
     prompt = '(flowlog_parser) '
     file = None
     
     def do_load(self, arg):
-        'Load flow logs from a specified file:  LOAD path/to/flowlog.txt\nIf the schema is set, it will be used; otherwise, the default schema is applied.'
-        print(f'Loading flow logs from {arg}...\n', file=self.stdout)
-        if hasattr(self, 'schema'):
-            self.parser = Parser(path=arg, schema=self.schema)
-        else:
-            self.parser = Parser(path=arg)
+        'Load flow logs from a file, directory or glob:  LOAD path/to/flowlog.txt|path/to/dir|path/to/*.log [workers=N] [lazy] [epsilon=E]\nIf the file starts with a header line naming its fields (custom log formats), that schema is used; otherwise the schema set with SET_SCHEMA, or the default one.\nWith workers=N the file is split into N shards that are parsed in parallel processes; for a directory or glob whole files are spread over N processes and merged into one set of indexes.\nWith lazy only the indexed fields are decoded up front, the rest is read from the mapped file when rows are printed.\nWith epsilon=E connection counts are approximated in fixed memory, overcounting by at most E * total flows.\nWith skip_malformed lines that do not fit the schema are skipped and reported instead of stopping the load, rejects=path also writes them (file, line number, reason, line) to path. Both reparse the file even if it has an index snapshot.\nRollups chosen with SET_ROLLUPS are built while loading, see ROLLUP.'
+        try:
+            path, options = parse_options(arg, {"workers": int, "lazy": bool, "epsilon": float, "skip_malformed": bool, "rejects": str})
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. Usage: LOAD path/to/flowlog.txt|path/to/dir|path/to/*.log [workers=N] [lazy] [epsilon=E] [skip_malformed] [rejects=path]\n', file=self.stdout)
+            return
+
+        print(f'Loading flow logs from {path}...\n', file=self.stdout)
+        schema = self.schema if hasattr(self, 'schema') else constants.FLOW_LOG_SCHEMA_DEFAULT
+        skip_malformed = options.get("skip_malformed", False) or "rejects" in options
+        self.parser = Parser(path=path, schema=schema, lazy=options.get("lazy", False), epsilon=options.get("epsilon"), skip_malformed=skip_malformed, rollups=getattr(self, 'rollups', None))
+        self.parser.cache.resize(**getattr(self, 'cache_limits', {}))
+        if self.parser.header_length:
+            print(f'Schema read from header: {" ".join(self.parser.schema)}\n', file=self.stdout)
+        self._report_skipped_rollups(self.parser)
+        # snapshots hold no rejected lines, so skip_malformed and rejects= always reparse
+        if not skip_malformed and self.parser.load_index():
+            print('Loaded index snapshot, skipping parse.\n', file=self.stdout)
+            return
+        self.parser.deserialize(workers=options.get("workers", 1))
+        seconds = self.parser.stats.phases["load"]
+        print(f'Parsed {len(self.parser.store)} rows in {seconds:.2f}s ({self.parser.stats.counters["bytes"] / 2**20 / max(seconds, 1e-9):.1f} MB/s). Use STATS for details.\n', file=self.stdout)
+        if self.parser.rejects:
+            source_path, line_number, reason, _ = self.parser.rejects[0]
+            print(f'Skipped {len(self.parser.rejects)} malformed lines, the first at {source_path} line {line_number}: {reason}.\n', file=self.stdout)
+        if "rejects" in options:
+            try:
+                written = self.parser.write_rejects(options["rejects"])
+                print(f'Wrote {written} rejected lines to {options["rejects"]}.\n', file=self.stdout)
+            except OSError as e:
+                print(f'Could not write rejected lines: {e}\n', file=self.stdout)
+        if self.parser.files:
+            print(f'Loaded {len(self.parser.files)} files ({len(self.parser.store)} rows).\n', file=self.stdout)
+        if self.parser.rollups:
+            print(f'Built rollups {", ".join(summary.name for summary in self.parser.rollups)}, see ROLLUP.\n', file=self.stdout)
+
+    def _report_skipped_rollups(self, parser):
+        # rollups set with SET_ROLLUPS on fields the file's schema doesn't have
+        for spec, reason in parser.skipped_rollups:
+            print(f'Skipped rollup {spec}: {reason}.\n', file=self.stdout)
+
+    def do_files(self, arg):
+        'List the files of a directory or glob load with their rows, time range and interface-ids:  FILES'
+        if not getattr(self, 'parser', None) or not self.parser.files:
+            print('No multi-file load. Use LOAD with a directory or glob first.\n', file=self.stdout)
+            return
+        for source_file in self.parser.files:
+            start = source_file.start_range[0] if source_file.start_range else '-'
+            end = source_file.end_range[1] if source_file.end_range else '-'
+            interfaces = ','.join(sorted(source_file.interfaces)) if source_file.interfaces else '-'
+            print(f'{source_file.path}  rows {source_file.first_row}..{source_file.first_row + source_file.row_count - 1}  time {start}..{end}  {interfaces}', file=self.stdout)
+        print('', file=self.stdout)
+
+    def do_save_index(self, arg):
+        'Write the loaded columns, indexes and connection counts to a snapshot:  SAVE_INDEX [snapshot_path]\nDefaults to path/to/flowlog.txt.idx, which LOAD picks up automatically while the flow log is unchanged.'
+        if not hasattr(self, 'parser'):
+            print('No flow logs loaded. Use LOAD first.\n', file=self.stdout)
+            return
+        try:
+            path = self.parser.save_index(arg.strip() or None)
+        except (OSError, ValueError) as e:
+            print(f'Could not write index snapshot: {e}\n', file=self.stdout)
+            return
+        print(f'Index snapshot written to {path}.\n', file=self.stdout)
+
+    def do_load_index(self, arg):
+        'Load flow logs from an index snapshot without parsing:  LOAD_INDEX path/to/flowlog.txt [snapshot_path]'
+        split_args = arg.split()
+        if len(split_args) not in (1, 2):
+            print('Invalid arguments. Usage: LOAD_INDEX path/to/flowlog.txt [snapshot_path]\n', file=self.stdout)
+            return
+
+        schema = self.schema if hasattr(self, 'schema') else constants.FLOW_LOG_SCHEMA_DEFAULT
+        parser = Parser(path=split_args[0], schema=schema, rollups=getattr(self, 'rollups', None))
+        self._report_skipped_rollups(parser)
+        if not parser.load_index(split_args[1] if len(split_args) == 2 else None):
+            print(f'No valid index snapshot for {split_args[0]}.\n', file=self.stdout)
+            return
+        self.parser = parser
+        print(f'Loaded index snapshot for {split_args[0]} ({len(parser.store)} rows).\n', file=self.stdout)
+
+    def do_stream(self, arg):
+        'Stream flow logs through counts-only aggregation, keeping no rows:  STREAM path/to/flowlog.txt[.gz]|- [top=N] [epsilon=E]\nUse - to read from stdin. Afterwards GET_CONNECTION_COUNT answers from the streamed counts.\nWith epsilon=E connection counts are kept in a fixed-size Count-Min Sketch.'
+        try:
+            path, options = parse_options(arg, {"top": int, "epsilon": float})
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. Usage: STREAM path/to/flowlog.txt[.gz]|- [top=N] [epsilon=E]\n', file=self.stdout)
+            return
 
+        schema = self.schema if hasattr(self, 'schema') else constants.FLOW_LOG_SCHEMA_DEFAULT
+        self.parser = Parser(path=path, schema=schema, counts_only=True, epsilon=options.get("epsilon"))
         self.parser.deserialize()
+        aggregates = self.parser.aggregates
+        top = options.get("top", 10)
+
+        print(f'Rows: {aggregates.rows} ({aggregates.skipped} without addresses)', file=self.stdout)
+        if self.parser.epsilon:
+            print(f'Connection count error bound: {aggregates.connection_counts.error_bound():.0f}', file=self.stdout)
+        else:
+            print(f'Distinct connections: {len(aggregates.connection_counts)}', file=self.stdout)
+        print(f'\nTop {top} sources by bytes:', file=self.stdout)
+        for ip_addr, total in aggregates.top_sources(top):
+            print(f'  {ip_addr:<15} {total}', file=self.stdout)
+        print(f'\nTop {top} destinations by bytes:', file=self.stdout)
+        for ip_addr, total in aggregates.top_destinations(top):
+            print(f'  {ip_addr:<15} {total}', file=self.stdout)
+        print(f'\nTop {top} destination ports by flows:', file=self.stdout)
+        for port, flows in aggregates.top_destination_ports(top):
+            print(f'  {port:<15} {flows}', file=self.stdout)
+        print('', file=self.stdout)
+
+    def do_follow(self, arg):
+        'Follow a growing flow log, ingesting appended lines in the background:  FOLLOW path/to/flowlog.txt [interval=seconds]\nIf the file is already loaded, following resumes after the last ingested line. Queries keep working while following.'
+        try:
+            path, options = parse_options(arg, {"interval": float})
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. Usage: FOLLOW path/to/flowlog.txt [interval=seconds]\n', file=self.stdout)
+            return
+
+        self.do_unfollow('')
+        if not hasattr(self, 'parser') or self.parser.path != path:
+            schema = self.schema if hasattr(self, 'schema') else constants.FLOW_LOG_SCHEMA_DEFAULT
+            self.parser = Parser(path=path, schema=schema, rollups=getattr(self, 'rollups', None))
+            self.parser.cache.resize(**getattr(self, 'cache_limits', {}))
+            self._report_skipped_rollups(self.parser)
+        try:
+            self.parser.ingest_appended()
+        except (OSError, ValueError, IndexError) as e:
+            print(f'Could not follow {path}: {e}\n', file=self.stdout)
+            return
+
+        self.follow_stop = threading.Event()
+        self.follower = threading.Thread(
+            target=self._follow, args=(self.parser, options.get("interval", 1.0), self.follow_stop), daemon=True
+        )
+        self.follower.start()
+        print(f'Following {path} ({len(self.parser.store)} rows so far).\n', file=self.stdout)
+
+    def _follow(self, parser, interval, stop):
+        while not stop.wait(interval):
+            try:
+                parser.ingest_appended()
+            except Exception as e:
+                print(f'Stopped following {parser.path}: {e}\n', file=self.stdout)
+                return
+
+    def do_unfollow(self, arg):
+        'Stop following the flow log:  UNFOLLOW'
+        follower = getattr(self, 'follower', None)
+        if follower is None:
+            return
+        self.follow_stop.set()
+        follower.join()
+        self.follower = None
+        print(f'Stopped following {self.parser.path}.\n', file=self.stdout)
 
     def do_set_schema(self, arg):
-        'Set the schema for parsing flow logs:  SET_SCHEMA default|all\n Set the custom schema for parsing flow logs: SET_SCHEMA dstaddr srcaddr srcport dstport protocol packets bytes start end action log-status'
+        'Set the schema for parsing flow logs:  SET_SCHEMA default|all\n Set the custom schema for parsing flow logs: SET_SCHEMA dstaddr srcaddr srcport dstport protocol packets bytes start end action log-status\nNot needed for flow logs that start with a header line, LOAD reads their schema from it.'
         try:
             fields = arg.split(' ')
             if len(fields) == 1 and fields[0].lower() == 'default':
@@ -32,7 +248,7 @@ class FlowlogParserCLI(cmd.Cmd):
                 self.schema = list(constants.FLOW_LOG_SCHEMA_ALL)
             else:
                 for field in fields:
-                    if field not in constants.FLOW_LOG_SCHEMA_ALL:
+                    if field not in constants.FLOW_LOG_FIELDS:
                         raise SchemaError(f'Invalid field: {field}')
                 self.schema = fields
                 
@@ -44,122 +260,434 @@ class FlowlogParserCLI(cmd.Cmd):
             print(f'{e}\n', file=self.stdout)
             return
     
-    def do_search_src(self, arg):
-        'Search flow logs by source IP:  SEARCH_SRC <src_ip> [output_file]'
+    def do_set_rollups(self, arg):
+        'Set the rollups LOAD and FOLLOW build while ingesting:  SET_ROLLUPS none|default|<field>[,<field>...][@seconds] ...\nA rollup sums flows, packets and bytes per bucket of start time (60 seconds unless @seconds is given) and value of its fields; total sums all flows per bucket. default stands for srcaddr, dstport and action per minute. Answer from them with ROLLUP.\nExample: SET_ROLLUPS dstport srcaddr,dstport@300 total@3600'
+        specs = arg.split()
+        try:
+            if not specs:
+                raise ValueError('expected rollups')
+            if len(specs) == 1 and specs[0].lower() == 'none':
+                specs = []
+            # default can be combined with more rollups
+            specs = [name for spec in specs for name in (rollup.DEFAULT_ROLLUPS if spec.lower() == 'default' else [spec])]
+            for spec in specs:
+                rollup.parse_spec(spec)
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. Usage: SET_ROLLUPS none|default|<field>[,<field>...][@seconds] ...\n', file=self.stdout)
+            return
+        self.rollups = list(specs)
+        print(f'Rollups set to {" ".join(self.rollups) or "none"}.\n', file=self.stdout)
 
-        output_file = None
+    def _rendered(self, results, key, render):
+        # render(results) joined into one string and cached under key, None when results aren't cacheable
+        if results.key is None or len(results) > RENDER_CACHE_ROWS:
+            return None
+        return self.parser.cache.get_or_compute(key, lambda: ''.join(render(results)))
+
+    def _emit_results(self, results, output_file, options):
+        # Echo and/or export a RowSet one row at a time, after applying offset/limit
+        total = len(results)
+        offset = options.get("offset", 0)
+        limit = options.get("limit")
+        page = (results.key, offset, limit)
+        if offset or limit is not None:
+            results = RowSet(results.store, results.row_ids[offset:None if limit is None else offset + limit], results.key)
+        if options.get("count"):
+            print(f'Total results: {total}\n', file=self.stdout)
+            return
+
+        if not options.get("quiet"):
+            text = self._rendered(results, ("printed",) + page, lambda rows: (f'{flowlog}\n' for flowlog in rows))
+            if text is None:
+                for flowlog in results:
+                    print(flowlog, file=self.stdout)
+            else:
+                self.stdout.write(text)
+        print(f'\nTotal results: {total}', file=self.stdout)
+        if len(results) != total:
+            print(f'Returned: {len(results)} (offset {offset})', file=self.stdout)
+        print('', file=self.stdout)
+
+        if output_file:
+            format = options.get("format") or export.infer_format(output_file)
+            with open(output_file, 'w', newline='' if format == "csv" else None) as f:
+                text = self._rendered(results, ("exported", format) + page, lambda rows: export.encode_rows(rows, format))
+                if text is None:
+                    export.write_rows(results, f, format)
+                else:
+                    f.write(text)
+
+    def do_search_src(self, arg):
+        'Search flow logs by source IP or CIDR block:  SEARCH_SRC <src_ip>|<network/prefix> [output_file] [format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]\nRows are streamed to output_file (format defaults to the file extension, else compact JSON). quiet skips printing rows, count only prints the number of matches.'
         try:
+            arg, options = split_output_options(arg)
             split_args = arg.split()
             if len(split_args) == 2:
                 src_ip, output_file = split_args
             elif len(split_args) == 1:
-                src_ip = split_args[0]
+                src_ip, output_file = split_args[0], None
             else:
                 raise ValueError
         except ValueError:
-            print('Invalid arguments. Usage: SEARCH_SRC <src_ip> [output_file]\n', file=self.stdout)
+            print(f'Invalid arguments. Usage: SEARCH_SRC <src_ip> [output_file] {OUTPUT_USAGE}\n', file=self.stdout)
             return
 
         # validate IP addresses
         try:
-            ip.ip_address(src_ip)
+            validate_address(src_ip)
         except ValueError:
             print(f'Invalid IP address: {src_ip!r}. Please provide a valid IPv4 address.\n', file=self.stdout)
             return
 
-        results = self.parser.search_by_source_ip(src_ip)
-        for flowlog in results:
-            print(flowlog, file=self.stdout)
-        print(f'\nTotal results: {len(results)}\n', file=self.stdout)
-
-        if output_file:
-            with open(output_file, 'w') as f:
-                json_obj = json.dumps(
-                    [
-                        {k: v for k, v in flowlog.__dict__.items() if k != "schema"}
-                        for flowlog in results
-                    ],
-                    indent=2,
-                )
-                f.write(json_obj)
+        self._emit_results(self.parser.search_by_source_ip(src_ip), output_file, options)
 
     def do_search_dst(self, arg):
-        'Search flow logs by destination IP:  SEARCH_DST <dst_ip> [output_file]'
-
-        output_file = None
+        'Search flow logs by destination IP or CIDR block:  SEARCH_DST <dst_ip>|<network/prefix> [output_file] [format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]'
         try:
+            arg, options = split_output_options(arg)
             split_args = arg.split()
             if len(split_args) == 2:
                 dst_ip, output_file = split_args
             elif len(split_args) == 1:
-                dst_ip = split_args[0]
+                dst_ip, output_file = split_args[0], None
             else:
                 raise ValueError
         except ValueError:
-            print('Invalid arguments. Usage: SEARCH_DST <dst_ip> [output_file]\n', file=self.stdout)
+            print(f'Invalid arguments. Usage: SEARCH_DST <dst_ip> [output_file] {OUTPUT_USAGE}\n', file=self.stdout)
             return
 
         # validate IP addresses
         try:
-            ip.ip_address(dst_ip)
+            validate_address(dst_ip)
         except ValueError:
             print(f'Invalid IP address: {dst_ip!r}. Please provide a valid IPv4 address.\n', file=self.stdout)
             return
 
-        results = self.parser.search_by_destination_ip(dst_ip)
-        for flowlog in results:
-            print(flowlog, file=self.stdout)
-        print(f'\nTotal results: {len(results)}\n', file=self.stdout)
+        self._emit_results(self.parser.search_by_destination_ip(dst_ip), output_file, options)
 
-        if output_file:
-            with open(output_file, 'w') as f:
-                json_obj = json.dumps(
-                    [
-                        {k: v for k, v in flowlog.__dict__.items() if k != "schema"}
-                        for flowlog in results
-                    ],
-                    indent=2,
-                )
-                f.write(json_obj)
-        
     def do_search_src_dst(self, arg):
-        'Search flow logs by source and destination IP:  SEARCH_SRC_DST <src_ip> <dst_ip> [output_file]'
-        output_file = None
-        src_ip, dst_ip = "", ""
+        'Search flow logs by source and destination IP or CIDR block:  SEARCH_SRC_DST <src_ip> <dst_ip> [output_file] [format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]'
         try:
+            arg, options = split_output_options(arg)
             split_args = arg.split()
             if len(split_args) == 3:
                 src_ip, dst_ip, output_file = split_args
             elif len(split_args) == 2:
-                src_ip, dst_ip = split_args
+                (src_ip, dst_ip), output_file = split_args, None
+            else:
+                raise ValueError
         except ValueError:
-            print('Invalid arguments. Usage: SEARCH_SRC_DST <src_ip> <dst_ip>\n', file=self.stdout)
+            print(f'Invalid arguments. Usage: SEARCH_SRC_DST <src_ip> <dst_ip> [output_file] {OUTPUT_USAGE}\n', file=self.stdout)
             return
 
         # validate IP addresses
         try:
-            ip.ip_address(src_ip)
-            ip.ip_address(dst_ip)
+            validate_address(src_ip)
+            validate_address(dst_ip)
         except ValueError:
             print(f'Invalid IP address: {src_ip!r} or {dst_ip!r}. Please provide valid IPv4 addresses.\n', file=self.stdout)
             return
 
-        results = self.parser.search_by_source_and_destination_ip(src_ip, dst_ip)
-        for flowlog in results:
-            print(flowlog, file=self.stdout)
-        print(f'\nTotal results: {len(results)}\n', file=self.stdout)
+        self._emit_results(self.parser.search_by_source_and_destination_ip(src_ip, dst_ip), output_file, options)
+
+    def do_search_time(self, arg):
+        'Search flows overlapping a time window:  SEARCH_TIME <from> <to> [src=<src_ip>] [dst=<dst_ip>] [output_file] [format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]\nTimes are epoch seconds or ISO-8601 (UTC unless an offset is given). src/dst also take CIDR blocks.'
+        try:
+            arg, options = split_output_options(arg)
+            split_args = arg.split()
+            filters = dict(token.split('=', 1) for token in split_args if token.startswith(('src=', 'dst=')))
+            positional = [token for token in split_args if not token.startswith(('src=', 'dst='))]
+            if len(positional) == 3:
+                start, end, output_file = positional
+            elif len(positional) == 2:
+                (start, end), output_file = positional, None
+            else:
+                raise ValueError
+            start, end = parse_time(start), parse_time(end)
+        except ValueError:
+            print(f'Invalid arguments. Usage: SEARCH_TIME <from> <to> [src=<src_ip>] [dst=<dst_ip>] [output_file] {OUTPUT_USAGE}\n', file=self.stdout)
+            return
+
+        try:
+            for address in filters.values():
+                validate_address(address)
+        except ValueError:
+            print(f'Invalid IP address in {filters!r}. Please provide valid IPv4 addresses.\n', file=self.stdout)
+            return
+
+        results = self.parser.search_by_time(start, end, src_ip=filters.get('src'), dst_ip=filters.get('dst'))
+        self._emit_results(results, output_file, options)
+
+    def do_query(self, arg):
+        'Search flow logs with a compound predicate:  QUERY <field><op><value> [AND|OR <field><op><value> ...] [INTO output_file] [format=json|ndjson|csv] [limit=N] [offset=N] [quiet] [count]\nOperators are = != < <= > >=, AND binds tighter than OR. srcaddr/dstaddr take CIDR blocks, start/end take ISO-8601 times.\nExample: QUERY srcaddr=10.0.1.0/24 AND dstport=443 AND action=REJECT'
+        usage = f'Usage: QUERY <field><op><value> [AND|OR <field><op><value> ...] [INTO output_file] {OUTPUT_USAGE}'
+        try:
+            arg, options = split_output_options(arg)
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. {usage}\n', file=self.stdout)
+            return
+        expression, output_file = split_clause(arg, 'INTO')
+        try:
+            results = self.parser.query(expression)
+        except QueryError as e:
+            print(f'Invalid query: {e}. {usage}\n', file=self.stdout)
+            return
+
+        self._emit_results(results, output_file, options)
+
+    def do_explain(self, arg):
+        'Show how a QUERY expression would be answered, which index is probed first and which predicates are filtered:  EXPLAIN <expression>'
+        try:
+            plan = self.parser.explain(arg)
+        except QueryError as e:
+            print(f'Invalid query: {e}\n', file=self.stdout)
+            return
+        print('\n'.join(plan) + '\n', file=self.stdout)
+
+    def do_aggregate(self, arg):
+        'Group flow logs by fields and aggregate them:  AGGREGATE <field>[,<field>...] [count] [sum|min|max(<field>) ...] [top=N] [order=<metric>] [WHERE <expression>] [INTO output_file]\nResults are sorted by the first metric (count if none is given), largest first. WHERE takes a QUERY expression.\nExample: AGGREGATE dstport sum(bytes) top=20 WHERE action=REJECT'
+        usage = 'Usage: AGGREGATE <field>[,<field>...] [count] [sum|min|max(<field>) ...] [top=N] [order=<metric>] [WHERE <expression>] [INTO output_file]'
+        arg, output_file = split_clause(arg, 'INTO')
+        arg, where = split_clause(arg, 'WHERE')
+        try:
+            tokens = arg.split()
+            if not tokens:
+                raise ValueError('expected fields to group by')
+            group_by = tokens[0].split(',')
+            options = dict(token.split('=', 1) for token in tokens[1:] if '=' in token)
+            metrics = [token for token in tokens[1:] if '=' not in token] or ['count']
+            unknown = set(options) - {'top', 'order'}
+            if unknown:
+                raise ValueError(f'unknown option {unknown.pop()!r}')
+            top = int(options['top']) if 'top' in options else None
+            results = self.parser.aggregate(group_by, metrics, where=where, top=top, order_by=options.get('order'))
+        except ValueError as e:
+            # QueryError is a ValueError too
+            print(f'Invalid arguments: {e}. {usage}\n', file=self.stdout)
+            return
+
+        self._print_table(results)
+        print(f'\nTotal groups: {len(results)}\n', file=self.stdout)
 
         if output_file:
             with open(output_file, 'w') as f:
-                # Build list of dicts excluding any 'schema' property before dumping to JSON
-                json_obj = json.dumps(
-                    [
-                        {k: v for k, v in flowlog.__dict__.items() if k != "schema"}
-                        for flowlog in results
-                    ],
-                    indent=2,
+                f.write(json.dumps(results, indent=2))
+
+    def _print_table(self, rows):
+        # list of dicts as left-aligned columns under a header line
+        if not rows:
+            return
+        columns = list(rows[0])
+        widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+        print('  '.join(f'{column:<{width}}' for column, width in zip(columns, widths)).rstrip(), file=self.stdout)
+        for row in rows:
+            print('  '.join(f'{str(row[column]):<{width}}' for column, width in zip(columns, widths)).rstrip(), file=self.stdout)
+
+    def do_rollup(self, arg):
+        'Answer from a rollup built during LOAD (see SET_ROLLUPS) instead of the rows:  ROLLUP <rollup> [from=<time>] [to=<time>] [last=seconds] [by=key|time] [key=<value>[,<value>...]] [top=N] [order=flows|packets|bytes] [INTO output_file]\nby=key (the default) sums flows, packets and bytes per value of the rollup\'s fields, largest first; by=time sums them per bucket, of one key=... or of all. last=3600 is the last hour up to the newest flow. Times take the SEARCH_TIME formats.\nExample: ROLLUP dstport last=3600 top=10'
+        usage = 'Usage: ROLLUP <rollup> [from=<time>] [to=<time>] [last=seconds] [by=key|time] [key=<value>[,<value>...]] [top=N] [order=flows|packets|bytes] [INTO output_file]'
+        arg, output_file = split_clause(arg, 'INTO')
+        if not getattr(self, 'parser', None):
+            print('No flow logs loaded. Use LOAD first.\n', file=self.stdout)
+            return
+        try:
+            tokens = arg.split()
+            if not tokens:
+                raise ValueError('expected a rollup name')
+            summary = self.parser.get_rollup(tokens[0])
+            options = {}
+            for token in tokens[1:]:
+                key, sep, value = token.partition('=')
+                if not sep or key not in ('from', 'to', 'last', 'by', 'key', 'top', 'order'):
+                    raise ValueError(f'unknown option {token!r}')
+                options[key] = value
+            started = time.perf_counter()
+            with self.parser.lock:
+                results = rollup.answer(
+                    summary,
+                    start=parse_time(options['from']) if 'from' in options else None,
+                    end=parse_time(options['to']) if 'to' in options else None,
+                    last=int(options['last']) if 'last' in options else None,
+                    by=options.get('by', 'key'), key=options.get('key'),
+                    top=int(options['top']) if 'top' in options else None, order_by=options.get('order', 'bytes'),
                 )
-                f.write(json_obj)
+            elapsed = time.perf_counter() - started
+        except ValueError as e:
+            # QueryError is a ValueError too
+            print(f'Invalid arguments: {e}. {usage}\n', file=self.stdout)
+            return
+
+        self._print_table(results)
+        print(f'\nTotal {"buckets" if options.get("by") == "time" else "groups"}: {len(results)} from rollup {summary.name} in {elapsed * 1000:.2f} ms\n', file=self.stdout)
+
+        if output_file:
+            with open(output_file, 'w') as f:
+                f.write(json.dumps(results, indent=2))
+
+    def do_batch(self, arg):
+        'Answer a file of queries together, one result file per distinct query:  BATCH <queries_file> <output_dir> [format=json|ndjson|csv]\nEach line is a SEARCH_SRC, SEARCH_DST, SEARCH_SRC_DST, SEARCH_TIME, GET_CONNECTION_COUNT or QUERY command without output options. Repeated queries are answered once, index lookups are grouped and unindexed QUERY predicates share scans over the rows. output_dir/summary.tsv maps each line to its result and file.'
+        try:
+            arg, options = split_output_options(arg)
+            queries_file, output_dir = arg.split()
+        except ValueError:
+            print('Invalid arguments. Usage: BATCH <queries_file> <output_dir> [format=json|ndjson|csv]\n', file=self.stdout)
+            return
+        if not getattr(self, 'parser', None) or self.parser.counts_only:
+            print('No flow logs loaded. Use LOAD first.\n', file=self.stdout)
+            return
+
+        report = stats.Stats()
+        try:
+            with report.timer("total"):
+                with report.timer("parse"), open(queries_file) as f:
+                    batch_queries, errors = batch.read_batch(f)
+                batch.run_batch(self.parser, batch_queries, report)
+                with report.timer("write"):
+                    rows = batch.write_results(self.parser, batch_queries, errors, output_dir, options.get("format", "json"))
+        except OSError as e:
+            print(f'Could not run the batch: {e}\n', file=self.stdout)
+            return
+
+        lines = sum(len(batch_query.lines) for batch_query in batch_queries)
+        failed = sum(len(batch_query.lines) for batch_query in batch_queries if batch_query.error is not None) + len(errors)
+        phases = report.phases
+        print(f'Answered {lines + len(errors) - failed} of {lines + len(errors)} queries ({len(batch_queries)} distinct) in {phases["total"]:.2f}s, {rows} rows written to {output_dir}.', file=self.stdout)
+        print(f'  parse {phases["parse"]:.3f}s, index probes {phases["index probes"]:.3f}s, shared scans {phases["shared scans"]:.3f}s ({report.counters["scanned_predicates"]} predicates), queries {phases["queries"]:.3f}s, write {phases["write"]:.3f}s', file=self.stdout)
+        if failed:
+            print(f'{failed} queries failed, see {batch.SUMMARY_FILE} for the reasons.', file=self.stdout)
+        print('', file=self.stdout)
+
+    def do_stats(self, arg):
+        'Show how the last load spent its time, row counters and approximate memory per column and index:  STATS [json]\nPer-row phases (tokenize, build, index) are timed on a sample of rows and scaled up, so they are estimates.'
+        if not getattr(self, 'parser', None):
+            print('No flow logs loaded. Use LOAD first.\n', file=self.stdout)
+            return
+        report = self.parser.stats.to_dict()
+        report["memory_bytes"] = stats.memory_report(self.parser)
+        if arg.strip().lower() == 'json':
+            print(json.dumps(report, indent=2) + '\n', file=self.stdout)
+            return
+
+        counters = report["counters"]
+        rows, size = counters.get("rows", 0), counters.get("bytes", 0)
+        print(f'Rows parsed: {rows} ({counters.get("rows_without_addresses", 0)} without addresses, {counters.get("malformed", 0)} malformed)', file=self.stdout)
+        print(f'Bytes parsed: {size / 2**20:.1f} MB' + (f' from {counters["files"]} files' if counters.get("files") else ''), file=self.stdout)
+        print('\nPhases:', file=self.stdout)
+        for phase, seconds in sorted(report["phases"].items()):
+            rate = f'  {size / 2**20 / seconds:8.1f} MB/s  {rows / seconds:10.0f} rows/s' if phase == 'load' and seconds else ''
+            print(f'  {phase:<22} {seconds:8.3f} s{rate}', file=self.stdout)
+        for phase, seconds in report["row_phases_estimated"].items():
+            print(f'  {phase:<22}~{seconds:8.3f} s', file=self.stdout)
+        print(f'  (row phases estimated from {report["samples"]} sampled rows)', file=self.stdout)
+        print('\nMemory (approximate):', file=self.stdout)
+        for name, size in report["memory_bytes"].items():
+            print(f'  {name:<34} {size / 2**20:8.2f} MB', file=self.stdout)
+        print(f'  {"total":<34} {sum(report["memory_bytes"].values()) / 2**20:8.2f} MB', file=self.stdout)
+        for error in report["errors"]:
+            print(f'Error: {error}', file=self.stdout)
+        print('', file=self.stdout)
+
+    def do_cache(self, arg):
+        'Show result cache statistics, empty the cache or change its size:  CACHE [clear] [entries=N] [bytes=N]\nRepeated searches and queries are answered from the cache, along with their printed and exported rows for results of up to 10000 rows. The least recently used results are evicted beyond N entries or N bytes, and the cache is emptied whenever rows are loaded or appended. entries=0 turns it off.'
+        if not getattr(self, 'parser', None):
+            print('No flow logs loaded. Use LOAD first.\n', file=self.stdout)
+            return
+        limits = {}
+        try:
+            for token in arg.split():
+                key, sep, value = token.partition('=')
+                if token.lower() == 'clear':
+                    self.parser.cache.invalidate()
+                elif sep and key in ('entries', 'bytes') and int(value) >= 0:
+                    limits['max_' + key] = int(value)
+                else:
+                    raise ValueError(f'unknown option {token!r}')
+        except ValueError as e:
+            print(f'Invalid arguments: {e}. Usage: CACHE [clear] [entries=N] [bytes=N]\n', file=self.stdout)
+            return
+        if limits:
+            # kept for the parsers of later loads
+            self.cache_limits = {**getattr(self, 'cache_limits', {}), **limits}
+            self.parser.cache.resize(**limits)
+
+        report = self.parser.cache.to_dict()
+        print(f'Entries: {report["entries"]} of {report["max_entries"]}, {report["bytes"] / 2**20:.2f} MB of {report["max_bytes"] / 2**20:.2f} MB', file=self.stdout)
+        print(f'Hits: {report["hits"]}, misses: {report["misses"]} (hit rate {report["hit_rate"]:.1%})', file=self.stdout)
+        print(f'Evictions: {report["evictions"]}, invalidations: {report["invalidations"]}\n', file=self.stdout)
+
+    def do_profile(self, arg):
+        'Run a command under cProfile (hottest functions by own time) or tracemalloc (top allocation sites):  PROFILE [cprofile|tracemalloc] [top=N] <command ...>\nExample: PROFILE tracemalloc top=10 load data/temp_flowlogs.txt'
+        tokens = arg.split()
+        mode, top = 'cprofile', 20
+        while tokens and (tokens[0].lower() in ('cprofile', 'tracemalloc') or tokens[0].startswith('top=')):
+            token = tokens.pop(0)
+            if token.startswith('top='):
+                try:
+                    top = int(token[4:])
+                except ValueError:
+                    tokens = []
+                    break
+            else:
+                mode = token.lower()
+        if not tokens:
+            print('Invalid arguments. Usage: PROFILE [cprofile|tracemalloc] [top=N] <command ...>\n', file=self.stdout)
+            return
+        command = ' '.join(tokens)
+
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.runcall(self.onecmd, command)
+            print(f'Hottest functions of {command!r}:', file=self.stdout)
+            pstats.Stats(profiler, stream=self.stdout).sort_stats('tottime').print_stats(top)
+            return
+
+        if tracemalloc.is_tracing():
+            print('tracemalloc is already running, profile without it.\n', file=self.stdout)
+            return
+        tracemalloc.start()
+        try:
+            self.onecmd(command)
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+        print(f'Memory of {command!r}: {current / 2**20:.1f} MB still allocated, {peak / 2**20:.1f} MB peak', file=self.stdout)
+        for statistic in snapshot.statistics('lineno')[:top]:
+            print(f'  {statistic.size / 2**20:8.2f} MB  {statistic.count:9d} blocks  {statistic.traceback}', file=self.stdout)
+        print('', file=self.stdout)
+
+    def do_serve(self, arg):
+        'Serve the loaded flow logs to other clients over HTTP until interrupted:  SERVE [path [load options]] [host=127.0.0.1] [port=8765] [threads=N]\nWith a path the flow logs are loaded first (see LOAD for its options). Endpoints are named after the commands, e.g. /search_src?ip=10.0.1.0/24, /query?q=..., /aggregate?by=dstport&metrics=count&top=10, /get_connection_count, /rollup?name=srcaddr&last=3600, /stats and /load?path=... to swap in another file; rows stream back as NDJSON (or format=json|csv).'
+        server_options, load_args = {}, []
+        try:
+            for token in arg.split():
+                key, sep, value = token.partition('=')
+                if sep and key in ('host', 'port', 'threads'):
+                    server_options[key] = value if key == 'host' else int(value)
+                else:
+                    load_args.append(token)
+        except ValueError:
+            print('Invalid arguments. Usage: SERVE [path [load options]] [host=127.0.0.1] [port=8765] [threads=N]\n', file=self.stdout)
+            return
+
+        if load_args:
+            self.do_load(' '.join(load_args))
+        if not getattr(self, 'parser', None) or self.parser.counts_only:
+            print('No flow logs loaded. Use LOAD first or pass a path.\n', file=self.stdout)
+            return
+        server = QueryServer(self.parser, threads=server_options.get('threads', 4))
+        ready = lambda host, port: print(f'Serving {self.parser.path} on http://{host}:{port}, press Ctrl-C to stop.\n', file=self.stdout, flush=True)
+        try:
+            server.run(server_options.get('host', '127.0.0.1'), server_options.get('port', DEFAULT_PORT), ready)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f'Could not start the server: {e}\n', file=self.stdout)
+            return
+        # the server may have swapped in another file
+        self.parser = server.parser
+        print('Server stopped.\n', file=self.stdout)
 
     def do_get_connection_count(self, arg):
         'Get connection count by src_ip, src_port, dst_ip, dst_port, protocol:  GET_CONNECTION_COUNT <src_ip> <src_port> <dst_ip> <dst_port> <protocol>'
@@ -178,3 +706,25 @@ class FlowlogParserCLI(cmd.Cmd):
 
         count = self.parser.get_connection_count(src_ip, src_port, dst_ip, dst_port, protocol)
         print(f'Connection count: {count}\n', file=self.stdout)
+
+    def do_distinct(self, arg):
+        'Count distinct source IPs, or distinct destination ports of a destination IP:  DISTINCT [dst_ip]\nEstimated with HyperLogLog when loaded with epsilon=E, exact otherwise.'
+        split_args = arg.split()
+        if len(split_args) > 1:
+            print('Invalid arguments. Usage: DISTINCT [dst_ip]\n', file=self.stdout)
+            return
+        if not split_args:
+            print(f'Distinct source IPs: {self.parser.count_distinct_sources()}\n', file=self.stdout)
+            return
+
+        try:
+            ip.ip_address(split_args[0])
+        except ValueError:
+            print(f'Invalid IP address: {split_args[0]!r}. Please provide a valid IPv4 address.\n', file=self.stdout)
+            return
+        try:
+            count = self.parser.count_distinct_destination_ports(split_args[0])
+        except ValueError as e:
+            print(f'Cannot count destination ports: {e}.\n', file=self.stdout)
+            return
+        print(f'Distinct destination ports: {count}\n', file=self.stdout)
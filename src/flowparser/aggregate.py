@@ -0,0 +1,115 @@
+import collections
+import heapq
+import operator
+import re
+import flowparser.constants as constants
+import flowparser.query as query
+from flowparser.query import QueryError
+from flowparser.store import DictColumn, IPv4Column
+
+# Group-by aggregation: one pass over the group key columns and metric columns, grouping on the
+# stored values (packed IPs, ints, dictionary codes) and only decoding the keys of the groups returned.
+METRIC = re.compile(r"(?P<function>sum|min|max)\((?P<field>[\w-]+)\)|count")
+
+def parse_metric(metric: str) -> tuple[str, str]:
+    # "count" or "<sum|min|max>(<int field>)" -> (function, field)
+    match = METRIC.fullmatch(metric.strip().lower())
+    if match is None:
+        raise QueryError(f"invalid metric {metric!r}, expected count, sum(field), min(field) or max(field)")
+    if match["function"] is None:
+        return "count", None
+    if match["field"] not in constants.FLOW_LOG_INT_FIELDS or match["field"] in ("start", "end"):
+        raise QueryError(f"{match['function']}() needs a numeric field such as packets or bytes, got {match['field']!r}")
+    return match["function"], match["field"]
+
+def _key_values(store, field: str, rows):
+    # Stored values of a group key field for the given rows (every row if None)
+    column = store.columns.get(field)
+    if column is None:
+        # lazy field, group on the decoded string
+        return [store.get(row_idx, field) for row_idx in (range(store.row_count) if rows is None else rows)]
+    values = column.codes if isinstance(column, DictColumn) else column.values
+    return values if rows is None else [values[row_idx] for row_idx in rows]
+
+def _metric_values(store, field: str, rows):
+    column = store.columns.get(field)
+    if column is None:
+        tokens = [store.get(row_idx, field) for row_idx in (range(store.row_count) if rows is None else rows)]
+        return [-1 if token is None else int(token) for token in tokens]
+    return column.values if rows is None else [column.values[row_idx] for row_idx in rows]
+
+def _decoder(store, field: str):
+    column = store.columns.get(field)
+    if column is None:
+        return lambda value: value
+    if isinstance(column, DictColumn):
+        return column.symbols.__getitem__
+    if isinstance(column, IPv4Column):
+        return column.decode
+    return lambda value: None if value == column.null else value
+
+def aggregate(parser, group_by: list[str], metrics: list[str] = ("count",), where: str = None, top: int = None, order_by: str = None) -> list[dict]:
+    # Rows are {group field: value, ..., metric: value}, sorted by order_by (the first metric by default), largest first
+    store = parser.store
+    if not group_by:
+        raise QueryError("nothing to group by")
+    for field in group_by:
+        if field not in store.positions:
+            raise QueryError(f"field {field!r} is not in the loaded schema")
+    specs = [parse_metric(metric) for metric in metrics]
+    names = ["count" if function == "count" else f"{function}({field})" for function, field in specs]
+    for function, field in specs:
+        if field is not None and field not in store.positions:
+            raise QueryError(f"field {field!r} is not in the loaded schema")
+    order_by = names[0] if order_by is None else order_by.strip().lower()
+    if order_by not in names:
+        raise QueryError(f"cannot order by {order_by!r}, it is not one of the metrics {names}")
+    if top is not None and top < 1:
+        raise QueryError("top must be at least 1")
+
+    rows = None if where is None else query.execute(parser, where)
+    keys = [_key_values(store, field, rows) for field in group_by]
+    # every metric is its own tight pass over (group key, value) pairs
+    groups = list(zip(*keys)) if len(keys) > 1 else keys[0]
+    totals = {("count", None): collections.Counter(groups)}
+    for function, field in specs:
+        if (function, field) in totals:
+            continue
+        values = _metric_values(store, field, rows)
+        null = store.columns[field].null if field in store.columns else -1
+        if function == "sum":
+            sums = totals[function, field] = collections.defaultdict(int)
+            for key, value in zip(groups, values):
+                if value != null:
+                    sums[key] += value
+            continue
+        better = operator.lt if function == "min" else operator.gt
+        extremes = totals[function, field] = {}
+        for key, value in zip(groups, values):
+            if value != null:
+                current = extremes.get(key)
+                if current is None or better(value, current):
+                    extremes[key] = value
+
+    counts = totals["count", None]
+    def results(key) -> list:
+        # groups whose values are all missing sum to 0 and have no min/max
+        return [totals[spec].get(key, 0 if spec[0] == "sum" else None) for spec in specs]
+
+    order = names.index(order_by)
+    # min/max of a group without any value sort last
+    sort_key = lambda item: (item[1][order] is not None, item[1][order] or 0)
+    items = ((key, results(key)) for key in counts)
+    if top is None:
+        selected = sorted(items, key=sort_key, reverse=True)
+    else:
+        selected = heapq.nlargest(top, items, key=sort_key)
+
+    decoders = [_decoder(store, field) for field in group_by]
+    output = []
+    for key, values in selected:
+        key = key if len(group_by) > 1 else (key,)
+        row = {field: decode(value) for field, decode, value in zip(group_by, decoders, key)}
+        row.update(zip(names, values))
+        output.append(row)
+    return output
@@ -0,0 +1,214 @@
+import array
+import bisect
+import json
+import os
+import flowparser.export as export
+import flowparser.query as query
+import flowparser.stats as stats
+from flowparser.index import pack_pair, union_all
+from flowparser.parser import network_range, pack_ip
+from flowparser.query import QueryError, parse_time
+from flowparser.store import RowSet, int_to_ip
+
+# Batch execution: a file with one command per line in the shell's syntax, e.g.
+#   search_src 10.0.1.5
+#   search_dst 10.0.2.0/24
+#   search_src_dst 10.0.1.5 10.0.2.7
+#   search_time 2024-05-01T10:00:00 2024-05-01T10:05:00 src=10.0.1.5
+#   get_connection_count 10.0.1.5 49152 10.0.2.7 443 6
+#   query dstport=22 AND action=REJECT
+# All lines are parsed and deduplicated first. Index probes then run grouped per index in key order,
+# and the unindexed predicates of every query are filtered over the rows together (see
+# query.shared_scans) before the queries themselves run. Blank lines and lines starting with # are
+# skipped.
+COMMANDS = ("search_src", "search_dst", "search_src_dst", "search_time", "get_connection_count", "query")
+SUMMARY_FILE = "summary.tsv"
+
+class BatchQuery:
+    # One distinct query of the batch and the lines that asked for it
+    __slots__ = ("number", "command", "text", "args", "lines", "result", "error")
+
+    def __init__(self, number: int, command: str, text: str, args):
+        self.number = number
+        self.command = command
+        self.text = text
+        # packed addresses, times and parsed expressions, depending on the command
+        self.args = args
+        self.lines: list[int] = []
+        # row ids, or the count for get_connection_count
+        self.result = None
+        # why the query couldn't be answered, e.g. a field that isn't in the loaded schema
+        self.error = None
+
+def _is_dotted_quad(value: str) -> bool:
+    # Four decimal parts of 0-255 without leading zeros, as ipaddress accepts them. inet_aton alone also
+    # takes 10.1, 0x0a.0.0.1 and 010.0.0.1, which the shell rejects
+    parts = value.split(".")
+    return len(parts) == 4 and all(
+        part.isascii() and part.isdigit() and len(part) <= 3 and (part == "0" or part[0] != "0") and int(part) <= 255
+        for part in parts
+    )
+
+def _address(value: str):
+    # Packed IPv4 address, or the (first, last) packed addresses of a CIDR block. Cheaper than
+    # ipaddress for single addresses, which are most of a batch
+    if "/" in value:
+        bounds = network_range(value)
+        if bounds is None:
+            raise ValueError(f"invalid CIDR block {value!r}")
+        return bounds
+    packed = pack_ip(value) if _is_dotted_quad(value) else None
+    if packed is None:
+        raise ValueError(f"invalid IP address {value!r}")
+    return packed
+
+def _bounds(address) -> tuple[int, int]:
+    # (first, last) packed address, to order single addresses and CIDR blocks together
+    return address if isinstance(address, tuple) else (address, address)
+
+def _address_text(address) -> str:
+    if isinstance(address, tuple):
+        first, last = address
+        return f"{int_to_ip(first)}/{32 - (last - first).bit_length()}"
+    return int_to_ip(address)
+
+def parse_line(line: str):
+    # (command, args) of one batch line, raises ValueError (or QueryError) when it's invalid
+    command, _, rest = line.strip().partition(" ")
+    command = command.lower()
+    tokens = rest.split()
+    if command in ("search_src", "search_dst"):
+        if len(tokens) != 1:
+            raise ValueError(f"expected {command} <ip>|<network/prefix>")
+        return command, _address(tokens[0])
+    if command == "search_src_dst":
+        if len(tokens) != 2:
+            raise ValueError("expected search_src_dst <src_ip> <dst_ip>")
+        return command, (_address(tokens[0]), _address(tokens[1]))
+    if command == "search_time":
+        filters = dict(token.split("=", 1) for token in tokens if token.startswith(("src=", "dst=")))
+        positional = [token for token in tokens if not token.startswith(("src=", "dst="))]
+        if len(positional) != 2:
+            raise ValueError("expected search_time <from> <to> [src=<ip>] [dst=<ip>]")
+        src, dst = filters.get("src"), filters.get("dst")
+        return command, (
+            parse_time(positional[0]), parse_time(positional[1]),
+            _address(src) if src else None, _address(dst) if dst else None,
+        )
+    if command == "get_connection_count":
+        if len(tokens) != 5:
+            raise ValueError("expected get_connection_count <src_ip> <src_port> <dst_ip> <dst_port> <protocol>")
+        src, dst = _address(tokens[0]), _address(tokens[2])
+        if isinstance(src, tuple) or isinstance(dst, tuple):
+            raise ValueError("connection counts take single IP addresses")
+        return command, (src, dst, int(tokens[1]), int(tokens[3]), int(tokens[4]))
+    if command == "query":
+        return command, query.parse_query(rest)
+    raise ValueError(f"unknown command {command!r}, expected one of {', '.join(COMMANDS)}")
+
+def read_batch(lines) -> tuple[list[BatchQuery], list[tuple[int, str, str]]]:
+    # Distinct queries in order of first appearance, and (line number, line, reason) of invalid lines
+    queries: dict[tuple, BatchQuery] = {}
+    errors = []
+    for line_number, line in enumerate(lines, 1):
+        # tabs would break the summary's columns
+        line = " ".join(line.split())
+        if not line or line.startswith("#"):
+            continue
+        try:
+            command, args = parse_line(line)
+        except ValueError as e:
+            # QueryError is a ValueError too
+            errors.append((line_number, line, str(e)))
+            continue
+        key = (command, query.query_key(args) if command == "query" else args)
+        batch_query = queries.get(key)
+        if batch_query is None:
+            batch_query = queries[key] = BatchQuery(len(queries) + 1, command, line, args)
+        batch_query.lines.append(line_number)
+    return list(queries.values()), errors
+
+def _probe_addresses(index, batch_queries: list[BatchQuery]) -> None:
+    # Single addresses are looked up directly, CIDR blocks bisect the sorted keys from where the
+    # previous block started, since they are visited in address order
+    keys, start = None, 0
+    for batch_query in sorted(batch_queries, key=lambda batch_query: _bounds(batch_query.args)):
+        if not isinstance(batch_query.args, tuple):
+            batch_query.result = index.postings(batch_query.args)
+            continue
+        if keys is None:
+            keys = index.sorted_keys()
+        low, high = batch_query.args
+        start = bisect.bisect_left(keys, low, start)
+        stop = bisect.bisect_right(keys, high, start)
+        postings = [index[keys[i]] for i in range(start, stop)]
+        batch_query.result = union_all(postings) if postings else array.array('I')
+
+def run_batch(parser, batch_queries: list[BatchQuery], report: stats.Stats = None) -> stats.Stats:
+    # Answers every query in place (BatchQuery.result), returns report with the time spent per phase
+    report = report or stats.Stats()
+    by_command = {command: [] for command in COMMANDS}
+    for batch_query in batch_queries:
+        by_command[batch_query.command].append(batch_query)
+
+    with parser.lock:
+        with report.timer("index probes"):
+            _probe_addresses(parser.source_ip_index, by_command["search_src"])
+            _probe_addresses(parser.destination_ip_index, by_command["search_dst"])
+            for batch_query in sorted(by_command["search_src_dst"], key=lambda batch_query: tuple(map(_bounds, batch_query.args))):
+                src, dst = batch_query.args
+                if parser.pair_index and not isinstance(src, tuple) and not isinstance(dst, tuple):
+                    batch_query.result = parser.source_and_destination_ip_index.postings(pack_pair(src, dst))
+                else:
+                    batch_query.result = parser.pair_postings(_address_text(src), _address_text(dst))
+            for batch_query in sorted(by_command["search_time"], key=lambda batch_query: batch_query.args[:2]):
+                start, end, src, dst = batch_query.args
+                batch_query.result = parser.window_postings(
+                    start, end, _address_text(src) if src is not None else None, _address_text(dst) if dst is not None else None
+                )
+            counts = parser.connection_counts
+            for batch_query in by_command["get_connection_count"]:
+                batch_query.result = counts.get(batch_query.args, 0)
+
+        with report.timer("shared scans"):
+            scanned = []
+            for batch_query in by_command["query"]:
+                try:
+                    scanned.extend(query.full_scans(parser, batch_query.args))
+                except QueryError as e:
+                    batch_query.error = str(e)
+            scans = query.shared_scans(parser.store, scanned)
+        report.count("scanned_predicates", len(scans))
+        with report.timer("queries"):
+            for batch_query in by_command["query"]:
+                if batch_query.error is None:
+                    batch_query.result = query.execute(parser, batch_query.args, scans)
+    return report
+
+def write_results(parser, batch_queries: list[BatchQuery], errors: list[tuple[int, str, str]], output_dir: str, format: str = "json") -> int:
+    # One file per distinct query (NNNNN.<format>, connection counts as JSON) and SUMMARY_FILE mapping
+    # every line to its result, returns the number of rows written
+    os.makedirs(output_dir, exist_ok=True)
+    rows_written = 0
+    summary = [("line", "query", "result", "file")]
+    for batch_query in batch_queries:
+        if batch_query.error is not None:
+            summary.extend((line_number, batch_query.text, f"error: {batch_query.error}", "-") for line_number in batch_query.lines)
+            continue
+        if batch_query.command == "get_connection_count":
+            name = f"{batch_query.number:05d}.json"
+            with open(os.path.join(output_dir, name), "w") as f:
+                json.dump({"count": batch_query.result}, f)
+            result = f"count {batch_query.result}"
+        else:
+            name = f"{batch_query.number:05d}.{format}"
+            rows = RowSet(parser.store, batch_query.result)
+            with open(os.path.join(output_dir, name), "w", newline="" if format == "csv" else None) as f:
+                rows_written += export.write_rows(rows, f, format)
+            result = f"{len(rows)} rows"
+        summary.extend((line_number, batch_query.text, result, name) for line_number in batch_query.lines)
+    summary.extend((line_number, line, f"error: {reason}", "-") for line_number, line, reason in errors)
+    summary[1:] = sorted(summary[1:])
+    with open(os.path.join(output_dir, SUMMARY_FILE), "w") as f:
+        f.writelines("\t".join(map(str, entry)) + "\n" for entry in summary)
+    return rows_written
@@ -0,0 +1,112 @@
+import collections
+import ipaddress
+import sys
+import threading
+
+# Results of repeated searches and queries, plus their rendered text, kept in one LRU cache per parser.
+# Entries are evicted least recently used first once there are more than max_entries of them or they
+# hold more than max_bytes, and the whole cache is dropped whenever rows are ingested.
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 64 * 2**20
+
+def size_of(value) -> int:
+    # Approximate bytes held by a cached value: a RowSet's row ids, rendered text, ...
+    row_ids = getattr(value, "row_ids", None)
+    if row_ids is not None:
+        return sys.getsizeof(value) + sys.getsizeof(row_ids)
+    return sys.getsizeof(value)
+
+def address_key(address: str) -> str:
+    # Canonical IP or CIDR argument, so 10.0.1.7/24 and 10.0.1.0/24 share an entry. Invalid addresses are
+    # kept as given, the search reports them
+    try:
+        if "/" in address:
+            return str(ipaddress.ip_network(address, strict=False))
+        return str(ipaddress.ip_address(address))
+    except ValueError:
+        return address
+
+class ResultCache:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (value, bytes), least recently used first
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped on invalidation, a result computed before that is not stored
+        self.generation = 0
+        # the query server looks results up from several threads
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation: int = None) -> None:
+        size = size_of(value)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if size > self.max_bytes or not self.max_entries:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def get_or_compute(self, key, compute):
+        # Cached value of key, or compute() stored under it. Nothing is stored if compute raises, or if
+        # rows were ingested while it ran
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation
+        value = compute()
+        self.put(key, value, generation)
+        return value
+
+    def _evict(self) -> None:
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_entries: int = None, max_bytes: int = None) -> None:
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self) -> None:
+        # Drop every entry, called whenever the parser's rows change
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation += 1
+            self.invalidations += 1
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries), "bytes": self.bytes,
+            "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions, "invalidations": self.invalidations,
+        }
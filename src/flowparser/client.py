@@ -0,0 +1,85 @@
+import http.client
+import json
+import urllib.parse
+from flowparser.server import DEFAULT_PORT
+
+# Client for the query server (python3 main.py serve ...). One keep-alive connection per client;
+# row results are read line by line from the NDJSON stream as they arrive.
+
+class ServerError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+class QueryClient:
+    def __init__(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT, timeout: float = None):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, command: str, params: dict) -> http.client.HTTPResponse:
+        query = urllib.parse.urlencode({name: value for name, value in params.items() if value is not None})
+        self.connection.request("GET", f"/{command}?{query}")
+        response = self.connection.getresponse()
+        if response.status != 200:
+            body = response.read()
+            try:
+                message = json.loads(body)["error"]
+            except (ValueError, KeyError):
+                message = body.decode(errors="replace")
+            raise ServerError(response.status, message)
+        return response
+
+    def call(self, command: str, **params):
+        # A command answering with one JSON document (aggregate, explain, stats, load, ...)
+        return json.loads(self._request(command, params).read())
+
+    def rows(self, command: str, **params):
+        # Rows of a search or query as dicts, yielded as they are streamed. Read them all before sending
+        # the next request on this client.
+        response = self._request(command, dict(params, format="ndjson"))
+        for line in response:
+            yield json.loads(line)
+
+    def search_src(self, ip: str, **params):
+        return self.rows("search_src", ip=ip, **params)
+
+    def search_dst(self, ip: str, **params):
+        return self.rows("search_dst", ip=ip, **params)
+
+    def search_src_dst(self, src: str, dst: str, **params):
+        return self.rows("search_src_dst", src=src, dst=dst, **params)
+
+    def search_time(self, start, end, src: str = None, dst: str = None, **params):
+        return self.rows("search_time", **{"from": start, "to": end, "src": src, "dst": dst}, **params)
+
+    def query(self, expression: str, **params):
+        return self.rows("query", q=expression, **params)
+
+    def explain(self, expression: str) -> list[str]:
+        return self.call("explain", q=expression)["plan"]
+
+    def aggregate(self, by: list[str], metrics: list[str] = ("count",), where: str = None, top: int = None, order: str = None) -> list[dict]:
+        return self.call("aggregate", by=",".join(by), metrics=",".join(metrics), where=where, top=top, order=order)
+
+    def get_connection_count(self, src_ip: str, src_port, dst_ip: str, dst_port, protocol) -> int:
+        return self.call("get_connection_count", src_ip=src_ip, src_port=src_port, dst_ip=dst_ip, dst_port=dst_port, protocol=protocol)["count"]
+
+    def rollup(self, name: str, start=None, end=None, last: int = None, by: str = None, key: str = None, top: int = None, order: str = None) -> list[dict]:
+        return self.call("rollup", name=name, **{"from": start, "to": end}, last=last, by=by, key=key, top=top, order=order)
+
+    def stats(self) -> dict:
+        return self.call("stats")
+
+    def load(self, path: str, workers: int = None, lazy: bool = False, skip_malformed: bool = False, rollups: list[str] = None) -> dict:
+        return self.call(
+            "load", path=path, workers=workers, lazy="1" if lazy else None, skip_malformed="1" if skip_malformed else None,
+            rollups=" ".join(rollups) if rollups is not None else None,
+        )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "QueryClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -16,8 +16,9 @@ FLOW_LOG_SCHEMA_DEFAULT = [
     "log-status",
 ]
 
-FLOW_LOG_SCHEMA_ALL = set(
-    ["version",
+# Every field in the order AWS documents them (version 2 fields first, then newer versions)
+FLOW_LOG_SCHEMA_ALL = [
+    "version",
     "account-id",
     "interface-id",
     "srcaddr",
@@ -58,5 +59,29 @@ FLOW_LOG_SCHEMA_ALL = set(
     "ecs-task-id",
     "reject-reason",
     "resource-id",
-    "encryption-status"]
-)
+    "encryption-status",
+]
+
+FLOW_LOG_FIELDS = frozenset(FLOW_LOG_SCHEMA_ALL)
+
+# Column types for the columnar store. IPv4 fields are packed into 32-bit ints,
+# integer fields are stored in typed arrays (array typecodes) and every other
+# field is dictionary-encoded.
+FLOW_LOG_IPV4_FIELDS = set(["srcaddr", "dstaddr", "pkt-srcaddr", "pkt-dstaddr"])
+
+FLOW_LOG_INT_FIELDS = {
+    "srcport": "i",
+    "dstport": "i",
+    "protocol": "h",
+    "packets": "q",
+    "bytes": "q",
+    "start": "q",
+    "end": "q",
+    "tcp-flags": "i",
+}
+
+# Fields the indexes and connection counts are built from, always decoded at ingest
+FLOW_LOG_INDEXED_FIELDS = ["srcaddr", "dstaddr", "srcport", "dstport", "protocol", "start", "end"]
+
+# Width of a time index bucket in seconds
+TIME_BUCKET_SECONDS = 60
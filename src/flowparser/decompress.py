@@ -0,0 +1,205 @@
+import collections
+import concurrent.futures
+import contextlib
+import mmap
+import queue
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed input is decompressed in background threads (zlib and zstandard release the GIL) and handed
+# to the parser as chunks through a bounded queue, so decompression and parsing overlap and at most
+# QUEUE_CHUNKS chunks are buffered.
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+CHUNK_BYTES = 1 << 20
+QUEUE_CHUNKS = 8
+_DONE = object()
+
+def detect_compression(path: str):
+    # "gzip", "zstd" or None for plain text, judged by the magic bytes rather than the file name
+    try:
+        with open(path, 'rb') as file:
+            return compression_of(file.read(4))
+    except OSError:
+        return None
+
+def compression_of(magic: bytes):
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+def _gzip_chunks(file):
+    # Sequential inflate, a new decompressor picks up after each member of a multi-member file
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = False
+    while True:
+        data = file.read(CHUNK_BYTES)
+        if not data:
+            break
+        while data:
+            pending = True
+            output = decompressor.decompress(data)
+            if output:
+                yield output
+            if not decompressor.eof:
+                break
+            pending = False
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+    if pending:
+        raise EOFError("compressed file ended before the end-of-stream marker was reached")
+
+def member_ranges(mapping) -> list[tuple[int, int]]:
+    # Candidate gzip member byte ranges: every gzip header signature (magic + deflate + reserved flag bits
+    # clear) starts one. The signature can also occur inside compressed data, those false starts are
+    # caught when their range fails to inflate on its own.
+    starts = [0]
+    position = mapping.find(GZIP_MAGIC + b'\x08', 1)
+    while position != -1:
+        if position + 3 < len(mapping) and mapping[position + 3] & 0xE0 == 0:
+            starts.append(position)
+        position = mapping.find(GZIP_MAGIC + b'\x08', position + 1)
+    return list(zip(starts, starts[1:] + [len(mapping)]))
+
+def _inflate_range(mapping, start: int, end: int):
+    # The member's data if [start, end) is exactly one complete gzip member, None otherwise
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        output = decompressor.decompress(mapping[start:end])
+    except zlib.error:
+        return None
+    if not decompressor.eof or decompressor.unused_data:
+        return None
+    return output
+
+def _inflate_member(mapping, start: int) -> tuple[bytes, int]:
+    # Inflate the single member starting at start, returns its data and the offset just past it
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    output = []
+    position = start
+    while not decompressor.eof:
+        if position >= len(mapping):
+            raise EOFError("compressed file ended before the end-of-stream marker was reached")
+        data = mapping[position:position + CHUNK_BYTES]
+        output.append(decompressor.decompress(data))
+        position += len(data)
+    return b''.join(output), position - len(decompressor.unused_data)
+
+def _gzip_parallel_chunks(file, workers: int):
+    # Members are inflated concurrently but yielded in file order, with at most 2 * workers in flight
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        ranges = member_ranges(mapping)
+        if len(ranges) == 1:
+            yield from _gzip_chunks(file)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            remaining = iter(ranges)
+            in_flight = collections.deque()
+
+            def fill():
+                while len(in_flight) < 2 * workers:
+                    member = next(remaining, None)
+                    if member is None:
+                        return
+                    in_flight.append((member, executor.submit(_inflate_range, mapping, *member)))
+
+            fill()
+            position = 0
+            while in_flight:
+                (start, end), future = in_flight.popleft()
+                output = future.result()
+                fill()
+                while position < start:
+                    # the previous range ended early or was rejected, inflate members up to this one directly
+                    output_before, position = _inflate_member(mapping, position)
+                    yield output_before
+                if start < position:
+                    # inside a member already inflated past a false header match
+                    continue
+                if output is None:
+                    output, end = _inflate_member(mapping, start)
+                if output:
+                    yield output
+                position = end
+
+def _zstd_chunks(file):
+    if zstandard is None:
+        raise ImportError("reading .zst flow logs needs the zstandard package (pip install zstandard)")
+    # read_across_frames handles files written as many independent frames
+    with zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True) as reader:
+        while True:
+            output = reader.read(CHUNK_BYTES)
+            if not output:
+                return
+            yield output
+
+def _put(chunks: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocks while the queue is full, gives up once the consumer has gone away
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _decompress(file, compression: str, workers: int, chunks: queue.Queue, stop: threading.Event) -> None:
+    if compression == "zstd":
+        source = _zstd_chunks(file)
+    elif workers > 1:
+        source = _gzip_parallel_chunks(file, workers)
+    else:
+        source = _gzip_chunks(file)
+    with contextlib.closing(source):
+        for chunk in source:
+            if not _put(chunks, chunk, stop):
+                return
+    _put(chunks, _DONE, stop)
+
+def _produce(source, compression: str, workers: int, chunks: queue.Queue, stop: threading.Event) -> None:
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as file:
+                _decompress(file, compression, workers, chunks, stop)
+        else:
+            _decompress(source, compression, 1, chunks, stop)
+    except BaseException as e:
+        _put(chunks, e, stop)
+
+def iter_chunks(source, compression: str, workers: int = 1):
+    # Decompressed chunks of source (a path or a binary file object) in order, chunk boundaries fall
+    # anywhere, even mid-line. workers > 1 inflates the members of a multi-member gzip file concurrently.
+    chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(source, compression, workers, chunks, stop), daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        producer.join()
+
+def iter_lines(chunks):
+    # Re-split decompressed chunks into newline-terminated lines
+    leftover = b''
+    for chunk in chunks:
+        lines = (leftover + chunk).split(b'\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if leftover:
+        yield leftover
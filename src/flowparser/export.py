@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+
+# Result export, one row at a time so memory stays flat however many rows match
+FORMATS = ("json", "ndjson", "csv")
+
+def infer_format(path: str) -> str:
+    # Format implied by the output file's extension, compact JSON otherwise
+    lowered = path.lower()
+    if lowered.endswith(".csv"):
+        return "csv"
+    if lowered.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "json"
+
+def encode_rows(rows, format: str = "json"):
+    # The text of a RowSet in format, piece by piece: one piece per row plus the header or brackets
+    if format not in FORMATS:
+        raise ValueError(f"unknown format {format!r}, expected one of {', '.join(FORMATS)}")
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["row_idx"] + list(rows.store.schema) + (["file"] if rows.store.files else []))
+        for flowlog in rows:
+            writer.writerow(["" if value is None else value for value in flowlog.to_dict().values()])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # an empty result still gets its header
+        if buffer.tell():
+            yield buffer.getvalue()
+        return
+
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    if format == "ndjson":
+        for flowlog in rows:
+            yield encode(flowlog.to_dict()) + "\n"
+        return
+
+    separator = "["
+    for flowlog in rows:
+        yield separator + encode(flowlog.to_dict())
+        separator = ",\n"
+    yield "[]\n" if separator == "[" else "]\n"
+
+def write_rows(rows, file, format: str = "json") -> int:
+    # Writes every row of a RowSet to the text file object, returns the number of rows written
+    file.writelines(encode_rows(rows, format))
+    return len(rows)
@@ -0,0 +1,90 @@
+import glob
+import os
+from flowparser.snapshot import default_snapshot_path
+from flowparser.store import DictColumn
+
+# Multi-file loads: a directory or glob expands to many flow log files (typically one per ENI per
+# 5-minute interval) whose rows are stored back to back. Each file keeps a little metadata so that
+# queries can skip files that cannot match.
+
+def is_multi_file(path: str) -> bool:
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def expand_paths(path: str) -> list[str]:
+    # Files under a directory (recursively) or matching a glob, sorted so row ids are stable between loads
+    if os.path.isdir(path):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    else:
+        paths = [match for match in glob.glob(path, recursive=True) if os.path.isfile(match)]
+    # skip index snapshots and hidden files lying next to the logs
+    return sorted(
+        candidate for candidate in paths
+        if not os.path.basename(candidate).startswith('.') and not candidate.endswith(default_snapshot_path(""))
+    )
+
+class SourceFile:
+    __slots__ = ("path", "first_row", "row_count", "start_range", "end_range", "interfaces")
+
+    def __init__(self, path: str, first_row: int, row_count: int):
+        self.path = path
+        self.first_row = first_row
+        self.row_count = row_count
+        # (min, max) of the start/end columns and the set of interface-ids, None when unknown
+        self.start_range = None
+        self.end_range = None
+        self.interfaces = None
+
+    def may_match(self, field: str, op: str, value) -> bool:
+        # False only if no row of this file can satisfy "field op value"
+        if field == "interface-id" and self.interfaces is not None:
+            if op == "=":
+                return value in self.interfaces
+            if op == "!=":
+                return self.interfaces != {value}
+            return True
+        bounds = self.start_range if field == "start" else self.end_range if field == "end" else None
+        if bounds is None:
+            return True
+        low, high = bounds
+        if op == "=":
+            return low <= value <= high
+        if op == "<":
+            return low < value
+        if op == "<=":
+            return low <= value
+        if op == ">":
+            return high > value
+        if op == ">=":
+            return high >= value
+        return True
+
+    def __repr__(self) -> str:
+        return f"SourceFile({self.path!r}, rows {self.first_row}..{self.first_row + self.row_count - 1})"
+
+def _bounds(values, null: int, first: int, last: int):
+    rows = values[first:last]
+    if not rows:
+        return None
+    low = min(rows)
+    if low == null:
+        present = [value for value in rows if value != null]
+        if not present:
+            return None
+        return min(present), max(present)
+    return low, max(rows)
+
+def describe(store, path: str, first_row: int, row_count: int) -> SourceFile:
+    source_file = SourceFile(path, first_row, row_count)
+    last_row = first_row + row_count
+    for field in ("start", "end"):
+        column = store.columns.get(field)
+        if column is not None:
+            bounds = _bounds(column.values, column.null, first_row, last_row)
+            if field == "start":
+                source_file.start_range = bounds
+            else:
+                source_file.end_range = bounds
+    column = store.columns.get("interface-id")
+    if isinstance(column, DictColumn):
+        source_file.interfaces = {column.symbols[code] for code in set(column.codes[first_row:last_row]) if code}
+    return source_file
@@ -0,0 +1,37 @@
+import flowparser.constants as constants
+import flowparser.decompress as decompress
+
+# Flow logs written with a custom format start with a header line naming their fields in order
+# ("version account-id interface-id srcaddr ..."), which is all it takes to know the schema.
+HEADER_PEEK_BYTES = 1 << 16
+
+def parse_header(line: bytes):
+    # The fields named by a header line, None if the line is a record
+    try:
+        tokens = line.decode().split()
+    except UnicodeDecodeError:
+        return None
+    if not tokens or not all(token in constants.FLOW_LOG_FIELDS for token in tokens):
+        return None
+    return tokens
+
+def read_header(path: str) -> tuple[list[str], int]:
+    # (fields, length in bytes of the header line) of a plain or compressed flow log, (None, 0) when it
+    # has no header
+    try:
+        compression = decompress.detect_compression(path)
+        if compression:
+            chunks = decompress.iter_chunks(path, compression)
+            try:
+                first = next(chunks, b'')[:HEADER_PEEK_BYTES]
+            finally:
+                chunks.close()
+            end = first.find(b'\n')
+            first = first if end == -1 else first[:end + 1]
+        else:
+            with open(path, 'rb') as file:
+                first = file.readline(HEADER_PEEK_BYTES)
+    except (OSError, EOFError):
+        return None, 0
+    fields = parse_header(first)
+    return (fields, len(first)) if fields else (None, 0)
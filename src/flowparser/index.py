@@ -0,0 +1,82 @@
+import array
+import bisect
+import sys
+
+class PostingIndex(dict):
+    # key -> sorted array('I') of row ids, rows are appended in increasing order
+    def __missing__(self, key):
+        postings = self[key] = array.array('I')
+        return postings
+
+    def sorted_keys(self) -> array.array:
+        # keys are only ever added, so a length mismatch means the cached order is stale
+        keys = self.__dict__.get("_sorted_keys")
+        if keys is None or len(keys) != len(self):
+            keys = self._sorted_keys = array.array('Q', sorted(self))
+        return keys
+
+    def range_postings(self, low: int, high: int) -> list[array.array]:
+        # postings of every key in [low, high], found by bisecting the sorted keys instead of scanning them
+        keys = self.sorted_keys()
+        start, stop = bisect.bisect_left(keys, low), bisect.bisect_right(keys, high)
+        return [self[keys[i]] for i in range(start, stop)]
+
+    def postings(self, key) -> array.array:
+        # a copy, so rows appended by a follower don't show up in results already handed out
+        postings = self.get(key)
+        return postings[:] if postings is not None else array.array('I')
+
+    def merge(self, other: "PostingIndex", offset: int = 0) -> None:
+        # other's row ids are shifted by offset, which must be past every row id in self
+        for key, postings in other.items():
+            if offset:
+                postings = array.array('I', [row_idx + offset for row_idx in postings])
+            if key in self:
+                self[key].extend(postings)
+            else:
+                self[key] = postings
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(key) + sys.getsizeof(postings) for key, postings in self.items()
+        )
+
+def pack_pair(src: int, dst: int) -> int:
+    return (src << 32) | dst
+
+def intersect(a: array.array, b: array.array) -> array.array:
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return array.array('I')
+    if len(a) * 16 < len(b):
+        # probe the short postings into the long one instead of hashing both
+        result = array.array('I')
+        lo, size = 0, len(b)
+        for row_idx in a:
+            lo = bisect.bisect_left(b, row_idx, lo)
+            if lo == size:
+                break
+            if b[lo] == row_idx:
+                result.append(row_idx)
+        return result
+    return array.array('I', sorted(set(a).intersection(b)))
+
+def union(a: array.array, b: array.array) -> array.array:
+    return array.array('I', sorted(set(a).union(b)))
+
+def intersect_all(postings: list[array.array]) -> array.array:
+    if not postings:
+        return array.array('I')
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for other in postings[1:]:
+        if not result:
+            break
+        result = intersect(result, other)
+    return result
+
+def union_all(postings: list[array.array]) -> array.array:
+    if len(postings) == 1:
+        return postings[0][:]
+    return array.array('I', sorted(set().union(*postings)))
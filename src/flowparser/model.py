@@ -1,25 +1,59 @@
-import flowparser.constants as constants
-
 class Flowlog:
-    def __init__(self, row_idx, schema=constants.FLOW_LOG_SCHEMA_DEFAULT, **kwargs):
-        self.schema = schema
+    # Lightweight view over one row of a FlowlogStore, fields are only decoded on access
+    __slots__ = ("store", "row_idx")
+
+    def __init__(self, store, row_idx: int):
+        self.store = store
         self.row_idx = row_idx
-        for field in schema:
-            setattr(self, field, kwargs.get(field))
-    
+
+    @property
+    def schema(self) -> list[str]:
+        return self.store.schema
+
+    def __getattr__(self, field):
+        if field in Flowlog.__slots__:
+            raise AttributeError(field)
+        if field in self.store.positions:
+            return self.store.get(self.row_idx, field)
+        raise AttributeError(field)
+
+    @property
+    def source_file(self):
+        # path of the file the row was read from, None for single-file loads
+        files = self.store.files
+        return files[self.store.file_of(self.row_idx)] if files else None
+
+    def to_dict(self) -> dict:
+        data = {"row_idx": self.row_idx}
+        data.update(zip(self.schema, self.store.values(self.row_idx)))
+        if self.store.files:
+            data["file"] = self.source_file
+        return data
+
     def to_pretty(self, indent: int = 2) -> str:
         lines = ["{"]
         pad = " " * indent
         lines.append(f"{pad}row_idx: {self.row_idx!r}")
-        for field in self.schema:
-            value = getattr(self, field, None)
-            lines.append(f"{pad}{field}: {value!r}")
+        for field, value in self.to_dict().items():
+            if field != "row_idx":
+                lines.append(f"{pad}{field}: {value!r}")
         lines.append("}")
         return "\n".join(lines)
 
     def __str__(self) -> str:
         return self.to_pretty()
-    
+
     def __repr__(self) -> str:
         return self.to_pretty()
-    
\ No newline at end of file
+
+def record_class(store) -> type:
+    # Flowlog subclass for one store with a property per field (hyphenated ones are read with getattr),
+    # so reading a field is one call into its column rather than the __getattr__ fallback
+    namespace = {"__slots__": ()}
+    for field in store.schema:
+        column = store.columns.get(field)
+        if column is not None:
+            namespace[field] = property(lambda row, get=column.get: get(row.row_idx))
+        else:
+            namespace[field] = property(lambda row, field=field: row.store.get(row.row_idx, field))
+    return type("Flowlog", (Flowlog,), namespace)
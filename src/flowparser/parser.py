@@ -1,62 +1,673 @@
+import array
 import collections
+import concurrent.futures
+import ipaddress
+import mmap
+import os
+import threading
+import time
+import flowparser.aggregate as aggregate
+import flowparser.cache as cache
 import flowparser.constants as constants
-from flowparser.model import Flowlog
+import flowparser.decompress as decompress
+import flowparser.files as files
+import flowparser.header as header
+import flowparser.query as query
+import flowparser.rollup as rollup
+import flowparser.snapshot as snapshot
+import flowparser.stats as stats
+import flowparser.stream as stream
+from flowparser.index import PostingIndex, intersect, intersect_all, pack_pair, union_all
+from flowparser.sketch import CountMinSketch, HyperLogLog, DESTINATION_PORT_PRECISION
+from flowparser.store import FlowlogStore, RowSet, IPV4_OTHER, ip_to_int
+
+# what a line that doesn't fit the schema raises while being appended: too few fields, a bad int or
+# address, an int out of its column's range or undecodable bytes
+MALFORMED_LINE_ERRORS = (IndexError, ValueError, OSError, OverflowError)
+
+# lazy multi-file loads keep every file mapped, and each mapping holds a file descriptor open: loads of more
+# files than this decode eagerly instead, well under the usual limit of 1024 open files
+LAZY_MAX_FILES = 256
+
+class MalformedLineError(ValueError):
+    def __init__(self, path: str, line_number: int, reason: str, line: bytes, offset: int = None):
+        super().__init__(path, line_number, reason, line)
+        self.path = path
+        self.line_number = line_number
+        self.reason = reason
+        self.line = line
+        # byte offset ingesting stopped at, every line before it is in the indexes
+        self.offset = offset
+
+    def __str__(self) -> str:
+        return f"{self.path} line {self.line_number}: {self.reason}"
+
+def pack_ip(ip: str):
+    try:
+        return ip_to_int(ip)
+    except OSError:
+        return None
+
+def network_range(cidr: str):
+    # (first, last) packed address of an IPv4 CIDR block, None for anything else
+    try:
+        network = ipaddress.IPv4Network(cidr, strict=False)
+    except ValueError:
+        return None
+    return int(network.network_address), int(network.broadcast_address)
+
+def shard_ranges(path: str, shards: int, start: int = 0, end: int = None) -> list[tuple[int, int]]:
+    # Split the file between start and end into byte ranges whose boundaries fall right after a newline
+    size = os.path.getsize(path) if end is None else end
+    boundaries = [start]
+    with open(path, 'rb') as file:
+        for shard in range(1, shards):
+            file.seek(max(start + (size - start) * shard // shards, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+def map_file(path: str):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _parse_file(options: dict, path: str) -> "Parser":
+    parser = Parser(**dict(options, path=path))
+    parser.deserialize()
+    parser.store.source = None
+    return parser
+
+def _parse_shard(options: dict, start: int, end: int) -> "Parser":
+    parser = Parser(**options)
+    # line numbers count from the shard's start, the parent rebases them
+    parser.lines = 0
+    mapping = map_file(parser.path)
+    parser._ingest(mapping, start, end)
+    return parser
 
 class Parser:
-    def __init__(self, path: str, schema=constants.FLOW_LOG_SCHEMA_DEFAULT):
+    def __init__(self, path: str, schema=constants.FLOW_LOG_SCHEMA_DEFAULT, pair_index: bool = True, lazy: bool = False, counts_only: bool = False, epsilon: float = None, skip_malformed: bool = False, rollups: list[str] = None):
         self.path = path
-        self.source_ip_index: dict[str, list[Flowlog]] = collections.defaultdict(list)
-        self.destination_ip_index: dict[str, list[Flowlog]] = collections.defaultdict(list)
-        self.source_and_destination_ip_index: dict[tuple[str, str], list[Flowlog]] = collections.defaultdict(list)
-        self.connection_counts: dict[tuple[str, str, str, str, str], int] = collections.defaultdict(int)
+        self.pair_index = pair_index
+        # gzip/zstd input is decompressed on the fly, and always decoded eagerly since there is no mapped
+        # text to slice lazy fields out of
+        self.compression = decompress.detect_compression(path) if path != '-' else None
+        lazy = lazy and self.compression is None
+        self.lazy = lazy
+        # a header line naming the fields (custom log formats) overrides the given schema, for a directory
+        # or glob the first file's header is used
+        first_path = path
+        if path != '-' and files.is_multi_file(path):
+            first_path = next(iter(files.expand_paths(path)), None)
+        fields, self.header_length = header.read_header(first_path) if first_path not in (None, '-') else (None, 0)
+        if fields:
+            schema = fields
+        # counts-only parsers stream the input (a file, gzip file or '-' for stdin) and keep no rows or indexes
+        self.counts_only = counts_only
+        self.aggregates = None
+        # with an epsilon, connection counts live in a fixed-size Count-Min Sketch (overcounting by at most
+        # epsilon * total flows) and distinct counts come from HyperLogLogs instead of the indexes
+        self.epsilon = epsilon
+        self.distinct_sources = HyperLogLog() if epsilon else None
+        self.destination_port_sketches: dict[int, HyperLogLog] = {}
+        # time-bucketed flow/packet/byte sums maintained while ingesting, see rollup.py. Rollups on fields
+        # the schema doesn't have are left out and listed in skipped_rollups as (name, reason)
+        self.rollups: list[rollup.Rollup] = []
+        self.skipped_rollups: list[tuple[str, str]] = []
+        for spec in rollups or ():
+            fields, seconds = rollup.parse_spec(spec)
+            missing = [field for field in fields + ("start",) if field not in schema]
+            if missing:
+                self.skipped_rollups.append((spec, f"{', '.join(missing)} not in the schema"))
+                continue
+            self.rollups.append(rollup.Rollup(fields, seconds))
+        # lazy parsers only decode the fields the indexes and rollups need, the rest is sliced from the mapped file
+        eager_fields = None
+        if lazy:
+            eager_fields = list(constants.FLOW_LOG_INDEXED_FIELDS)
+            if self.rollups:
+                eager_fields += ["packets", "bytes"] + [field for summary in self.rollups for field in summary.fields]
+        self.store = FlowlogStore(schema, eager_fields=eager_fields)
+        # packed IPv4 (or packed src/dst pair) -> sorted array('I') of row ids
+        self.source_ip_index: PostingIndex = PostingIndex()
+        self.destination_ip_index: PostingIndex = PostingIndex()
+        self.source_and_destination_ip_index: PostingIndex = PostingIndex()
+        # start // TIME_BUCKET_SECONDS -> row ids, with the longest flow seen to know how far back to look
+        self.time_index: PostingIndex = PostingIndex()
+        self.max_flow_duration = 0
+        # (srcaddr, dstaddr, srcport, dstport, protocol) with packed IPs -> count
+        self.connection_counts: dict[tuple[int, int, int, int, int], int] = CountMinSketch(epsilon) if epsilon else collections.defaultdict(int)
         self.schema: list[str] = schema
+        # byte offset just past the last ingested line, follow mode resumes from here
+        self.offset = self.header_length
+        # set when path is a directory or glob: one SourceFile (row range plus time/ENI metadata) per file
+        self.files: list[files.SourceFile] = []
+        # with skip_malformed a line that doesn't fit the schema is set aside as (path, line number, reason,
+        # line) and the load carries on, otherwise it stops the load
+        self.skip_malformed = skip_malformed
+        self.rejects: list[tuple[str, int, str, bytes]] = []
+        # lines consumed so far (rows, rejected and blank lines), to number rejected lines
+        self.lines = 1 if self.header_length else 0
+        # phase timers and row counters, see the STATS command
+        self.stats = stats.Stats()
+        # repeated searches and queries, and their rendered rows, dropped whenever rows are ingested
+        self.cache = cache.ResultCache()
+        # held while ingesting so a follower thread and queries don't interleave
+        self.lock = threading.RLock()
 
-    def deserialize(self) -> None:
-        row_idx = 0
-        try:
-            with open(self.path, 'r') as file:
-                for line in file:
-                    fields = line.strip().split()
-                    flowlog_data = {}
-                    for i, field in enumerate(self.schema):
-                        if fields[i] != '-':
-                            flowlog_data[field] = fields[i]
+    def options(self) -> dict:
+        # constructor arguments, used to build sibling parsers for shards
+        return {
+            "path": self.path, "schema": self.schema, "pair_index": self.pair_index,
+            "lazy": self.lazy, "counts_only": self.counts_only, "epsilon": self.epsilon,
+            "skip_malformed": self.skip_malformed, "rollups": [summary.name for summary in self.rollups],
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        del state["cache"]
+        return state
 
-                    flowlog = Flowlog(row_idx=row_idx, schema=self.schema, **flowlog_data)
-                    self.source_ip_index[getattr(flowlog, "srcaddr")].append(flowlog)
-                    self.destination_ip_index[getattr(flowlog, "dstaddr")].append(flowlog)
-                    self.source_and_destination_ip_index[(getattr(flowlog, "srcaddr"), getattr(flowlog, "dstaddr"))].append(flowlog)
-                    self.connection_counts[(getattr(flowlog, "srcaddr"), getattr(flowlog, "dstaddr"), getattr(flowlog, "srcport"), getattr(flowlog, "dstport"), getattr(flowlog, "protocol"))] += 1
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = cache.ResultCache()
+        self.lock = threading.RLock()
 
-                    row_idx += 1
+    def deserialize(self, workers: int = 1) -> None:
+        try:
+            with self.lock, self.stats.timer("load"):
+                if self.counts_only:
+                    self.aggregates = stream.StreamAggregates(self.connection_counts)
+                    self.connection_counts = self.aggregates.connection_counts
+                    self.aggregates.consume(stream.select_fields(stream.read_lines(self.path), self.schema))
+                    self.stats.count("rows", self.aggregates.rows)
+                    self.stats.count("rows_without_addresses", self.aggregates.skipped)
+                    return
+                if files.is_multi_file(self.path):
+                    self._deserialize_files(files.expand_paths(self.path), workers)
+                    return
+                if self.compression:
+                    self._ingest_chunks(decompress.iter_chunks(self.path, self.compression, workers))
+                    self.offset = os.path.getsize(self.path)
+                    return
+                with self.stats.timer("read"):
+                    mapping = map_file(self.path)
+                if self.lazy:
+                    self.store.source = mapping
+                # complete lines first, a follow resumes after the last one
+                end = max(mapping.rfind(b'\n') + 1, self.header_length)
+                try:
+                    if workers > 1:
+                        self._deserialize_parallel(workers, end)
+                    else:
+                        self._ingest(mapping, self.header_length, end)
+                except MalformedLineError as e:
+                    self.offset = e.offset
+                    raise
+                self.offset = end
+                self._ingest_last_line(mapping, end)
         except FileNotFoundError:
+            self.stats.errors.append(f"file not found: {self.path}")
             print(f"File not found: {self.path}")
+        except MalformedLineError as e:
+            self.stats.count("malformed")
+            self.stats.errors.append(str(e))
+            print(f"Schema mismatch in {e.path} line {e.line_number} ({e.reason}). Please check the schema and ensure it matches the log format, or load with skip_malformed to skip bad lines.")
         except IndexError:
+            self.store.truncate(self.store.row_count)
+            self.stats.count("malformed")
+            self.stats.errors.append(f"schema mismatch after row {self.store.row_count}")
             print(f"Schema mismatch in line. Please check the schema and ensure it matches the log format.")
         except Exception as e:
+            self.store.truncate(self.store.row_count)
+            self.stats.errors.append(str(e))
             print(f"An error occurred: {e}")
-            
-    def search_by_source_ip(self, src_ip: str) -> list[Flowlog]:
+        finally:
+            self.cache.invalidate()
+
+    def _ingest(self, source, start: int = 0, end: int = None, skip_malformed: bool = None) -> None:
+        # Scan newline-terminated lines of source (an mmap or bytes) between start and end
+        skip_malformed = self.skip_malformed if skip_malformed is None else skip_malformed
+        store = self.store
+        source_ip_index = self.source_ip_index
+        destination_ip_index = self.destination_ip_index
+        pair_index = self.source_and_destination_ip_index if self.pair_index else None
+        connection_counts = self.connection_counts
+        distinct_sources, port_sketches = self.distinct_sources, self.destination_port_sketches
+        src, dst = store.slot("srcaddr"), store.slot("dstaddr")
+        src_port, dst_port = store.slot("srcport"), store.slot("dstport")
+        protocol = store.slot("protocol")
+        time_index = self.time_index if "start" in store.columns and "end" in store.columns else None
+        if time_index is not None:
+            start_slot, end_slot = store.slot("start"), store.slot("end")
+        bucket_seconds = constants.TIME_BUCKET_SECONDS
+        max_duration = self.max_flow_duration
+        maxsplit = store.maxsplit
+        end = len(source) if end is None else end
+        offset = start
+        first_row = store.row_count
+        lines = self.lines
+        # rejected and blank lines of this call
+        skipped = 0
+        unaddressed = 0
+        sample = self.stats.sample
+        perf_counter, sample_mask = time.perf_counter, stats.SAMPLE_MASK
         try:
-            return self.source_ip_index.get(src_ip, [])
+            while True:
+                # Errors are handled per batch: the loop runs without a per-line try, a bad line drops out of
+                # it, is set aside and the loop starts over at the next line
+                try:
+                    while offset < end:
+                        row_idx = store.row_count
+                        sampled = not row_idx & sample_mask
+                        if sampled:
+                            started = perf_counter()
+                        line_end = source.find(b'\n', offset, end)
+                        if line_end == -1:
+                            line_end = end
+                        fields = source[offset:line_end].split(None, maxsplit)
+                        if sampled:
+                            tokenized = perf_counter()
+                        values = store.append(fields, offset)
+                        if sampled:
+                            built = perf_counter()
+                        offset = line_end + 1
+
+                        if time_index is not None and values[start_slot] != -1:
+                            time_index[values[start_slot] // bucket_seconds].append(row_idx)
+                            if values[end_slot] - values[start_slot] > max_duration:
+                                max_duration = self.max_flow_duration = values[end_slot] - values[start_slot]
+
+                        # only packed IPv4 addresses are indexed and counted, not missing or IPv6 ones
+                        src_ip, dst_ip = values[src], values[dst]
+                        if src_ip < IPV4_OTHER:
+                            source_ip_index[src_ip].append(row_idx)
+                        if dst_ip < IPV4_OTHER:
+                            destination_ip_index[dst_ip].append(row_idx)
+                            if src_ip < IPV4_OTHER:
+                                if pair_index is not None:
+                                    pair_index[pack_pair(src_ip, dst_ip)].append(row_idx)
+                                if distinct_sources is None:
+                                    connection_counts[(src_ip, dst_ip, values[src_port], values[dst_port], values[protocol])] += 1
+                                else:
+                                    connection_counts.increment((src_ip, dst_ip, values[src_port], values[dst_port], values[protocol]))
+                                    distinct_sources.add(src_ip)
+                                    ports = port_sketches.get(dst_ip)
+                                    if ports is None:
+                                        ports = port_sketches[dst_ip] = HyperLogLog(DESTINATION_PORT_PRECISION)
+                                    ports.add(values[dst_port])
+                            else:
+                                unaddressed += 1
+                        else:
+                            unaddressed += 1
+                        if sampled:
+                            indexed = perf_counter()
+                            sample(tokenized - started, built - tokenized, indexed - built)
+                    break
+                except MALFORMED_LINE_ERRORS as e:
+                    # drop whatever the partial row appended to the columns
+                    store.truncate(store.row_count)
+                    line = source[offset:line_end]
+                    if not line.strip():
+                        offset = line_end + 1
+                        skipped += 1
+                        self.stats.count("blank_lines")
+                        continue
+                    line_number = lines + store.row_count - first_row + skipped + 1
+                    if not skip_malformed:
+                        # the load stops before the line, so a later follow reads it again
+                        raise MalformedLineError(self.path, line_number, str(e), bytes(line), offset) from e
+                    offset = line_end + 1
+                    skipped += 1
+                    self.stats.count("malformed")
+                    self.rejects.append((self.path, line_number, str(e), bytes(line)))
+        finally:
+            if self.rollups:
+                with self.stats.timer("rollups"):
+                    for summary in self.rollups:
+                        summary.update(store, first_row, store.row_count)
+            self.lines = lines + store.row_count - first_row + skipped
+            self.stats.count("rows", store.row_count - first_row)
+            self.stats.count("bytes", min(offset, end) - start)
+            self.stats.count("rows_without_addresses", unaddressed)
+
+    def _ingest_last_line(self, mapping, start: int) -> None:
+        # A last line without a newline ends a file written without one or is still being written: it is
+        # kept when it fits the schema, otherwise left (not rejected) for follow to read once complete
+        if not mapping[start:].strip():
+            return
+        try:
+            self._ingest(mapping, start, skip_malformed=False)
+        except MalformedLineError:
+            return
+        self.offset = len(mapping)
+
+    def _ingest_chunks(self, chunks) -> None:
+        # Ingest decompressed chunks, carrying each chunk's trailing partial line over to the next one
+        leftover = b''
+        skip = self.header_length
+        chunks = iter(chunks)
+        while True:
+            # time spent waiting on the decompression thread
+            with self.stats.timer("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            buffer = leftover + chunk if leftover else chunk
+            if skip:
+                buffer, skip = buffer[skip:], max(0, skip - len(buffer))
+            end = buffer.rfind(b'\n') + 1
+            self._ingest(buffer, 0, end)
+            leftover = buffer[end:]
+        if leftover.strip():
+            self._ingest(leftover)
+
+    def _deserialize_files(self, paths: list[str], workers: int) -> None:
+        # Parse every file on its own (in a process pool with workers > 1) and merge them in path order
+        if not paths:
+            raise FileNotFoundError(self.path)
+        if self.lazy and (len(paths) > LAZY_MAX_FILES or any(decompress.detect_compression(path) for path in paths)):
+            # compressed files can't be sliced lazily, too many mapped files run out of descriptors, and all
+            # stores must decode the same fields
+            self.lazy = False
+            self.store = FlowlogStore(self.schema)
+        options = self.options()
+        if workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            parsed = executor.map(_parse_file, [options] * len(paths), paths, chunksize=max(1, len(paths) // (4 * workers)))
+        else:
+            executor = None
+            parsed = (_parse_file(options, path) for path in paths)
+        try:
+            for path, parser in zip(paths, parsed):
+                if parser.schema != self.schema:
+                    raise ValueError(f"{path} has fields {' '.join(parser.schema)}, expected {' '.join(self.schema)} like the other files")
+                first_row = self.store.row_count
+                self.store.add_file(path, map_file(path) if self.lazy else None)
+                self.merge(parser)
+                self.files.append(files.describe(self.store, path, first_row, parser.store.row_count))
+                self.stats.count("files")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def file_ranges(self, predicates) -> list[tuple[int, int]]:
+        # [first, last) row ranges of the files that may hold rows matching every (field, op, value)
+        # predicate, None when nothing can be skipped
+        if not self.files:
+            return None
+        kept = [
+            source_file for source_file in self.files
+            if all(source_file.may_match(field, op, value) for field, op, value in predicates)
+        ]
+        if len(kept) == len(self.files):
+            return None
+        return [(source_file.first_row, source_file.first_row + source_file.row_count) for source_file in kept]
+
+    def _deserialize_parallel(self, workers: int, end: int = None) -> None:
+        shards = shard_ranges(self.path, workers, self.header_length, end)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_parse_shard, self.options(), start, end)
+                for start, end in shards
+            ]
+            # merge in file order so row ids stay globally correct
+            for (start, _), future in zip(shards, futures):
+                try:
+                    shard = future.result()
+                except MalformedLineError as e:
+                    # shards number their lines from their own start, and none of this shard's rows are merged
+                    raise MalformedLineError(e.path, self.lines + e.line_number, e.reason, e.line, start) from None
+                self.merge(shard)
+
+    def merge(self, other: "Parser") -> None:
+        offset = self.store.row_count
+        self.stats.merge(other.stats)
+        self.store.extend(other.store)
+        self.source_ip_index.merge(other.source_ip_index, offset)
+        self.destination_ip_index.merge(other.destination_ip_index, offset)
+        self.source_and_destination_ip_index.merge(other.source_and_destination_ip_index, offset)
+        self.time_index.merge(other.time_index, offset)
+        self.max_flow_duration = max(self.max_flow_duration, other.max_flow_duration)
+        for summary, other_summary in zip(self.rollups, other.rollups):
+            summary.merge(other_summary)
+        # a shard's line numbers start at its first line, other files keep their own numbering
+        line_offset = self.lines if other.path == self.path else 0
+        self.rejects.extend((path, line_offset + line_number, reason, line) for path, line_number, reason, line in other.rejects)
+        self.lines += other.lines
+        if self.epsilon:
+            self.connection_counts.merge(other.connection_counts)
+            self.distinct_sources.merge(other.distinct_sources)
+            for dst_ip, ports in other.destination_port_sketches.items():
+                if dst_ip in self.destination_port_sketches:
+                    self.destination_port_sketches[dst_ip].merge(ports)
+                else:
+                    self.destination_port_sketches[dst_ip] = ports
+        else:
+            for key, count in other.connection_counts.items():
+                self.connection_counts[key] += count
+        self.cache.invalidate()
+
+    def ingest_appended(self) -> int:
+        # Ingest complete lines appended since the last load, returns the number of new rows
+        with self.lock:
+            if self.compression:
+                raise ValueError(f"{self.path} is {self.compression} compressed, only plain text flow logs can be followed")
+            if self.files:
+                raise ValueError(f"{self.path} names several files, only a single flow log can be followed")
+            size = os.path.getsize(self.path)
+            if size < self.offset:
+                raise ValueError(f"{self.path} shrank from {self.offset} to {size} bytes, reload it instead")
+            if size == self.offset:
+                return 0
+            mapping = map_file(self.path)
+            end = mapping.rfind(b'\n', self.offset, size) + 1
+            if end <= self.offset:
+                return 0
+            row_count = self.store.row_count
+            # searches don't take the lock, the new rows must never be sliced from the old, shorter mapping
+            if self.lazy:
+                self.store.source = mapping
+            try:
+                with self.stats.timer("follow"):
+                    self._ingest(mapping, self.offset, end)
+            except MalformedLineError as e:
+                # the lines before the bad one are indexed, the next poll starts at it
+                self.offset = e.offset
+                raise
+            finally:
+                self.cache.invalidate()
+            self.offset = end
+            return self.store.row_count - row_count
+
+    def write_rejects(self, path: str) -> int:
+        # One tab-separated line per rejected line: source file, line number, reason and the line as read,
+        # returns the number written
+        with open(path, 'wb') as file:
+            for source_path, line_number, reason, line in self.rejects:
+                file.write(f"{source_path}\t{line_number}\t{reason}\t".encode() + line.rstrip(b'\r') + b'\n')
+        return len(self.rejects)
+
+    def save_index(self, path: str = None) -> str:
+        if self.files:
+            raise ValueError("index snapshots cover a single flow log file")
+        path = path or snapshot.default_snapshot_path(self.path)
+        with self.lock:
+            snapshot.write_snapshot(self, path)
+        return path
+
+    def load_index(self, path: str = None) -> bool:
+        path = path or snapshot.default_snapshot_path(self.path)
+        try:
+            with self.lock:
+                snapshot.read_snapshot(self, path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Ignoring index snapshot {path}: {e}")
+            return False
+        if self.lazy:
+            self.store.source = map_file(self.path)
+        # snapshots hold no rollups, they are summed again from the columns
+        for i, summary in enumerate(self.rollups):
+            self.rollups[i] = rollup.Rollup(summary.fields, summary.seconds)
+            self.rollups[i].update(self.store, 0, self.store.row_count)
+        self.cache.invalidate()
+        return True
+
+    def _rows(self, row_ids=(), key=None) -> RowSet:
+        return RowSet(self.store, row_ids, key)
+
+    def _cached_rows(self, key, row_ids) -> RowSet:
+        # RowSet of row_ids(), answered from the result cache when the same search ran since the last ingest
+        return self.cache.get_or_compute(key, lambda: self._rows(row_ids(), key))
+
+    def _address_postings(self, index: PostingIndex, address: str, field: str):
+        if "/" not in address:
+            packed = pack_ip(address)
+            if packed is None and field in self.store.columns:
+                # IPv6 addresses aren't indexed, their rows are found by scanning the column
+                stored = self.store.columns[field].stored(address)
+                return query.equal_rows(self.store.columns[field].values, stored) if stored is not None else array.array('I')
+            return index.postings(packed)
+        bounds = network_range(address)
+        if bounds is None:
+            return array.array('I')
+        return union_all(index.range_postings(*bounds))
+
+    def source_postings(self, src_ip: str):
+        # src_ip may be a single address or a CIDR block such as 10.0.1.0/24
+        return self._address_postings(self.source_ip_index, src_ip, "srcaddr")
+
+    def destination_postings(self, dst_ip: str):
+        return self._address_postings(self.destination_ip_index, dst_ip, "dstaddr")
+
+    def time_postings(self, start: int, end: int) -> array.array:
+        # Rows whose flow overlaps [start, end] (epoch seconds): start <= end bound and end >= start bound
+        if "start" not in self.store.columns or "end" not in self.store.columns:
+            return array.array('I')
+        bucket_seconds = constants.TIME_BUCKET_SECONDS
+        # buckets starting inside the window hold only matches, earlier ones may hold flows still running
+        first_full = -(-start // bucket_seconds)
+        last_full = (end + 1) // bucket_seconds - 1
+        low, high = (start - self.max_flow_duration) // bucket_seconds, end // bucket_seconds
+        starts, ends = self.store.columns["start"].values, self.store.columns["end"].values
+
+        # walk the window's buckets, or the index's own when the window spans more buckets than it holds
+        if high - low < len(self.time_index):
+            buckets = ((bucket, self.time_index.get(bucket)) for bucket in range(low, high + 1))
+        else:
+            buckets = ((bucket, postings) for bucket, postings in self.time_index.items() if low <= bucket <= high)
+        matches = []
+        partial = []
+        for bucket, postings in buckets:
+            if postings is None:
+                continue
+            if first_full <= bucket <= last_full:
+                matches.append(postings)
+            else:
+                partial.extend(row_idx for row_idx in postings if starts[row_idx] <= end and ends[row_idx] >= start)
+        # filled bucket by bucket, so only sorted within each bucket when rows aren't in start order
+        matches.append(array.array('I', sorted(partial)))
+        return union_all(matches)
+
+    def window_postings(self, start: int, end: int, src_ip: str = None, dst_ip: str = None) -> array.array:
+        # time window, optionally narrowed to a source and/or destination IP or CIDR block
+        postings = [self.time_postings(start, end)]
+        if src_ip is not None:
+            postings.append(self.source_postings(src_ip))
+        if dst_ip is not None:
+            postings.append(self.destination_postings(dst_ip))
+        return intersect_all(postings)
+
+    def search_by_time(self, start: int, end: int, src_ip: str = None, dst_ip: str = None) -> RowSet:
+        try:
+            key = ("search_time", start, end, src_ip and cache.address_key(src_ip), dst_ip and cache.address_key(dst_ip))
+            return self._cached_rows(key, lambda: self.window_postings(start, end, src_ip, dst_ip))
+        except Exception as e:
+            print(f"An error occurred during search_by_time: {e}")
+            return self._rows()
+
+    def query(self, expression: str) -> RowSet:
+        # e.g. "srcaddr=10.0.1.0/24 AND dstport=443 AND action=REJECT", raises query.QueryError for bad expressions
+        # columns are scanned, so hold off follow-mode ingest meanwhile
+        key = ("query", query.query_key(expression))
+        with self.lock:
+            return self._cached_rows(key, lambda: query.execute(self, expression))
+
+    def explain(self, expression: str) -> list[str]:
+        return query.explain(self, expression)
+
+    def aggregate(self, group_by: list[str], metrics: list[str] = ("count",), where: str = None, top: int = None, order_by: str = None) -> list[dict]:
+        # e.g. aggregate(["dstport"], ["sum(bytes)"], where="action=REJECT", top=20) for the top 20 rejected ports by bytes
+        with self.lock:
+            return aggregate.aggregate(self, group_by, metrics, where=where, top=top, order_by=order_by)
+
+    def get_rollup(self, name: str) -> rollup.Rollup:
+        # The rollup named like "dstport" or "srcaddr,dstport@300", a name without @seconds matches any bucket
+        # width. Raises ValueError if there is none
+        fields, seconds = rollup.parse_spec(name)
+        for summary in self.rollups:
+            if summary.fields == fields and ("@" not in name or summary.seconds == seconds):
+                return summary
+        raise ValueError(f"no rollup {name!r}, loaded with {', '.join(summary.name for summary in self.rollups) or 'none'}")
+
+    def search_by_source_ip(self, src_ip: str) -> RowSet:
+        try:
+            return self._cached_rows(("search_src", cache.address_key(src_ip)), lambda: self.source_postings(src_ip))
         except Exception as e:
             print(f"An error occurred during search_by_source_ip: {e}")
-            return []
+            return self._rows()
     
-    def search_by_destination_ip(self, dst_ip: str) -> list[Flowlog]:
+    def search_by_destination_ip(self, dst_ip: str) -> RowSet:
         try:
-            return self.destination_ip_index.get(dst_ip, [])
+            return self._cached_rows(("search_dst", cache.address_key(dst_ip)), lambda: self.destination_postings(dst_ip))
         except Exception as e:
             print(f"An error occurred during search_by_destination_ip: {e}")
-            return []
+            return self._rows()
+
+    def pair_postings(self, src_ip: str, dst_ip: str):
+        if "/" in src_ip or "/" in dst_ip:
+            return intersect(self.source_postings(src_ip), self.destination_postings(dst_ip))
+        src_key, dst_key = pack_ip(src_ip), pack_ip(dst_ip)
+        if src_key is None or dst_key is None:
+            return intersect(self.source_postings(src_ip), self.destination_postings(dst_ip))
+        if self.pair_index:
+            return self.source_and_destination_ip_index.postings(pack_pair(src_key, dst_key))
+        # without a pair index the answer is the intersection of both single-IP postings
+        return intersect(self.source_ip_index.postings(src_key), self.destination_ip_index.postings(dst_key))
 
-    def search_by_source_and_destination_ip(self, src_ip: str, dst_ip: str) -> list[Flowlog]:
+    def search_by_source_and_destination_ip(self, src_ip: str, dst_ip: str) -> RowSet:
         try:
-            return self.source_and_destination_ip_index.get((src_ip, dst_ip), [])
+            key = ("search_src_dst", cache.address_key(src_ip), cache.address_key(dst_ip))
+            return self._cached_rows(key, lambda: self.pair_postings(src_ip, dst_ip))
         except Exception as e:
             print(f"An error occurred during search_by_source_and_destination_ip: {e}")
-            return []
+            return self._rows()
     
     def get_connection_count(self, src_ip: str, src_port: str, dst_ip: str, dst_port: str, transport_protocol: str) -> int:
-        return self.connection_counts.get((src_ip, dst_ip, src_port, dst_port, transport_protocol), 0)
+        try:
+            key = (ip_to_int(src_ip), ip_to_int(dst_ip), int(src_port), int(dst_port), int(transport_protocol))
+        except (OSError, ValueError):
+            return 0
+        return self.connection_counts.get(key, 0)
+
+    def count_distinct_sources(self) -> int:
+        if self.distinct_sources is not None:
+            return self.distinct_sources.count()
+        return len(self.source_ip_index)
+
+    def count_distinct_destination_ports(self, dst_ip: str) -> int:
+        key = pack_ip(dst_ip)
+        if self.distinct_sources is not None:
+            ports = self.destination_port_sketches.get(key)
+            return ports.count() if ports is not None else 0
+        if "dstport" not in self.store.columns:
+            raise ValueError("field 'dstport' is not in the loaded schema")
+        dstport = self.store.columns["dstport"].values
+        return len({dstport[row_idx] for row_idx in self.destination_ip_index.get(key, ())})
     
\ No newline at end of file
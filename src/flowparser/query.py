@@ -0,0 +1,400 @@
+import array
+import bisect
+import collections
+import datetime
+import ipaddress
+import operator
+import re
+import flowparser.constants as constants
+from flowparser.index import intersect, pack_pair, union_all
+from flowparser.store import DictColumn, IPV4_NULL, IPV4_OTHER, ip_to_int
+
+# Query language: predicates joined by AND, alternatives joined by OR (AND binds tighter), e.g.
+#   srcaddr=10.0.1.0/24 AND dstport=443 AND action=REJECT OR dstport<1024
+# Comparisons are =, !=, <, <=, >, >=. IP fields accept CIDR blocks with = and !=, start/end accept
+# ISO-8601 timestamps. Missing ('-') values never match.
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+TERM = re.compile(r"\s*(?P<field>[A-Za-z][\w-]*)\s*(?P<op><=|>=|!=|=|<|>)\s*(?P<value>\S+)\s*")
+CONNECTIVE = re.compile(r"\s+(AND|OR)\s+", re.IGNORECASE)
+# an index is only intersected if it is at most this many times larger than the current candidates,
+# otherwise its predicate is checked on the candidates' column values instead
+INTERSECT_RATIO = 4
+# an equality scan that matches more than one row in this many walks the values in Python, sparser
+# matches are found with bytes.find over the column's raw bytes
+DENSE_MATCHES = 16
+# batches with at least this many equality scans of one column share a single pass over it
+SHARED_SCAN_MIN = 16
+
+class QueryError(ValueError):
+    pass
+
+def equal_rows(values: array.array, target: int) -> array.array:
+    # Row ids whose stored value is target. Only matches cost Python work when they are sparse.
+    try:
+        needle = array.array(values.typecode, [target]).tobytes()
+    except OverflowError:
+        return array.array('I')
+    data = values.tobytes()
+    # counts unaligned matches too, good enough to pick a strategy
+    if data.count(needle) * DENSE_MATCHES > len(values):
+        return array.array('I', [row_idx for row_idx, value in enumerate(values) if value == target])
+    size = values.itemsize
+    rows = array.array('I')
+    position = data.find(needle)
+    while position != -1:
+        if position % size:
+            # straddles two values
+            position = data.find(needle, position + 1)
+        else:
+            rows.append(position // size)
+            position = data.find(needle, position + size)
+    return rows
+
+def equal_rows_many(values: array.array, targets) -> dict[int, array.array]:
+    # Row ids of every target value from one pass over the column. Costs about as much as SHARED_SCAN_MIN
+    # equal_rows calls, whatever the number of targets
+    found = {target: array.array('I') for target in targets}
+    get = found.get
+    for row_idx, value in enumerate(values):
+        rows = get(value)
+        if rows is not None:
+            rows.append(row_idx)
+    return found
+
+def parse_time(value: str) -> int:
+    # Epoch seconds or an ISO-8601 timestamp, naive timestamps are taken as UTC
+    if value.lstrip('-').isdigit():
+        return int(value)
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp())
+
+class Predicate:
+    def __init__(self, field: str, op: str, value: str):
+        if field not in constants.FLOW_LOG_FIELDS:
+            raise QueryError(f"unknown field {field!r}")
+        self.field, self.op, self.text = field, op, value
+        self.network = None
+        try:
+            if field in constants.FLOW_LOG_IPV4_FIELDS and "/" in value:
+                if op not in ("=", "!="):
+                    raise QueryError(f"CIDR blocks only support = and != ({self})")
+                network = ipaddress.IPv4Network(value, strict=False)
+                self.network = (int(network.network_address), int(network.broadcast_address))
+                self.value = None
+            elif field in constants.FLOW_LOG_IPV4_FIELDS and ":" in value:
+                # IPv6 addresses aren't packed or indexed, they are matched as written
+                if op not in ("=", "!="):
+                    raise QueryError(f"IPv6 addresses only support = and != ({self})")
+                ipaddress.IPv6Address(value)
+                self.value = value
+            elif field in constants.FLOW_LOG_IPV4_FIELDS:
+                self.value = ip_to_int(value)
+            elif field in ("start", "end"):
+                self.value = parse_time(value)
+            elif field in constants.FLOW_LOG_INT_FIELDS:
+                self.value = int(value)
+            else:
+                self.value = value
+        except (OSError, ValueError) as e:
+            if isinstance(e, QueryError):
+                raise
+            raise QueryError(f"invalid value in {self}: {e}")
+
+    def __str__(self) -> str:
+        return f"{self.field}{self.op}{self.text}"
+
+    def key(self) -> tuple:
+        # Same for predicates matching the same rows however they were written (10.0.1.7/24, ISO times, ...)
+        return (self.field, self.op, self.network if self.network is not None else self.value)
+
+    def _test(self, store):
+        # A function over the field's stored value (packed IP, int or dictionary code) for this predicate
+        column = store.columns.get(self.field)
+        compare = OPERATORS[self.op]
+        if self.network is not None:
+            low, high = self.network
+            inside = self.op == "="
+            return lambda value: value != IPV4_NULL and (low <= value <= high and value < IPV4_OTHER) == inside
+        if isinstance(self.value, str) and self.field in constants.FLOW_LOG_IPV4_FIELDS:
+            stored = column.stored(self.value)
+            if self.op == "=":
+                return lambda value: value == stored
+            return lambda value: value != stored and value != IPV4_NULL
+        if isinstance(column, DictColumn):
+            if self.op in ("=", "!="):
+                # compare dictionary codes instead of strings
+                code = column.lookup.get(self.value.encode(), -1)
+                if self.op == "=":
+                    return lambda value: value == code
+                return lambda value: value != code and value != 0
+            symbols, literal = column.symbols, self.value
+            return lambda value: value != 0 and compare(symbols[value], literal)
+        null, literal = column.null, self.value
+        if self.field in constants.FLOW_LOG_IPV4_FIELDS and self.op != "!=":
+            # IPv6 addresses are stored from IPV4_OTHER up and don't order against IPv4 ones
+            return lambda value: value < IPV4_OTHER and compare(value, literal)
+        return lambda value: value != null and compare(value, literal)
+
+    def _stored_equal(self, column):
+        # The stored value (dictionary code, packed IP or int) an "=" predicate matches, None when it isn't
+        # an equality or the value is never stored
+        if self.op != "=" or self.network is not None:
+            return None
+        if isinstance(column, DictColumn):
+            return column.lookup.get(self.value.encode())
+        if isinstance(self.value, str):
+            return column.stored(self.value)
+        # the null marker never matches
+        return self.value if self.value != column.null else None
+
+    def filter(self, store, rows=None) -> array.array:
+        # Rows (all rows if None) whose value satisfies the predicate
+        column = store.columns.get(self.field)
+        if column is None:
+            # lazy field, decoded from the source line
+            test = self._decoded_test()
+            rows = range(store.row_count) if rows is None else rows
+            return array.array('I', [row_idx for row_idx in rows if test(store.get(row_idx, self.field))])
+        values = column.codes if isinstance(column, DictColumn) else column.values
+        target = self._stored_equal(column)
+        if target is not None and rows is None:
+            return equal_rows(values, target)
+        test = self._test(store)
+        if rows is None:
+            return array.array('I', [row_idx for row_idx, value in enumerate(values) if test(value)])
+        return array.array('I', [row_idx for row_idx in rows if test(values[row_idx])])
+
+    def _decoded_test(self):
+        compare, literal = OPERATORS[self.op], self.value
+        if self.field in constants.FLOW_LOG_IPV4_FIELDS and isinstance(literal, str):
+            return lambda value: value is not None and compare(value, literal)
+        if self.field in constants.FLOW_LOG_IPV4_FIELDS:
+            test = self._test_packed()
+            # an IPv6 address is only ever unequal to an IPv4 address or block
+            other = self.op == "!="
+            return lambda value: value is not None and (other if ":" in value else test(ip_to_int(value)))
+        if self.field in constants.FLOW_LOG_INT_FIELDS:
+            return lambda value: value is not None and compare(int(value), literal)
+        return lambda value: value is not None and compare(value, literal)
+
+    def _test_packed(self):
+        if self.network is not None:
+            low, high = self.network
+            inside = self.op == "="
+            return lambda value: (low <= value <= high) == inside
+        compare, literal = OPERATORS[self.op], self.value
+        return lambda value: compare(value, literal)
+
+def parse_query(expression: str) -> list[list[Predicate]]:
+    # Disjunction of conjunctions
+    if not expression.strip():
+        raise QueryError("empty query")
+    parts = CONNECTIVE.split(expression.strip())
+    alternatives, conjunction = [], []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            if part.upper() == "OR":
+                alternatives.append(conjunction)
+                conjunction = []
+            continue
+        match = TERM.fullmatch(part)
+        if match is None:
+            raise QueryError(f"cannot parse {part!r}, expected <field><op><value>")
+        conjunction.append(Predicate(match["field"], match["op"], match["value"]))
+    alternatives.append(conjunction)
+    return alternatives
+
+def query_key(expression) -> tuple:
+    # Canonical form of an expression (or parse_query's result) for the result cache: the order of
+    # AND/OR terms, spacing and equivalent values (10.0.1.7/24 and 10.0.1.0/24, epoch and ISO-8601
+    # times) don't change it
+    alternatives = parse_query(expression) if isinstance(expression, str) else expression
+    conjunctions = {
+        tuple(sorted({predicate.key() for predicate in conjunction}, key=repr))
+        for conjunction in alternatives
+    }
+    return tuple(sorted(conjunctions, key=repr))
+
+class _IndexAccess:
+    # One way of getting candidate rows from an index, with its size estimate
+    def __init__(self, label: str, postings: list[array.array], covers: list[Predicate]):
+        self.label = label
+        self.postings = postings
+        self.estimate = sum(len(rows) for rows in postings)
+        # predicates the index answers exactly, they need no further filtering
+        self.covers = covers
+
+    def fetch(self) -> array.array:
+        return union_all(self.postings) if self.postings else array.array('I')
+
+def _index_accesses(parser, conjunction: list[Predicate]) -> list[_IndexAccess]:
+    accesses = []
+    exact = {}
+    for predicate in conjunction:
+        if predicate.op != "=" or predicate.field not in ("srcaddr", "dstaddr") or isinstance(predicate.value, str):
+            continue
+        index = parser.source_ip_index if predicate.field == "srcaddr" else parser.destination_ip_index
+        if predicate.network is not None:
+            postings = index.range_postings(*predicate.network)
+        else:
+            postings = [index[predicate.value]] if predicate.value in index else []
+            exact[predicate.field] = predicate
+        name = "source_ip_index" if predicate.field == "srcaddr" else "destination_ip_index"
+        accesses.append(_IndexAccess(f"{name} {predicate}", postings, [predicate]))
+
+    if parser.pair_index and "srcaddr" in exact and "dstaddr" in exact:
+        src, dst = exact["srcaddr"], exact["dstaddr"]
+        key = pack_pair(src.value, dst.value)
+        postings = [parser.source_and_destination_ip_index[key]] if key in parser.source_and_destination_ip_index else []
+        accesses.append(_IndexAccess(f"source_and_destination_ip_index {src} {dst}", postings, [src, dst]))
+
+    # the time index narrows start to whole buckets, the start predicates still filter the edges
+    bounds = [predicate for predicate in conjunction if predicate.field == "start" and predicate.op in ("=", "<", "<=", ">", ">=")]
+    if bounds and parser.time_index:
+        low, high = min(parser.time_index), max(parser.time_index)
+        for predicate in bounds:
+            bucket = predicate.value // constants.TIME_BUCKET_SECONDS
+            if predicate.op in ("=", ">", ">="):
+                low = max(low, bucket)
+            if predicate.op in ("=", "<", "<="):
+                high = min(high, bucket)
+        if high - low < len(parser.time_index):
+            postings = [parser.time_index[bucket] for bucket in range(low, high + 1) if bucket in parser.time_index]
+        else:
+            postings = [rows for bucket, rows in parser.time_index.items() if low <= bucket <= high]
+        accesses.append(_IndexAccess(f"time_index buckets {low}..{high}", postings, []))
+    return accesses
+
+def plan_conjunction(parser, conjunction: list[Predicate]):
+    # Returns (index accesses to intersect, smallest first; predicates left to filter on the candidates)
+    accesses = sorted(_index_accesses(parser, conjunction), key=lambda access: access.estimate)
+    chosen, covered = [], set()
+    for access in accesses:
+        if chosen and access.estimate > INTERSECT_RATIO * chosen[0].estimate:
+            continue
+        if all(id(predicate) in covered for predicate in access.covers) and access.covers:
+            continue
+        chosen.append(access)
+        covered.update(id(predicate) for predicate in access.covers)
+    residual = [predicate for predicate in conjunction if id(predicate) not in covered]
+    # cheap code/int comparisons first, lazily decoded fields last
+    residual.sort(key=lambda predicate: predicate.field not in parser.store.columns)
+    return chosen, residual
+
+def _check_fields(parser, alternatives: list[list[Predicate]]) -> None:
+    for conjunction in alternatives:
+        for predicate in conjunction:
+            if predicate.field not in parser.store.positions:
+                raise QueryError(f"field {predicate.field!r} is not in the loaded schema")
+
+def prune_files(parser, conjunction: list[Predicate]):
+    # Row ranges of the files whose metadata (time range, interface-ids) allows a match, None to keep all
+    predicates = [
+        (predicate.field, predicate.op, predicate.value) for predicate in conjunction
+        if predicate.field in ("start", "end", "interface-id") and predicate.value is not None
+    ]
+    return parser.file_ranges(predicates) if predicates else None
+
+def _restrict(rows: array.array, ranges: list[tuple[int, int]]) -> array.array:
+    # Sorted rows that fall inside one of the sorted [first, last) ranges
+    kept = array.array('I')
+    for first, last in ranges:
+        kept.extend(rows[bisect.bisect_left(rows, first):bisect.bisect_left(rows, last)])
+    return kept
+
+def full_scans(parser, alternatives: list[list[Predicate]]) -> list[Predicate]:
+    # Predicates execute() filters over every row: the first one of each conjunction that no index or
+    # file metadata narrows. Raises QueryError for fields that aren't in the loaded schema
+    _check_fields(parser, alternatives)
+    scans = []
+    for conjunction in alternatives:
+        chosen, residual = plan_conjunction(parser, conjunction)
+        if not chosen and residual and prune_files(parser, conjunction) is None:
+            scans.append(residual[0])
+    return scans
+
+def shared_scans(store, predicates: list[Predicate]) -> dict[tuple, array.array]:
+    # Rows of each predicate over every row, keyed by Predicate.key(). Equality predicates on a column
+    # with at least SHARED_SCAN_MIN distinct values share one pass over it instead of a scan each
+    scans = {}
+    # field -> stored value -> predicate key
+    equalities = collections.defaultdict(dict)
+    for key, predicate in {predicate.key(): predicate for predicate in predicates}.items():
+        column = store.columns.get(predicate.field)
+        target = predicate._stored_equal(column) if column is not None else None
+        if target is None:
+            scans[key] = predicate.filter(store)
+        else:
+            equalities[predicate.field][target] = key
+    for field, wanted in equalities.items():
+        column = store.columns[field]
+        values = column.codes if isinstance(column, DictColumn) else column.values
+        if len(wanted) >= SHARED_SCAN_MIN:
+            found = equal_rows_many(values, wanted)
+        else:
+            found = {target: equal_rows(values, target) for target in wanted}
+        for target, key in wanted.items():
+            scans[key] = found[target]
+    return scans
+
+def execute(parser, expression, scans: dict = None) -> array.array:
+    # expression is a query string or parse_query's result, scans maps Predicate.key() to the rows of
+    # predicates already filtered over every row by a shared scan
+    alternatives = parse_query(expression) if isinstance(expression, str) else expression
+    _check_fields(parser, alternatives)
+    results = []
+    for conjunction in alternatives:
+        chosen, residual = plan_conjunction(parser, conjunction)
+        rows = None
+        for access in chosen:
+            rows = access.fetch() if rows is None else intersect(rows, access.fetch())
+        ranges = prune_files(parser, conjunction)
+        if ranges is not None:
+            if rows is None:
+                rows = array.array('I')
+                for first, last in ranges:
+                    rows.extend(range(first, last))
+            else:
+                rows = _restrict(rows, ranges)
+        for predicate in residual:
+            if rows is not None and not rows:
+                break
+            if rows is None and scans and predicate.key() in scans:
+                rows = scans[predicate.key()]
+            else:
+                rows = predicate.filter(parser.store, rows)
+        if rows is None:
+            rows = array.array('I', range(parser.store.row_count))
+        results.append(rows)
+    return union_all(results)
+
+def explain(parser, expression: str) -> list[str]:
+    lines = []
+    alternatives = parse_query(expression)
+    _check_fields(parser, alternatives)
+    for number, conjunction in enumerate(alternatives, start=1):
+        if len(alternatives) > 1:
+            lines.append(f"alternative {number}:")
+        chosen, residual = plan_conjunction(parser, conjunction)
+        for i, access in enumerate(chosen):
+            lines.append(f"  {'index' if i == 0 else 'intersect'} {access.label} (~{access.estimate} rows)")
+        ranges = prune_files(parser, conjunction)
+        if ranges is not None:
+            lines.append(f"  {'restrict to' if chosen else 'scan'} {len(ranges)} of {len(parser.files)} files ({sum(last - first for first, last in ranges)} rows)")
+        elif not chosen:
+            lines.append(f"  scan all {parser.store.row_count} rows")
+        for predicate in residual:
+            source = "column" if predicate.field in parser.store.columns else "source line"
+            lines.append(f"  filter {predicate} ({source})")
+    if len(alternatives) > 1:
+        lines.append("union alternatives")
+    return lines
@@ -0,0 +1,259 @@
+import array
+import collections
+import datetime
+import heapq
+import itertools
+import sys
+import flowparser.constants as constants
+from flowparser.store import DictColumn, IPv4Column, IPV4_OTHER, int_to_ip, ip_to_int
+
+# Rollups are small time-bucketed summaries kept up to date while rows are ingested, like the connection
+# counts: for every bucket of a flow's start time and every value of the rollup's fields, the number of
+# flows and their packets and bytes. "Traffic per dstport over the last hour" then reads 60 buckets of a
+# per-minute rollup instead of the rows. Rollups of files and shards merge by adding their sums.
+#
+# A rollup is named by its fields and bucket width, e.g. "srcaddr" (per minute), "dstport@300" or
+# "srcaddr,dstport@3600"; "total" has no fields and sums all flows per bucket.
+DEFAULT_SECONDS = 60
+DEFAULT_ROLLUPS = ["srcaddr", "dstport", "action"]
+METRICS = ("flows", "packets", "bytes")
+
+def parse_spec(spec: str) -> tuple[tuple[str, ...], int]:
+    # "srcaddr,dstport@300" -> (("srcaddr", "dstport"), 300), raises ValueError
+    names, _, seconds = spec.partition("@")
+    fields = () if names == "total" else tuple(names.split(","))
+    for field in fields:
+        if field not in constants.FLOW_LOG_FIELDS:
+            raise ValueError(f"unknown field {field!r} in rollup {spec!r}")
+        if field in METRICS or field in ("start", "end"):
+            raise ValueError(f"{field} is summed or bucketed by rollups, not grouped on")
+    if len(set(fields)) != len(fields):
+        raise ValueError(f"repeated field in rollup {spec!r}")
+    seconds = int(seconds) if seconds else DEFAULT_SECONDS
+    if seconds <= 0:
+        raise ValueError(f"bucket width of rollup {spec!r} must be positive")
+    return fields, seconds
+
+def format_key(fields: tuple[str, ...], key: tuple) -> list:
+    # Stored key values as printed: packed IPs as dotted quads (IPv6 addresses are kept as strings), missing
+    # values as None
+    return [int_to_ip(value) if field in constants.FLOW_LOG_IPV4_FIELDS and isinstance(value, int) else value for field, value in zip(fields, key)]
+
+def parse_key(fields: tuple[str, ...], text: str) -> tuple:
+    # "10.0.1.5,443" -> the stored key of a rollup grouped on srcaddr,dstport, raises ValueError
+    values = text.split(",")
+    if len(values) != len(fields):
+        raise ValueError(f"expected {len(fields)} comma-separated values for {','.join(fields)}")
+    key = []
+    for field, value in zip(fields, values):
+        if value == "-":
+            key.append(None)
+        elif field in constants.FLOW_LOG_IPV4_FIELDS and ":" in value:
+            key.append(value)
+        elif field in constants.FLOW_LOG_IPV4_FIELDS:
+            try:
+                key.append(ip_to_int(value))
+            except OSError:
+                raise ValueError(f"invalid IP address {value!r}")
+        elif field in constants.FLOW_LOG_INT_FIELDS:
+            key.append(int(value))
+        else:
+            key.append(value)
+    return tuple(key)
+
+def answer(summary: "Rollup", start: int = None, end: int = None, last: int = None, by: str = "key", key: str = None, top: int = None, order_by: str = "bytes") -> list[dict]:
+    # ROLLUP and /rollup: totals per key, or with by="time" the series of one key ("10.0.1.5,443") or of
+    # all of them, over [start, end] or the last seconds of the data. Raises ValueError
+    if by not in ("key", "time"):
+        raise ValueError("by must be key or time")
+    if last is not None:
+        if start is not None or end is not None:
+            raise ValueError("last cannot be combined with from and to")
+        start, end = summary.last_window(last)
+    if by == "time":
+        return summary.series(start, end, parse_key(summary.fields, key) if key is not None else None)
+    return summary.totals(start, end, top, order_by)
+
+class Rollup:
+    def __init__(self, fields: tuple[str, ...], seconds: int = DEFAULT_SECONDS):
+        self.fields = tuple(fields)
+        self.seconds = seconds
+        # bucket -> key -> slot of the key's sums in flows/packets/bytes. Keys hold packed IPs, ints and
+        # strings rather than dictionary codes, so rollups of different stores merge
+        self.buckets: dict[int, dict[tuple, int]] = {}
+        self.flows = array.array('Q')
+        self.packets = array.array('Q')
+        self.bytes = array.array('Q')
+        # first and last bucket holding flows
+        self.first = self.last = None
+
+    @property
+    def name(self) -> str:
+        fields = ",".join(self.fields) or "total"
+        return fields if self.seconds == DEFAULT_SECONDS else f"{fields}@{self.seconds}"
+
+    def _add(self, bucket: int, key: tuple, flows: int, packets: int, nbytes: int) -> None:
+        keys = self.buckets.get(bucket)
+        if keys is None:
+            keys = self.buckets[bucket] = {}
+            if self.first is None or bucket < self.first:
+                self.first = bucket
+            if self.last is None or bucket > self.last:
+                self.last = bucket
+        slot = keys.get(key)
+        if slot is None:
+            keys[key] = len(self.flows)
+            self.flows.append(flows)
+            self.packets.append(packets)
+            self.bytes.append(nbytes)
+        else:
+            self.flows[slot] += flows
+            self.packets[slot] += packets
+            self.bytes[slot] += nbytes
+
+    def update(self, store, first: int, last: int) -> None:
+        # Add rows [first, last) of store. Rows are grouped on (bucket, stored values) and counted by map,
+        # zip and Counter without a Python loop; packets and bytes take one short loop each. Only the
+        # distinct groups are decoded and added
+        if first >= last or "start" not in store.columns:
+            return
+        columns = [store.columns[field] for field in self.fields]
+        stored = [(column.codes if isinstance(column, DictColumn) else column.values)[first:last] for column in columns]
+        if not stored:
+            keys = itertools.repeat(())
+        elif len(stored) == 1:
+            keys = stored[0]
+        else:
+            keys = zip(*stored)
+        # a missing start (-1) lands in bucket -1 and is dropped below
+        groups = list(zip(map(self.seconds.__rfloordiv__, store.columns["start"].values[first:last]), keys))
+        flows = collections.Counter(groups)
+        slot_of = {group: slot for slot, group in enumerate(flows)}
+        slots = list(map(slot_of.__getitem__, groups))
+        sums = []
+        for field in ("packets", "bytes"):
+            totals = [0] * len(flows)
+            column = store.columns.get(field)
+            if column is not None:
+                values = column.values[first:last]
+                for slot, value in zip(slots, values):
+                    totals[slot] += value
+                if values.count(column.null):
+                    # take the missing values ('-', stored as the null) back out
+                    for slot, value in zip(slots, values):
+                        if value == column.null:
+                            totals[slot] -= value
+            sums.append(totals)
+
+        packets, sizes = sums
+        decode = self._key_decoder(columns)
+        buckets, flow_sums, packet_sums, byte_sums = self.buckets, self.flows, self.packets, self.bytes
+        for slot, ((bucket, key), count) in enumerate(flows.items()):
+            if bucket < 0:
+                continue
+            keys = buckets.get(bucket)
+            if keys is None:
+                keys = buckets[bucket] = {}
+                self.first = bucket if self.first is None else min(self.first, bucket)
+                self.last = bucket if self.last is None else max(self.last, bucket)
+            key = decode(key)
+            target = keys.get(key)
+            if target is None:
+                keys[key] = len(flow_sums)
+                flow_sums.append(count)
+                packet_sums.append(packets[slot])
+                byte_sums.append(sizes[slot])
+            else:
+                flow_sums[target] += count
+                packet_sums[target] += packets[slot]
+                byte_sums[target] += sizes[slot]
+
+    @staticmethod
+    def _key_decoder(columns):
+        # Stored values of a group -> its key tuple: dictionary codes and IPv6 addresses become their
+        # strings, the null of packed IP and int columns becomes None
+        def decoder(column):
+            if isinstance(column, DictColumn):
+                return column.symbols.__getitem__
+            if isinstance(column, IPv4Column):
+                return lambda value: value if value < IPV4_OTHER else column.decode(value)
+            null = column.null
+            return lambda value: None if value == null else value
+        decoders = [decoder(column) for column in columns]
+        if not decoders:
+            return lambda key: ()
+        if len(decoders) == 1:
+            decode = decoders[0]
+            return lambda value: (decode(value),)
+        return lambda key: tuple(map(lambda decode, value: decode(value), decoders, key))
+
+    def merge(self, other: "Rollup") -> None:
+        for bucket, keys in other.buckets.items():
+            for key, slot in keys.items():
+                self._add(bucket, key, other.flows[slot], other.packets[slot], other.bytes[slot])
+
+    def last_window(self, seconds: int) -> tuple[int, int]:
+        # [start, end] of the last seconds up to the end of the latest bucket, flow logs are read after the
+        # fact so "the last hour" is the data's, not the clock's
+        if self.last is None:
+            return 0, -1
+        end = (self.last + 1) * self.seconds - 1
+        return end - seconds + 1, end
+
+    def _window(self, start: int = None, end: int = None):
+        # (bucket, keys) of the buckets overlapping [start, end] in order, widened to whole buckets
+        if self.first is None:
+            return []
+        low = self.first if start is None else max(self.first, start // self.seconds)
+        high = self.last if end is None else min(self.last, end // self.seconds)
+        if high - low < len(self.buckets):
+            return [(bucket, self.buckets[bucket]) for bucket in range(low, high + 1) if bucket in self.buckets]
+        return sorted((bucket, keys) for bucket, keys in self.buckets.items() if low <= bucket <= high)
+
+    def totals(self, start: int = None, end: int = None, top: int = None, order_by: str = "bytes") -> list[dict]:
+        # Sums per key over the window, largest order_by first
+        if order_by not in METRICS:
+            raise ValueError(f"order must be one of {', '.join(METRICS)}")
+        sums = {}
+        for _, keys in self._window(start, end):
+            for key, slot in keys.items():
+                entry = sums.get(key)
+                if entry is None:
+                    sums[key] = [self.flows[slot], self.packets[slot], self.bytes[slot]]
+                else:
+                    entry[0] += self.flows[slot]
+                    entry[1] += self.packets[slot]
+                    entry[2] += self.bytes[slot]
+        position = METRICS.index(order_by)
+        items = sums.items()
+        if top is not None:
+            items = heapq.nlargest(top, items, key=lambda item: item[1][position])
+        else:
+            items = sorted(items, key=lambda item: item[1][position], reverse=True)
+        return [
+            dict(zip(self.fields, format_key(self.fields, key)), **dict(zip(METRICS, entry)))
+            for key, entry in items
+        ]
+
+    def series(self, start: int = None, end: int = None, key: tuple = None) -> list[dict]:
+        # Sums per bucket over the window, of one key or of all of them
+        rows = []
+        for bucket, keys in self._window(start, end):
+            slots = [keys[key]] if key is not None and key in keys else [] if key is not None else keys.values()
+            if not slots:
+                continue
+            rows.append({
+                "start": bucket * self.seconds,
+                "time": datetime.datetime.fromtimestamp(bucket * self.seconds, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "flows": sum(self.flows[slot] for slot in slots),
+                "packets": sum(self.packets[slot] for slot in slots),
+                "bytes": sum(self.bytes[slot] for slot in slots),
+            })
+        return rows
+
+    def nbytes(self) -> int:
+        keys = sum(sys.getsizeof(keys) + sum(sys.getsizeof(key) for key in keys) for keys in self.buckets.values())
+        return sys.getsizeof(self.buckets) + keys + sum(sums.itemsize * len(sums) for sums in (self.flows, self.packets, self.bytes))
+
+    def __len__(self) -> int:
+        return len(self.flows)
@@ -0,0 +1,312 @@
+import asyncio
+import concurrent.futures
+import ipaddress
+import itertools
+import json
+import urllib.parse
+import flowparser.constants as constants
+import flowparser.export as export
+import flowparser.rollup as rollup
+from flowparser.parser import Parser
+from flowparser.query import QueryError, parse_time
+from flowparser.stats import memory_report
+
+# Query server: a flow log is loaded and indexed once, then served over HTTP/1.1 on a local socket to
+# any number of clients. Requests are GETs named after the CLI commands, e.g.
+#   /search_src?ip=10.0.1.0/24&limit=100
+#   /query?q=dstport=443 AND action=REJECT&format=csv
+#   /aggregate?by=dstport&metrics=count,sum(bytes)&top=10&where=action=REJECT
+#   /get_connection_count?src_ip=..&src_port=..&dst_ip=..&dst_port=..&protocol=6
+#   /rollup?name=dstport&last=3600&top=10
+# Searches and queries run on a thread pool so the event loop keeps accepting and answering other
+# requests, and their rows are encoded in batches and streamed back with chunked transfer encoding.
+# /load parses a new file in the pool while the current one keeps answering, then swaps it in.
+DEFAULT_PORT = 8765
+BATCH_ROWS = 1000
+MAX_HEADER_LINES = 100
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+CONTENT_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def _address(value: str) -> str:
+    # A single IP address or a CIDR block, as the search commands take them
+    try:
+        if "/" in value:
+            ipaddress.ip_network(value, strict=False)
+        else:
+            ipaddress.ip_address(value)
+    except ValueError:
+        raise RequestError(400, f"invalid IP address {value!r}")
+    return value
+
+def _int(params: dict, name: str, default=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise RequestError(400, f"{name} must be an integer")
+
+def _required(params: dict, *names: str) -> list[str]:
+    missing = [name for name in names if not params.get(name)]
+    if missing:
+        raise RequestError(400, f"missing parameter {', '.join(missing)}")
+    return [params[name] for name in names]
+
+class QueryServer:
+    def __init__(self, parser: Parser = None, threads: int = 4):
+        self.parser = parser
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # path being loaded by /load, None when idle
+        self.loading = None
+        self.requests = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _loaded(self) -> Parser:
+        if self.parser is None:
+            raise RequestError(503, "no flow logs loaded, use /load?path=...")
+        return self.parser
+
+    async def load(self, path: str, schema=constants.FLOW_LOG_SCHEMA_DEFAULT, workers: int = 1, lazy: bool = False, skip_malformed: bool = False, rollups: list[str] = None) -> Parser:
+        # Parse off the event loop, queries keep going to the previous parser until this one is ready
+        if self.loading is not None:
+            raise RequestError(503, f"already loading {self.loading}")
+        self.loading = path
+        try:
+            parser = Parser(path=path, schema=schema, lazy=lazy, skip_malformed=skip_malformed, rollups=rollups)
+
+            def ingest():
+                # snapshots hold no rejected lines, a skip_malformed load reparses to report them
+                if skip_malformed or not parser.load_index():
+                    parser.deserialize(workers=workers)
+            await self._run(ingest)
+        finally:
+            self.loading = None
+        if parser.stats.errors and not parser.store.row_count:
+            raise RequestError(400, f"could not load {path}: {parser.stats.errors[0]}")
+        self.parser = parser
+        return parser
+
+    # Handlers take the query parameters and return either a JSON-able object or a RowSet to stream
+
+    async def _search_src(self, params):
+        (ip,) = _required(params, "ip")
+        return await self._run(self._loaded().search_by_source_ip, _address(ip))
+
+    async def _search_dst(self, params):
+        (ip,) = _required(params, "ip")
+        return await self._run(self._loaded().search_by_destination_ip, _address(ip))
+
+    async def _search_src_dst(self, params):
+        src, dst = _required(params, "src", "dst")
+        return await self._run(self._loaded().search_by_source_and_destination_ip, _address(src), _address(dst))
+
+    async def _search_time(self, params):
+        start, end = _required(params, "from", "to")
+        try:
+            start, end = parse_time(start), parse_time(end)
+        except ValueError:
+            raise RequestError(400, "from and to must be epoch seconds or ISO-8601 times")
+        src = _address(params["src"]) if params.get("src") else None
+        dst = _address(params["dst"]) if params.get("dst") else None
+        return await self._run(self._loaded().search_by_time, start, end, src, dst)
+
+    async def _query(self, params):
+        (expression,) = _required(params, "q")
+        return await self._run(self._loaded().query, expression)
+
+    async def _explain(self, params):
+        (expression,) = _required(params, "q")
+        return {"plan": await self._run(self._loaded().explain, expression)}
+
+    async def _aggregate(self, params):
+        (by,) = _required(params, "by")
+        metrics = [metric for metric in params.get("metrics", "count").split(",") if metric]
+        return await self._run(
+            self._loaded().aggregate, by.split(","), metrics, params.get("where"), _int(params, "top"), params.get("order")
+        )
+
+    async def _get_connection_count(self, params):
+        values = _required(params, "src_ip", "src_port", "dst_ip", "dst_port", "protocol")
+        return {"count": self._loaded().get_connection_count(*values)}
+
+    async def _rollup(self, params):
+        (name,) = _required(params, "name")
+        parser = self._loaded()
+        try:
+            start = parse_time(params["from"]) if params.get("from") else None
+            end = parse_time(params["to"]) if params.get("to") else None
+        except ValueError:
+            raise RequestError(400, "from and to must be epoch seconds or ISO-8601 times")
+
+        def answer():
+            try:
+                with parser.lock:
+                    return rollup.answer(
+                        parser.get_rollup(name), start, end, _int(params, "last"), params.get("by", "key"),
+                        params.get("key"), _int(params, "top"), params.get("order", "bytes"),
+                    )
+            except ValueError as e:
+                raise RequestError(400, str(e))
+        return await self._run(answer)
+
+    async def _stats(self, params):
+        parser = self._loaded()
+        report = parser.stats.to_dict()
+        report["memory_bytes"] = memory_report(parser)
+        report["rows"] = parser.store.row_count
+        report["cache"] = parser.cache.to_dict()
+        report["requests"] = self.requests
+        report["loading"] = self.loading
+        return report
+
+    async def _load(self, params):
+        (path,) = _required(params, "path")
+        schema = params["schema"].split(",") if params.get("schema") else constants.FLOW_LOG_SCHEMA_DEFAULT
+        # space-separated rollup names, the current file's rollups by default
+        if "rollups" in params:
+            rollups = params["rollups"].split()
+        else:
+            rollups = [summary.name for summary in self.parser.rollups] if self.parser is not None else None
+        try:
+            for spec in rollups or ():
+                rollup.parse_spec(spec)
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        parser = await self.load(
+            path, schema=schema, workers=_int(params, "workers", 1),
+            lazy=params.get("lazy") in ("1", "true"), skip_malformed=params.get("skip_malformed") in ("1", "true"),
+            rollups=rollups,
+        )
+        return {
+            "path": path, "rows": parser.store.row_count, "rejected": len(parser.rejects),
+            "skipped_rollups": [{"rollup": spec, "reason": reason} for spec, reason in parser.skipped_rollups],
+        }
+
+    ROUTES = {
+        "/search_src": _search_src,
+        "/search_dst": _search_dst,
+        "/search_src_dst": _search_src_dst,
+        "/search_time": _search_time,
+        "/query": _query,
+        "/explain": _explain,
+        "/aggregate": _aggregate,
+        "/get_connection_count": _get_connection_count,
+        "/rollup": _rollup,
+        "/stats": _stats,
+        "/load": _load,
+    }
+
+    async def _respond(self, writer, status: int, body: bytes, content_type: str = "application/json", keep_alive: bool = True) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _stream(self, writer, rows, format: str, keep_alive: bool) -> None:
+        # Rows are encoded BATCH_ROWS at a time on the pool and sent as they are ready
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: {CONTENT_TYPES[format]}\r\nTransfer-Encoding: chunked\r\n"
+            f"X-Total-Results: {len(rows)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+        )
+        pieces = export.encode_rows(rows, format)
+        while True:
+            batch = await self._run(lambda: "".join(itertools.islice(pieces, BATCH_ROWS)).encode())
+            if not batch:
+                break
+            writer.write(b"%x\r\n%s\r\n" % (len(batch), batch))
+            # waits while the client is slower than the encoding
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _read_request(self, reader):
+        # (method, target, keep_alive) of the next request on the connection, None once it's closed
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise RequestError(400, "malformed request line")
+        keep_alive = version == "HTTP/1.1"
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "connection":
+                keep_alive = value.strip().lower() != "close" if keep_alive else value.strip().lower() == "keep-alive"
+            elif name.strip().lower() == "content-length" and value.strip() != "0":
+                raise RequestError(400, "request bodies are not supported, pass parameters in the query string")
+        return method, target, keep_alive
+
+    async def handle(self, reader, writer) -> None:
+        # One connection, requests are answered in order until the client closes it
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, target, keep_alive = request
+                    self.requests += 1
+                    url = urllib.parse.urlsplit(target)
+                    handler = self.ROUTES.get(url.path)
+                    if handler is None:
+                        raise RequestError(404, f"unknown endpoint {url.path}, expected one of {', '.join(self.ROUTES)}")
+                    if method not in ("GET", "POST"):
+                        raise RequestError(405, "use GET")
+                    params = dict(urllib.parse.parse_qsl(url.query))
+                    format = params.get("format", "ndjson")
+                    if format not in export.FORMATS:
+                        raise RequestError(400, f"unknown format {format!r}, expected one of {', '.join(export.FORMATS)}")
+                    offset, limit = _int(params, "offset", 0), _int(params, "limit")
+                    result = await handler(self, params)
+                except RequestError as e:
+                    await self._respond(writer, e.status, json.dumps({"error": str(e)}).encode(), keep_alive=keep_alive)
+                    continue
+                except QueryError as e:
+                    await self._respond(writer, 400, json.dumps({"error": str(e)}).encode(), keep_alive=keep_alive)
+                    continue
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    # a bug in a handler answers this request with its error instead of dropping the connection
+                    await self._respond(writer, 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode(), keep_alive=keep_alive)
+                    continue
+                if isinstance(result, (dict, list)):
+                    await self._respond(writer, 200, json.dumps(result).encode(), keep_alive=keep_alive)
+                    continue
+                if offset or limit is not None:
+                    result = result[offset:offset + limit if limit is not None else None]
+                await self._stream(writer, result, format, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        return await asyncio.start_server(self.handle, host, port)
+
+    def run(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT, ready=None) -> None:
+        # Serves until interrupted, ready(host, port) is called once the socket is listening
+        async def main():
+            server = await self.start(host, port)
+            if ready is not None:
+                ready(*server.sockets[0].getsockname()[:2])
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(main())
+        finally:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,111 @@
+import array
+import math
+
+M64 = (1 << 64) - 1
+# precision of the per-destination-IP port sketches: 256 bytes each, ~6.5% standard error
+DESTINATION_PORT_PRECISION = 8
+
+def mix64(value: int) -> int:
+    # splitmix64 finalizer, spreads small ints (packed IPs, ports, tuple hashes) over 64 bits
+    value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9 & M64
+    value = (value ^ (value >> 27)) * 0x94d049bb133111eb & M64
+    return value ^ (value >> 31)
+
+class CountMinSketch:
+    # Estimates never undercount and overcount by at most epsilon * total with probability 1 - delta.
+    # Keys are ints or tuples of ints, whose hash() is stable across processes.
+    def __init__(self, epsilon: float = 0.0001, delta: float = 0.01):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.table = array.array('Q', bytes(8 * self.width * self.depth))
+        self.total = 0
+        self._rows = [(row, row * self.width) for row in range(self.depth)]
+
+    def _cells(self, key) -> list[int]:
+        # double hashing: row i uses h1 + i * h2
+        h1 = mix64(hash(key) & M64)
+        h2 = (h1 >> 32) | 1
+        width = self.width
+        return [start + (h1 + row * h2) % width for row, start in self._rows]
+
+    def add(self, key, count: int = 1) -> None:
+        table = self.table
+        for cell in self._cells(key):
+            table[cell] += count
+        self.total += count
+
+    def increment(self, key) -> None:
+        # conservative update: only the cells holding the current minimum grow
+        cells = self._cells(key)
+        table = self.table
+        estimate = min([table[cell] for cell in cells])
+        for cell in cells:
+            if table[cell] == estimate:
+                table[cell] = estimate + 1
+        self.total += 1
+
+    def get(self, key, default: int = 0) -> int:
+        table = self.table
+        return min(table[cell] for cell in self._cells(key)) or default
+
+    def __getitem__(self, key) -> int:
+        return self.get(key)
+
+    def __setitem__(self, key, value: int) -> None:
+        # `sketch[key] += n` lands here as a conservative update, cells only grow up to the new estimate
+        cells = self._cells(key)
+        table = self.table
+        estimate = min(table[cell] for cell in cells)
+        for cell in cells:
+            if table[cell] < value:
+                table[cell] = value
+        self.total += max(value - estimate, 0)
+
+    def merge(self, other: "CountMinSketch") -> None:
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("can only merge sketches with the same dimensions")
+        table = self.table
+        for cell, count in enumerate(other.table):
+            if count:
+                table[cell] += count
+        self.total += other.total
+
+    def error_bound(self) -> float:
+        return self.epsilon * self.total
+
+    def nbytes(self) -> int:
+        return self.table.itemsize * len(self.table)
+
+class HyperLogLog:
+    # Cardinality estimate with a standard error of about 1.04 / sqrt(2 ** precision)
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value) -> None:
+        hashed = mix64(hash(value) & M64)
+        register = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if self.precision != other.precision:
+            raise ValueError("can only merge HyperLogLogs with the same precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def nbytes(self) -> int:
+        return len(self.registers)
@@ -0,0 +1,198 @@
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from flowparser.index import PostingIndex
+from flowparser.sketch import HyperLogLog, DESTINATION_PORT_PRECISION
+from flowparser.store import DictColumn, IPv4Column, IPV4_OTHER
+
+# Snapshot layout:
+#   MAGIC | version (uint32) | header length (uint32) | JSON header | 8-byte aligned array sections
+# The header describes the source file, the schema and where each section lives. VERSION is bumped
+# whenever header keys or sections are added, removed or change meaning.
+MAGIC = b"FLOWIDX\0"
+VERSION = 5
+PREAMBLE = struct.Struct("<8sII")
+SAMPLE_BYTES = 1 << 20
+COUNT_KEY_FIELDS = ["srcaddr", "dstaddr", "srcport", "dstport", "protocol"]
+
+class SnapshotError(Exception):
+    pass
+
+def default_snapshot_path(path: str) -> str:
+    return path + ".idx"
+
+def source_fingerprint(path: str) -> dict:
+    # Hashing a multi-GB file would cost as much as parsing it, so only the head and tail are hashed
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        digest.update(file.read(SAMPLE_BYTES))
+        if stat.st_size > SAMPLE_BYTES:
+            file.seek(max(SAMPLE_BYTES, stat.st_size - SAMPLE_BYTES))
+            digest.update(file.read(SAMPLE_BYTES))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+class _SectionWriter:
+    def __init__(self):
+        self.sections = []
+        self.chunks = []
+        self.size = 0
+
+    def add(self, name: str, values: array.array) -> None:
+        data = values.tobytes()
+        self.sections.append({"name": name, "typecode": values.typecode, "offset": self.size, "length": len(data)})
+        padding = -len(data) % 8
+        self.chunks.append(data + b"\0" * padding)
+        self.size += len(data) + padding
+
+def _add_index(writer: _SectionWriter, name: str, index: PostingIndex) -> None:
+    keys = sorted(index)
+    bounds = array.array('Q', [0])
+    postings = array.array('I')
+    for key in keys:
+        postings.extend(index[key])
+        bounds.append(len(postings))
+    writer.add(f"{name}.keys", array.array('Q', keys))
+    writer.add(f"{name}.bounds", bounds)
+    writer.add(f"{name}.postings", postings)
+
+def _read_index(sections: dict, name: str) -> PostingIndex:
+    index = PostingIndex()
+    keys, bounds, postings = sections[f"{name}.keys"], sections[f"{name}.bounds"], sections[f"{name}.postings"]
+    for i, key in enumerate(keys):
+        index[key] = postings[bounds[i]:bounds[i + 1]]
+    return index
+
+def write_snapshot(parser, path: str) -> None:
+    store = parser.store
+    writer = _SectionWriter()
+    # the strings behind stored codes: dictionary symbols and the IPv6 addresses of IP columns
+    symbols = {}
+    for field, column in store.columns.items():
+        if isinstance(column, DictColumn):
+            writer.add(f"column.{field}", column.codes)
+            symbols[field] = column.symbols[1:]
+        else:
+            writer.add(f"column.{field}", column.values)
+            if isinstance(column, IPv4Column):
+                symbols[field] = column.others
+    writer.add("offsets", store.offsets)
+    _add_index(writer, "source_ip_index", parser.source_ip_index)
+    _add_index(writer, "destination_ip_index", parser.destination_ip_index)
+    _add_index(writer, "source_and_destination_ip_index", parser.source_and_destination_ip_index)
+    _add_index(writer, "time_index", parser.time_index)
+
+    counts = parser.connection_counts
+    if parser.epsilon:
+        writer.add("connection_counts.sketch", counts.table)
+        writer.add("distinct_sources", array.array('B', parser.distinct_sources.registers))
+        port_sketches = parser.destination_port_sketches
+        keys = sorted(port_sketches)
+        writer.add("destination_port_sketches.keys", array.array('Q', keys))
+        writer.add("destination_port_sketches.registers", array.array('B', b"".join(port_sketches[key].registers for key in keys)))
+    else:
+        for position, name in enumerate(COUNT_KEY_FIELDS):
+            writer.add(f"connection_counts.{name}", array.array('q', [key[position] for key in counts]))
+        writer.add("connection_counts.count", array.array('q', counts.values()))
+
+    header = json.dumps({
+        "source": source_fingerprint(parser.path),
+        "schema": store.schema,
+        "eager_fields": store.eager_fields,
+        "pair_index": parser.pair_index,
+        "epsilon": parser.epsilon,
+        "max_flow_duration": parser.max_flow_duration,
+        "connection_total": counts.total if parser.epsilon else None,
+        "row_count": store.row_count,
+        "lines": parser.lines,
+        "offset": parser.offset,
+        "byteorder": sys.byteorder,
+        "symbols": symbols,
+        "sections": writer.sections,
+    }).encode()
+    header += b" " * (-(PREAMBLE.size + len(header)) % 8)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        for chunk in writer.chunks:
+            file.write(chunk)
+    os.replace(tmp_path, path)
+
+def read_header(mapping) -> dict:
+    magic, version, header_size = PREAMBLE.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise SnapshotError("not a flow log index snapshot")
+    if version != VERSION:
+        raise SnapshotError(f"unsupported snapshot version {version} (expected {VERSION})")
+    header = json.loads(bytes(mapping[PREAMBLE.size:PREAMBLE.size + header_size]))
+    header["data_offset"] = PREAMBLE.size + header_size
+    return header
+
+def read_snapshot(parser, path: str) -> None:
+    # Loads columns, indexes and counts into parser, raising SnapshotError if the snapshot is stale
+    with open(path, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapping:
+        header = read_header(mapping)
+        if header["source"] != source_fingerprint(parser.path):
+            raise SnapshotError("source file changed since the snapshot was written")
+        if header["schema"] != list(parser.schema) or header["eager_fields"] != parser.store.eager_fields:
+            raise SnapshotError("snapshot was written for a different schema")
+        if header["epsilon"] != parser.epsilon:
+            raise SnapshotError("snapshot was written with different connection count settings")
+        if header["byteorder"] != sys.byteorder:
+            raise SnapshotError("snapshot was written on a machine with a different byte order")
+
+        data = memoryview(mapping)[header["data_offset"]:]
+        sections = {}
+        for section in header["sections"]:
+            values = array.array(section["typecode"])
+            values.frombytes(data[section["offset"]:section["offset"] + section["length"]])
+            sections[section["name"]] = values
+        del data
+
+    store = parser.store
+    for field, column in store.columns.items():
+        values = sections[f"column.{field}"]
+        if isinstance(column, DictColumn):
+            column.codes = values
+            column.symbols = [None] + [sys.intern(symbol) for symbol in header["symbols"][field]]
+            column.lookup = {b'-': 0}
+            column.lookup.update((symbol.encode(), code) for code, symbol in enumerate(column.symbols[1:], start=1))
+        else:
+            column.values = values
+            if isinstance(column, IPv4Column):
+                column.others = [sys.intern(address) for address in header["symbols"][field]]
+                column.cache.update((address.encode(), IPV4_OTHER + code) for code, address in enumerate(column.others))
+    store.offsets = sections["offsets"]
+    store.row_count = header["row_count"]
+    # short of the file's size when its last line was still being written
+    parser.offset = header["offset"]
+    parser.lines = header["lines"]
+
+    parser.pair_index = header["pair_index"]
+    parser.source_ip_index = _read_index(sections, "source_ip_index")
+    parser.destination_ip_index = _read_index(sections, "destination_ip_index")
+    parser.source_and_destination_ip_index = _read_index(sections, "source_and_destination_ip_index")
+    parser.time_index = _read_index(sections, "time_index")
+    parser.max_flow_duration = header["max_flow_duration"]
+    if parser.epsilon:
+        parser.connection_counts.table = sections["connection_counts.sketch"]
+        parser.connection_counts.total = header["connection_total"]
+        parser.distinct_sources.registers = bytearray(sections["distinct_sources"])
+        registers = sections["destination_port_sketches.registers"]
+        size = 1 << DESTINATION_PORT_PRECISION
+        parser.destination_port_sketches = {}
+        for i, key in enumerate(sections["destination_port_sketches.keys"]):
+            ports = parser.destination_port_sketches[key] = HyperLogLog(DESTINATION_PORT_PRECISION)
+            ports.registers = bytearray(registers[i * size:(i + 1) * size])
+    else:
+        keys = zip(*(sections[f"connection_counts.{name}"] for name in COUNT_KEY_FIELDS))
+        parser.connection_counts.clear()
+        parser.connection_counts.update(zip(keys, sections["connection_counts.count"]))
@@ -0,0 +1,91 @@
+import collections
+import contextlib
+import sys
+import time
+
+# Timing every row would cost more than some of the phases being timed, so the per-row phases
+# (tokenize, build, index) are only timed on one row in SAMPLE_EVERY and scaled up to all rows.
+SAMPLE_EVERY = 64
+SAMPLE_MASK = SAMPLE_EVERY - 1
+ROW_PHASES = ("tokenize", "build", "index")
+
+class Stats:
+    def __init__(self):
+        # rows, bytes, rows_without_addresses, malformed, files, ...
+        self.counters = collections.Counter()
+        # wall-clock seconds of timed sections (read, load, ...)
+        self.phases = collections.defaultdict(float)
+        # seconds spent per row phase in the sampled rows
+        self.sampled = collections.defaultdict(float)
+        self.samples = 0
+        self.errors: list[str] = []
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.perf_counter() - started
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] += amount
+
+    def sample(self, tokenize: float, build: float, index: float) -> None:
+        self.sampled["tokenize"] += tokenize
+        self.sampled["build"] += build
+        self.sampled["index"] += index
+        self.samples += 1
+
+    def estimated_phases(self) -> dict[str, float]:
+        # Row phases extrapolated from the samples to every row parsed
+        if not self.samples:
+            return {phase: 0.0 for phase in ROW_PHASES}
+        scale = self.counters["rows"] / self.samples
+        return {phase: self.sampled[phase] * scale for phase in ROW_PHASES}
+
+    def merge(self, other: "Stats") -> None:
+        # Shard and per-file parsers report into their parent, their timers add up (as CPU time across
+        # processes) under "shards."
+        self.counters.update(other.counters)
+        for phase, seconds in other.phases.items():
+            self.phases[phase if phase.startswith("shards.") else f"shards.{phase}"] += seconds
+        for phase, seconds in other.sampled.items():
+            self.sampled[phase] += seconds
+        self.samples += other.samples
+        self.errors.extend(other.errors)
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "phases": dict(self.phases),
+            "row_phases_estimated": self.estimated_phases(),
+            "samples": self.samples,
+            "errors": list(self.errors),
+        }
+
+def memory_report(parser) -> dict[str, int]:
+    # Approximate bytes held by the store columns, indexes and counts
+    report = {}
+    store = parser.store
+    for field, column in store.columns.items():
+        report[f"column.{field}"] = column.nbytes()
+    report["offsets"] = store.offsets.itemsize * len(store.offsets)
+    for name in ("source_ip_index", "destination_ip_index", "source_and_destination_ip_index", "time_index"):
+        report[name] = getattr(parser, name).nbytes()
+    counts = parser.connection_counts
+    if parser.epsilon:
+        report["connection_counts"] = counts.nbytes()
+        report["distinct_sources"] = parser.distinct_sources.nbytes()
+        report["destination_port_sketches"] = sum(sketch.nbytes() for sketch in parser.destination_port_sketches.values())
+    elif counts:
+        # dict table plus one 5-int tuple per key, ints are shared small ints or ~28 bytes each
+        key = next(iter(counts))
+        key_bytes = sys.getsizeof(key) + sum(sys.getsizeof(value) for value in key)
+        report["connection_counts"] = sys.getsizeof(counts) + len(counts) * key_bytes
+    else:
+        report["connection_counts"] = sys.getsizeof(counts)
+    for summary in parser.rollups:
+        report[f"rollup.{summary.name}"] = summary.nbytes()
+    report["result_cache"] = parser.cache.bytes
+    return report
@@ -0,0 +1,387 @@
+import array
+import bisect
+import collections.abc
+import socket
+import struct
+import sys
+import flowparser.constants as constants
+from flowparser.model import record_class
+
+# 255.255.255.255 never shows up as a VPC flow endpoint, so it doubles as the null marker
+IPV4_NULL = 0xFFFFFFFF
+# Neither does the rest of 240.0.0.0/4: addresses that aren't IPv4 (IPv6 in dual-stack VPCs) are stored as
+# IPV4_OTHER + their code in the column's table of other addresses, so stored values from IPV4_OTHER up
+# (the null included) are never packed IPv4 addresses
+IPV4_OTHER = 0xF0000000
+
+# Dictionary codes start one byte wide and widen as symbols are added: version, account-id, action,
+# log-status and most interface-ids fit in 'B'
+CODE_TYPECODES = ('B', 'H', 'I')
+CODE_LIMITS = {'B': 0xFF, 'H': 0xFFFF, 'I': 0xFFFFFFFF}
+
+IPV4_STRUCT = struct.Struct("!I")
+
+def ip_to_int(ip: str) -> int:
+    return IPV4_STRUCT.unpack(socket.inet_aton(ip))[0]
+
+def int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(IPV4_STRUCT.pack(value))
+
+class IntColumn:
+    def __init__(self, typecode: str, null: int = -1):
+        self.values = array.array(typecode)
+        self.null = null
+
+    def append(self, token: bytes) -> int:
+        value = self.null if token == b'-' else int(token)
+        self.values.append(value)
+        return value
+
+    def get(self, row_idx: int):
+        value = self.values[row_idx]
+        return None if value == self.null else str(value)
+
+    def extend(self, other: "IntColumn") -> None:
+        self.values.extend(other.values)
+
+    def truncate(self, row_count: int) -> None:
+        del self.values[row_count:]
+
+    def nbytes(self) -> int:
+        return self.values.itemsize * len(self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+class IPv4Column(IntColumn):
+    def __init__(self):
+        super().__init__('I', IPV4_NULL)
+        # addresses repeat heavily, so remember every token already packed
+        self.cache: dict[bytes, int] = {b'-': IPV4_NULL}
+        # IPv6 addresses, as written, stored as IPV4_OTHER + their position
+        self.others: list[str] = []
+
+    def pack(self, token: bytes) -> int:
+        address = token.decode()
+        try:
+            value = ip_to_int(address)
+        except OSError:
+            # anything that isn't IPv6 either is still malformed
+            if ":" not in address:
+                raise
+            socket.inet_pton(socket.AF_INET6, address)
+            value = IPV4_OTHER + len(self.others)
+            self.others.append(sys.intern(address))
+        self.cache[token] = value
+        return value
+
+    def stored(self, address: str):
+        # Stored value of an address, None when it was never seen (IPv6) or isn't an address
+        try:
+            return ip_to_int(address)
+        except OSError:
+            return self.cache.get(address.encode()) if ":" in address else None
+
+    def decode(self, value: int):
+        if value < IPV4_OTHER:
+            return int_to_ip(value)
+        return None if value == IPV4_NULL else self.others[value - IPV4_OTHER]
+
+    def append(self, token: bytes) -> int:
+        value = self.cache.get(token)
+        if value is None:
+            value = self.pack(token)
+        self.values.append(value)
+        return value
+
+    def extend(self, other: "IPv4Column") -> None:
+        if not other.others:
+            self.values.extend(other.values)
+            return
+        remap = {IPV4_OTHER + code: self.cache.get(address.encode()) for code, address in enumerate(other.others)}
+        for value, address in zip(remap, other.others):
+            if remap[value] is None:
+                remap[value] = self.pack(address.encode())
+        self.values.extend(array.array('I', [remap.get(value, value) for value in other.values]))
+
+    def __getstate__(self):
+        return {"values": self.values, "null": self.null, "others": self.others}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = {b'-': IPV4_NULL}
+        self.cache.update((address.encode(), IPV4_OTHER + code) for code, address in enumerate(self.others))
+
+    def get(self, row_idx: int):
+        return self.decode(self.values[row_idx])
+
+class DictColumn:
+    def __init__(self):
+        # code 0 is reserved for missing ('-') values
+        self.codes = array.array(CODE_TYPECODES[0])
+        # symbols are interned, so every column and store holding a value shares one string
+        self.symbols: list = [None]
+        self.lookup: dict[bytes, int] = {b'-': 0}
+
+    def _widen(self) -> None:
+        # Switch the codes to the narrowest typecode that holds every symbol's code
+        typecode = self.codes.typecode
+        while len(self.symbols) - 1 > CODE_LIMITS[typecode]:
+            typecode = CODE_TYPECODES[CODE_TYPECODES.index(typecode) + 1]
+        if typecode != self.codes.typecode:
+            self.codes = array.array(typecode, self.codes)
+
+    def add(self, token: bytes) -> int:
+        # Code of a symbol seen for the first time
+        code = len(self.symbols)
+        self.symbols.append(sys.intern(token.decode()))
+        self.lookup[token] = code
+        if code > CODE_LIMITS[self.codes.typecode]:
+            self._widen()
+        return code
+
+    def append(self, token: bytes) -> int:
+        code = self.lookup.get(token)
+        if code is None:
+            code = self.add(token)
+        self.codes.append(code)
+        return code
+
+    def get(self, row_idx: int):
+        return self.symbols[self.codes[row_idx]]
+
+    def extend(self, other: "DictColumn") -> None:
+        remap = [0] + [self.lookup.get(symbol.encode()) for symbol in other.symbols[1:]]
+        for code, symbol in enumerate(other.symbols[1:], start=1):
+            if remap[code] is None:
+                remap[code] = len(self.symbols)
+                self.symbols.append(sys.intern(symbol))
+                self.lookup[symbol.encode()] = remap[code]
+        self._widen()
+        if remap != list(range(len(remap))):
+            self.codes.extend(array.array(self.codes.typecode, [remap[code] for code in other.codes]))
+        elif other.codes.typecode == self.codes.typecode:
+            self.codes.extend(other.codes)
+        else:
+            self.codes.extend(array.array(self.codes.typecode, other.codes))
+
+    def truncate(self, row_count: int) -> None:
+        del self.codes[row_count:]
+
+    def nbytes(self) -> int:
+        symbols = sum(sys.getsizeof(symbol) for symbol in self.symbols[1:])
+        return self.codes.itemsize * len(self.codes) + symbols + sys.getsizeof(self.lookup)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+def make_column(field: str):
+    if field in constants.FLOW_LOG_IPV4_FIELDS:
+        return IPv4Column()
+    if field in constants.FLOW_LOG_INT_FIELDS:
+        return IntColumn(constants.FLOW_LOG_INT_FIELDS[field])
+    return DictColumn()
+
+def compile_appender(store: "FlowlogStore"):
+    # Generates FlowlogStore.append for one schema: straight-line code that picks the eager fields' tokens
+    # by their fixed positions and inlines each column's append, instead of looping over the fields and
+    # calling a method per field for every line. Columns are reached through their attributes, which
+    # snapshots and merges may replace.
+    fields = len(store.schema)
+    source = [
+        "def append(tokens, offset=0):",
+        "    # Returns the encoded value of every eager field (packed IP, int or dictionary code)",
+    ]
+    if store.lazy and store.maxsplit < fields:
+        # the lazy fields are left unsplit in the last token, only their count is checked
+        source += [
+            f"    if len(tokens) <= {store.maxsplit}:",
+            "        raise IndexError('not enough fields in line')",
+            f"    rest = len(tokens[{store.maxsplit}].split())",
+            f"    if rest != {fields - store.maxsplit}:",
+            f"        raise IndexError('not enough fields in line' if rest < {fields - store.maxsplit} else 'too many fields in line')",
+        ]
+    else:
+        source += [
+            f"    if len(tokens) != {fields}:",
+            f"        raise IndexError('not enough fields in line' if len(tokens) < {fields} else 'too many fields in line')",
+        ]
+    namespace = {"store": store}
+    values = []
+    for slot, field in enumerate(store.eager_fields):
+        column, token, value = f"column_{slot}", f"tokens[{store.positions[field]}]", f"value_{slot}"
+        namespace[column] = store.columns[field]
+        if isinstance(store.columns[field], IPv4Column):
+            source += [
+                f"    {value} = {column}.cache.get({token})",
+                f"    if {value} is None:",
+                f"        {value} = {column}.pack({token})",
+                f"    {column}.values.append({value})",
+            ]
+        elif isinstance(store.columns[field], IntColumn):
+            source += [
+                f"    {value} = {token}",
+                f"    {value} = {store.columns[field].null} if {value} == b'-' else int({value})",
+                f"    {column}.values.append({value})",
+            ]
+        else:
+            source += [
+                f"    {value} = {column}.lookup.get({token})",
+                f"    if {value} is None:",
+                f"        {value} = {column}.add({token})",
+                f"    {column}.codes.append({value})",
+            ]
+        values.append(value)
+    if store.lazy:
+        source.append("    store.offsets.append(offset)")
+    source += ["    store.row_count += 1", f"    return [{', '.join(values)}]"]
+    exec(compile("\n".join(source), f"<append {' '.join(store.schema)}>", "exec"), namespace)
+    return namespace["append"]
+
+def compile_decoder(store: "FlowlogStore"):
+    # Generates FlowlogStore.values for one schema, the counterpart of compile_appender: every field of a
+    # row is decoded inline (symbol lookup, IP formatting, int to str) and lazy fields are taken from the
+    # line's tokens, which are split once.
+    source = ["def values(row_idx):", "    # Every field of a row in schema order, None for missing values"]
+    namespace = {"store": store, "inet_ntoa": socket.inet_ntoa, "pack": IPV4_STRUCT.pack}
+    if store.lazy:
+        source.append("    tokens = store._line_tokens(row_idx)")
+    values = []
+    for position, field in enumerate(store.schema):
+        column, value = store.columns.get(field), f"value_{position}"
+        name = f"column_{position}"
+        namespace[name] = column
+        if column is None:
+            source.append(f"    {value} = tokens[{position}]")
+            values.append(f"None if {value} == b'-' else {value}.decode()")
+        elif isinstance(column, DictColumn):
+            values.append(f"{name}.symbols[{name}.codes[row_idx]]")
+        elif isinstance(column, IPv4Column):
+            source.append(f"    {value} = {name}.values[row_idx]")
+            values.append(f"inet_ntoa(pack({value})) if {value} < {IPV4_OTHER} else {name}.decode({value})")
+        else:
+            source.append(f"    {value} = {name}.values[row_idx]")
+            values.append(f"None if {value} == {column.null} else str({value})")
+    source.append(f"    return [{', '.join(values)}]")
+    exec(compile("\n".join(source), f"<values {' '.join(store.schema)}>", "exec"), namespace)
+    return namespace["values"]
+
+class FlowlogStore:
+    # Rows are appended as lists of bytes tokens. Eager fields are decoded into columns,
+    # lazy fields stay in the source buffer and are sliced out of the row's line on access.
+    def __init__(self, schema=constants.FLOW_LOG_SCHEMA_DEFAULT, eager_fields=None):
+        self.schema: list[str] = list(schema)
+        self.positions = {field: position for position, field in enumerate(self.schema)}
+        self.eager_fields = [field for field in self.schema if eager_fields is None or field in eager_fields]
+        self.lazy = len(self.eager_fields) < len(self.schema)
+        self.columns = {field: make_column(field) for field in self.eager_fields}
+        # fields past the last eager one are never split out of the line at ingest
+        self.maxsplit = max(self.positions[field] for field in self.eager_fields) + 1 if self.lazy and self.eager_fields else -1
+        self.offsets = array.array('Q')
+        # multi-file loads store each file's rows back to back: files[i] starts at row file_starts[i].
+        # Lazy stores keep one mapped source per file (offsets are relative to it).
+        self.files: list[str] = []
+        self.file_starts = array.array('Q', [0])
+        self.sources: list = [None]
+        self.row_count = 0
+        # append(tokens, offset) adds a row given its line's tokens and values(row_idx) decodes one,
+        # both generated for this schema, as is the class of the rows handed out
+        self.append = compile_appender(self)
+        self.values = compile_decoder(self)
+        self.record = record_class(self)
+
+    def slot(self, field: str) -> int:
+        # Position of an eager field in the list returned by append
+        return self.eager_fields.index(field)
+
+    def truncate(self, row_count: int) -> None:
+        for column in self.columns.values():
+            column.truncate(row_count)
+        del self.offsets[row_count:]
+        self.row_count = row_count
+
+    def extend(self, other: "FlowlogStore") -> None:
+        for field, column in self.columns.items():
+            column.extend(other.columns[field])
+        self.offsets.extend(other.offsets)
+        self.row_count += other.row_count
+
+    @property
+    def source(self):
+        return self.sources[0]
+
+    @source.setter
+    def source(self, mapping):
+        self.sources[0] = mapping
+
+    def file_of(self, row_idx: int) -> int:
+        # Index of the file row_idx was read from
+        return bisect.bisect_right(self.file_starts, row_idx) - 1
+
+    def add_file(self, path: str, source=None) -> None:
+        # Rows appended from now on belong to path
+        if self.files:
+            self.file_starts.append(self.row_count)
+            self.sources.append(source)
+        else:
+            self.file_starts[0] = self.row_count
+            self.sources[0] = source
+        self.files.append(path)
+
+    def _line_tokens(self, row_idx: int) -> list[bytes]:
+        offset = self.offsets[row_idx]
+        source = self.sources[self.file_of(row_idx)] if len(self.sources) > 1 else self.sources[0]
+        end = source.find(b'\n', offset)
+        return source[offset:end if end != -1 else len(source)].split()
+
+    def get(self, row_idx: int, field: str):
+        column = self.columns.get(field)
+        if column is not None:
+            return column.get(row_idx)
+        token = self._line_tokens(row_idx)[self.positions[field]]
+        return None if token == b'-' else token.decode()
+
+    def row(self, row_idx: int):
+        return self.record(self, row_idx)
+
+    def nbytes(self) -> int:
+        columns = sum(column.nbytes() for column in self.columns.values())
+        return columns + self.offsets.itemsize * len(self.offsets)
+
+    def __getstate__(self):
+        # the mapped source can't cross process boundaries, the owner reattaches it
+        state = self.__dict__.copy()
+        state["sources"] = [None] * len(self.sources)
+        for generated in ("append", "values", "record"):
+            del state[generated]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.append = compile_appender(self)
+        self.values = compile_decoder(self)
+        self.record = record_class(self)
+
+    def __len__(self) -> int:
+        return self.row_count
+
+class RowSet(collections.abc.Sequence):
+    # Query result: row ids plus the store they point into, rows are built on access
+    def __init__(self, store: FlowlogStore, row_ids=(), key=None):
+        self.store = store
+        self.row_ids = row_ids
+        # result cache key of the search that produced it, renderings of the rows are cached under it too
+        self.key = key
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return RowSet(self.store, self.row_ids[item])
+        return self.store.row(self.row_ids[item])
+
+    def __iter__(self):
+        row = self.store.row
+        for row_idx in self.row_ids:
+            yield row(row_idx)
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
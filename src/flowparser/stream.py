@@ -0,0 +1,102 @@
+import collections
+import heapq
+import itertools
+import operator
+import sys
+import flowparser.decompress as decompress
+import flowparser.header as header
+from flowparser.store import ip_to_int, int_to_ip
+
+# Counts-only pipeline: read_lines -> select_fields -> StreamAggregates.consume.
+# Every stage is a generator, so only the aggregates outlive a line.
+STREAM_FIELDS = ["srcaddr", "dstaddr", "srcport", "dstport", "protocol", "packets", "bytes"]
+
+def read_lines(path: str):
+    # '-' reads stdin, gzip/zstd input is detected by its magic bytes rather than the file name
+    # and decompressed in a background thread
+    if path == '-':
+        raw = sys.stdin.buffer
+        compression = decompress.compression_of(raw.peek(4)[:4])
+        yield from decompress.iter_lines(decompress.iter_chunks(raw, compression)) if compression else raw
+        return
+    compression = decompress.detect_compression(path)
+    if compression:
+        yield from decompress.iter_lines(decompress.iter_chunks(path, compression))
+        return
+    with open(path, 'rb') as raw:
+        yield from raw
+
+def select_fields(lines, schema: list[str]):
+    # Yields (srcaddr, dstaddr, srcport, dstport, protocol, packets, bytes) tokens, None for fields not in the schema.
+    # A header line (custom log formats, also on stdin) replaces the schema.
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    fields = header.parse_header(first)
+    if fields:
+        schema = fields
+    else:
+        lines = itertools.chain([first], lines)
+    for field in STREAM_FIELDS[:5]:
+        if field not in schema:
+            raise ValueError(f"schema has no {field!r} field")
+    present = [field for field in STREAM_FIELDS if field in schema]
+    positions = [schema.index(field) for field in present]
+    width = max(positions) + 1
+    getter = operator.itemgetter(*positions)
+    missing = len(present) < len(STREAM_FIELDS)
+    for line in lines:
+        fields = line.split(None, width)
+        if len(fields) < width:
+            raise IndexError("not enough fields in line")
+        if missing:
+            values = dict(zip(present, getter(fields)))
+            yield tuple(values.get(field) for field in STREAM_FIELDS)
+        else:
+            yield getter(fields)
+
+class StreamAggregates:
+    def __init__(self, connection_counts=None):
+        self.rows = 0
+        self.skipped = 0
+        # (srcaddr, dstaddr, srcport, dstport, protocol) with packed IPs -> count, same keys as Parser.
+        # A CountMinSketch can be passed in to keep memory fixed.
+        self.connection_counts = connection_counts if connection_counts is not None else collections.defaultdict(int)
+        self.source_bytes: dict[int, int] = collections.defaultdict(int)
+        self.destination_bytes: dict[int, int] = collections.defaultdict(int)
+        self.destination_port_flows: dict[int, int] = collections.defaultdict(int)
+        self._ips: dict[bytes, int] = {}
+
+    def _pack(self, token: bytes) -> int:
+        value = self._ips.get(token)
+        if value is None:
+            value = self._ips[token] = ip_to_int(token.decode())
+        return value
+
+    def consume(self, rows) -> "StreamAggregates":
+        for src, dst, src_port, dst_port, protocol, packets, bytes_ in rows:
+            self.rows += 1
+            # like the parser, only flows between IPv4 addresses are counted
+            if src == b'-' or dst == b'-' or b':' in src or b':' in dst:
+                self.skipped += 1
+                continue
+            src_ip, dst_ip, dst_port = self._pack(src), self._pack(dst), int(dst_port)
+            self.connection_counts[(src_ip, dst_ip, int(src_port), dst_port, int(protocol))] += 1
+            size = int(bytes_) if bytes_ not in (None, b'-') else 0
+            self.source_bytes[src_ip] += size
+            self.destination_bytes[dst_ip] += size
+            self.destination_port_flows[dst_port] += 1
+        return self
+
+    def top_sources(self, n: int = 10) -> list[tuple[str, int]]:
+        return [(int_to_ip(ip), total) for ip, total in heapq.nlargest(n, self.source_bytes.items(), key=operator.itemgetter(1))]
+
+    def top_destinations(self, n: int = 10) -> list[tuple[str, int]]:
+        return [(int_to_ip(ip), total) for ip, total in heapq.nlargest(n, self.destination_bytes.items(), key=operator.itemgetter(1))]
+
+    def top_destination_ports(self, n: int = 10) -> list[tuple[int, int]]:
+        return heapq.nlargest(n, self.destination_port_flows.items(), key=operator.itemgetter(1))
+
+def aggregate(path: str, schema: list[str]) -> StreamAggregates:
+    return StreamAggregates().consume(select_fields(read_lines(path), schema))
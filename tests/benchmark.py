@@ -0,0 +1,332 @@
+# Benchmarks for the flow log parser (assuming random.seed(0))
+# Run from tests/ like the test suite:  python3 benchmark.py memory|speedup|sketch [size_mb] or cidr [size_mb] [hosts]
+# or the full suite with JSON output:  python3 benchmark.py suite --size-mb 50 --output results.json
+import argparse
+import array
+import bisect
+import collections
+import contextlib
+import datetime
+import ipaddress
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+if os.path.join(os.getcwd(), "src") not in sys.path:
+    sys.path.append(os.path.join(os.getcwd(), "..", "src"))
+
+from flowparser.index import union_all
+from flowparser.parser import Parser
+import flowparser.cache as cache
+import flowparser.constants as constants
+from generator import generate_scaled, generate_testcase
+
+class LegacyFlowlog:
+    # Per-row object graph the parser used before the columnar store
+    def __init__(self, row_idx, schema=constants.FLOW_LOG_SCHEMA_DEFAULT, **kwargs):
+        self.schema = schema
+        self.row_idx = row_idx
+        for field in schema:
+            setattr(self, field, kwargs.get(field))
+
+def legacy_deserialize(path: str, schema=constants.FLOW_LOG_SCHEMA_DEFAULT):
+    source_ip_index = collections.defaultdict(list)
+    destination_ip_index = collections.defaultdict(list)
+    source_and_destination_ip_index = collections.defaultdict(list)
+    connection_counts = collections.defaultdict(int)
+    with open(path, 'r') as file:
+        for row_idx, line in enumerate(file):
+            fields = line.strip().split()
+            flowlog_data = {}
+            for i, field in enumerate(schema):
+                if fields[i] != '-':
+                    flowlog_data[field] = fields[i]
+            flowlog = LegacyFlowlog(row_idx=row_idx, schema=schema, **flowlog_data)
+            source_ip_index[flowlog.srcaddr].append(flowlog)
+            destination_ip_index[flowlog.dstaddr].append(flowlog)
+            source_and_destination_ip_index[(flowlog.srcaddr, flowlog.dstaddr)].append(flowlog)
+            connection_counts[(flowlog.srcaddr, flowlog.dstaddr, flowlog.srcport, flowlog.dstport, flowlog.protocol)] += 1
+    return source_ip_index, destination_ip_index, source_and_destination_ip_index, connection_counts
+
+@contextlib.contextmanager
+def generated(generate, filename: str, **options):
+    # Path of a benchmark input generated into a temporary directory, removed with everything in it afterwards
+    directory = tempfile.mkdtemp(prefix="flowlogs_bench_")
+    try:
+        yield generate(filename, directory=directory, **options)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def measure(build) -> tuple[int, float]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained, elapsed
+
+def bench_memory(size_mb: int = 20) -> None:
+    with generated(generate_testcase, "bench_flowlogs.txt", target_size_mb=size_mb) as path:
+        file_size = os.path.getsize(path)
+
+        def build_store():
+            parser = Parser(path=path)
+            parser.deserialize()
+            return parser
+
+        legacy, legacy_time = measure(lambda: legacy_deserialize(path))
+        columnar, columnar_time = measure(build_store)
+        parser = build_store()
+
+        print(f"input file:        {file_size / 2**20:8.1f} MB")
+        print(f"object graph:      {legacy / 2**20:8.1f} MB retained ({legacy / file_size:.1f}x file size, {legacy_time:.1f}s)")
+        print(f"columnar store:    {columnar / 2**20:8.1f} MB retained ({columnar / file_size:.1f}x file size, {columnar_time:.1f}s)")
+        print(f"  rows only:       {parser.store.nbytes() / 2**20:8.1f} MB ({len(parser.store)} rows)")
+        indexes = parser.source_ip_index.nbytes() + parser.destination_ip_index.nbytes() + parser.source_and_destination_ip_index.nbytes()
+        print(f"  indexes:         {indexes / 2**20:8.1f} MB")
+        print(f"reduction:         {legacy / columnar:8.1f}x")
+
+def bench_speedup(size_mb: int = 20) -> None:
+    with generated(generate_testcase, "bench_flowlogs.txt", target_size_mb=size_mb) as path:
+        cores = os.cpu_count() or 1
+        workers = sorted(set([1, 2, 4, 8, cores]) & set(range(1, cores + 1)))
+        baseline = None
+        print(f"input file: {os.path.getsize(path) / 2**20:.1f} MB, {cores} cores")
+        for count in workers:
+            parser = Parser(path=path)
+            started = time.perf_counter()
+            parser.deserialize(workers=count)
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"workers={count:<3} {elapsed:6.2f}s  speedup {baseline / elapsed:4.2f}x")
+
+def bench_sketch(size_mb: int = 20) -> None:
+    with generated(generate_testcase, "bench_flowlogs.txt", target_size_mb=size_mb) as path:
+        exact = Parser(path=path, pair_index=False)
+        exact_memory, exact_time = measure(lambda: exact.deserialize())
+        approximate = Parser(path=path, pair_index=False, epsilon=0.0001)
+        approximate_memory, approximate_time = measure(lambda: approximate.deserialize())
+
+        counts, sketch = exact.connection_counts, approximate.connection_counts
+        errors = [sketch.get(key) - count for key, count in counts.items()]
+        print(f"flows: {sketch.total}, distinct connections: {len(counts)}")
+        print(f"exact counts:       {sys.getsizeof(counts) / 2**20:8.1f} MB dict table, {exact_memory / 2**20:.1f} MB retained in total ({exact_time:.1f}s)")
+        print(f"count-min sketch:   {sketch.nbytes() / 2**20:8.1f} MB fixed, {approximate_memory / 2**20:.1f} MB retained in total ({approximate_time:.1f}s)")
+        print(f"overcount:          mean {sum(errors) / len(errors):.3f}, max {max(errors)}, bound {sketch.error_bound():.1f}, "
+              f"{sum(1 for error in errors if error == 0) / len(errors):.1%} exact")
+        print(f"distinct sources:   exact {exact.count_distinct_sources()}, hyperloglog {approximate.count_distinct_sources()}")
+        dst_ip = next(iter(exact.destination_ip_index))
+        dst_ip = f"{dst_ip >> 24}.{dst_ip >> 16 & 255}.{dst_ip >> 8 & 255}.{dst_ip & 255}"
+        print(f"dst ports of {dst_ip}: exact {exact.count_distinct_destination_ports(dst_ip)}, "
+              f"hyperloglog {approximate.count_distinct_destination_ports(dst_ip)}")
+
+def bench_cidr(size_mb: int = 20, hosts: int = 5000) -> None:
+    # Thousands of distinct sources, so a prefix covers a small share of the index's keys
+    with generated(generate_scaled, "bench_flowlogs.txt", target_size_mb=size_mb, hosts=hosts) as path:
+        parser = Parser(path=path)
+        parser.deserialize()
+    index = parser.source_ip_index
+    keys = index.sorted_keys()
+    # prefixes around a key from the middle of the address range
+    center = ipaddress.IPv4Address(keys[len(keys) // 2])
+    repeat = 200
+    print(f"{len(index)} source IPs, {len(parser.store)} rows")
+    print(f"{'prefix':<18}{'keys':>7}{'rows':>9}{'range scan':>14}{'full key scan':>16}")
+    for prefix in [8, 12, 16, 20, 22, 24, 28, 32]:
+        network = ipaddress.IPv4Network(f"{center}/{prefix}", strict=False)
+        low, high = int(network.network_address), int(network.broadcast_address)
+        matching_keys = bisect.bisect_right(keys, high) - bisect.bisect_left(keys, low)
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            rows = parser.source_postings(str(network))
+        range_scan = (time.perf_counter() - started) / repeat
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            union_all([postings for key, postings in index.items() if low <= key <= high] or [array.array('I')])
+        full_scan = (time.perf_counter() - started) / repeat
+        print(f"{str(network):<18}{matching_keys:>7}{len(rows):>9}{range_scan * 1e6:>11.0f} us{full_scan * 1e6:>13.0f} us")
+
+def _ingest_run(path: str, options: dict, results) -> None:
+    # Runs in a fresh spawned process so ru_maxrss is this ingest's peak alone
+    started = time.perf_counter()
+    parser = Parser(path=path, **options)
+    parser.deserialize()
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak_bytes = peak if sys.platform == "darwin" else peak * 1024
+    results.put({"seconds": elapsed, "rows": len(parser.store), "peak_rss_bytes": peak_bytes})
+
+def measure_ingest(path: str, **options) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_ingest_run, args=(path, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    size = os.path.getsize(path)
+    result["mb_per_second"] = size / 2**20 / result["seconds"]
+    result["rows_per_second"] = result["rows"] / result["seconds"]
+    return result
+
+def latency(run, repeat: int) -> dict:
+    # run(i) is timed repeat times, returns percentiles in milliseconds
+    samples = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        run(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"repeat": repeat, "p50_ms": statistics.median(samples), "p99_ms": cuts[98], "max_ms": max(samples)}
+
+def _version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def bench_suite(argv: list[str]) -> dict:
+    arguments = argparse.ArgumentParser(prog="benchmark.py suite", description="Ingest throughput, index build and query latency")
+    arguments.add_argument("--size-mb", type=float, default=20)
+    arguments.add_argument("--hosts", type=int, default=200, help="distinct IP addresses")
+    arguments.add_argument("--ports", type=int, default=1000, help="distinct destination ports")
+    arguments.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of host/port popularity, 0 is uniform")
+    arguments.add_argument("--repeat", type=int, default=200, help="runs per query type")
+    arguments.add_argument("--seed", type=int, default=0)
+    arguments.add_argument("--output", help="write the results as JSON to this file")
+    options = arguments.parse_args(argv)
+
+    generator_options = {"target_size_mb": options.size_mb, "hosts": options.hosts, "ports": options.ports, "skew": options.skew, "seed": options.seed}
+    with generated(generate_scaled, "bench_suite_flowlogs.txt", **generator_options) as path:
+        results = {
+            "version": _version(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "input": dict(generator_options, bytes=os.path.getsize(path)),
+        }
+
+        results["ingest"] = {
+            "eager": measure_ingest(path),
+            "lazy": measure_ingest(path, lazy=True),
+            "no_pair_index": measure_ingest(path, pair_index=False),
+            "approximate": measure_ingest(path, epsilon=0.0001),
+        }
+        for name, run in results["ingest"].items():
+            print(f"ingest {name:<14} {run['seconds']:7.2f}s  {run['mb_per_second']:6.1f} MB/s  {run['rows_per_second']:9.0f} rows/s  "
+                  f"peak RSS {run['peak_rss_bytes'] / 2**20:7.1f} MB")
+
+        parser = Parser(path=path)
+        parser.deserialize()
+        index = {"pair_index_seconds": results["ingest"]["eager"]["seconds"] - results["ingest"]["no_pair_index"]["seconds"]}
+        started = time.perf_counter()
+        for posting_index in (parser.source_ip_index, parser.destination_ip_index):
+            posting_index._sorted_keys = None
+            posting_index.sorted_keys()
+        index["sorted_keys_seconds"] = time.perf_counter() - started
+        snapshot_path = path + ".idx"
+        started = time.perf_counter()
+        parser.save_index(snapshot_path)
+        index["snapshot_write_seconds"] = time.perf_counter() - started
+        started = time.perf_counter()
+        Parser(path=path).load_index(snapshot_path)
+        index["snapshot_load_seconds"] = time.perf_counter() - started
+        index["bytes"] = {
+            "source_ip_index": parser.source_ip_index.nbytes(),
+            "destination_ip_index": parser.destination_ip_index.nbytes(),
+            "source_and_destination_ip_index": parser.source_and_destination_ip_index.nbytes(),
+            "time_index": parser.time_index.nbytes(),
+        }
+        os.remove(snapshot_path)
+        results["index"] = index
+        print(f"index  pair {index['pair_index_seconds']:.2f}s, sorted keys {index['sorted_keys_seconds'] * 1000:.1f} ms, "
+              f"snapshot write {index['snapshot_write_seconds']:.2f}s / load {index['snapshot_load_seconds']:.2f}s")
+
+        # query arguments drawn from the data so most probes hit
+        rng = random.Random(options.seed)
+        rows = [parser.store.row(rng.randrange(len(parser.store))) for _ in range(options.repeat)]
+        rows = [row for row in rows if row.srcaddr is not None] or rows
+        pick = lambda i: rows[i % len(rows)]
+        start = min(parser.time_index) * constants.TIME_BUCKET_SECONDS
+        repeat, few = options.repeat, max(10, options.repeat // 10)
+        queries = {
+            "search_src": (lambda i: parser.search_by_source_ip(pick(i).srcaddr), repeat),
+            "search_dst": (lambda i: parser.search_by_destination_ip(pick(i).dstaddr), repeat),
+            "search_src_dst": (lambda i: parser.search_by_source_and_destination_ip(pick(i).srcaddr, pick(i).dstaddr), repeat),
+            "search_src_cidr24": (lambda i: parser.search_by_source_ip(pick(i).srcaddr.rsplit(".", 1)[0] + ".0/24"), repeat),
+            "search_time_5min": (lambda i: parser.search_by_time(start + i * 60, start + i * 60 + 300), repeat),
+            "get_connection_count": (lambda i: parser.get_connection_count(pick(i).srcaddr, pick(i).srcport, pick(i).dstaddr, pick(i).dstport, pick(i).protocol), repeat),
+            "query_indexed": (lambda i: parser.query(f"srcaddr={pick(i).srcaddr} AND dstport={pick(i).dstport} AND action=REJECT"), repeat),
+            "query_scan": (lambda i: parser.query(f"dstport={pick(i).dstport} AND action=REJECT"), few),
+            "aggregate_top20": (lambda i: parser.aggregate(["dstport"], ["sum(bytes)"], where="action=REJECT", top=20), few),
+        }
+        results["queries"] = {}
+        # the index and scan work itself, not the result cache (Zipf-skewed picks repeat)
+        parser.cache.resize(max_entries=0)
+        for name, (run, count) in queries.items():
+            results["queries"][name] = stats = latency(run, count)
+            print(f"query  {name:<22} p50 {stats['p50_ms']:9.3f} ms  p99 {stats['p99_ms']:9.3f} ms")
+        # the same scanning query over and over, answered from the cache after the first run
+        parser.cache.resize(max_entries=cache.DEFAULT_MAX_ENTRIES)
+        results["queries"]["query_scan_repeated"] = stats = latency(lambda i: parser.query(f"dstport={pick(0).dstport} AND action=REJECT"), repeat)
+        print(f"query  {'query_scan_repeated':<22} p50 {stats['p50_ms']:9.3f} ms  p99 {stats['p99_ms']:9.3f} ms")
+
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"results written to {options.output}")
+        return results
+
+def compare(argv: list[str]) -> None:
+    # Ratios between two suite result files:  python3 benchmark.py compare old.json new.json
+    if len(argv) != 2:
+        print("Usage: python3 benchmark.py compare old.json new.json")
+        sys.exit(1)
+    with open(argv[0]) as f:
+        old = json.load(f)
+    with open(argv[1]) as f:
+        new = json.load(f)
+    print(f"{old['version']} -> {new['version']}")
+    for name in sorted(old["ingest"].keys() & new["ingest"].keys()):
+        before, after = old["ingest"][name], new["ingest"][name]
+        print(f"ingest {name:<22} {before['mb_per_second']:7.1f} -> {after['mb_per_second']:7.1f} MB/s ({after['mb_per_second'] / before['mb_per_second']:.2f}x)")
+    for name in sorted(old["queries"].keys() & new["queries"].keys()):
+        before, after = old["queries"][name], new["queries"][name]
+        print(f"query  {name:<22} p50 {before['p50_ms']:8.3f} -> {after['p50_ms']:8.3f} ms ({before['p50_ms'] / after['p50_ms']:.2f}x faster)")
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "speedup": bench_speedup,
+    "sketch": bench_sketch,
+    "cidr": bench_cidr,
+}
+
+# these take their own command line arguments
+COMMANDS = {
+    "suite": bench_suite,
+    "compare": compare,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python3 benchmark.py {'|'.join(list(BENCHMARKS) + list(COMMANDS))} [args...]")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*(int(arg) for arg in sys.argv[2:]))
@@ -21,9 +21,9 @@ def rand_ts():
 actions = ["ACCEPT", "REJECT"]
 statuses = ["OK", "NODATA", "SKIPDATA"]
 
-def generate_testcase(filename: str, target_size_mb: int = 20) -> str:
+def generate_testcase(filename: str, target_size_mb: int = 20, directory: str = None) -> str:
     target_size = target_size_mb * 1024 * 1024
-    path = os.path.join(os.getcwd(), "..", "data", filename)
+    path = os.path.join(directory or os.path.join(os.getcwd(), "..", "data"), filename)
     with open(path, "w") as f:
         size = 0
         while size < target_size:
@@ -52,3 +52,49 @@ def generate_testcase(filename: str, target_size_mb: int = 20) -> str:
             size += len(line) # each character is 1 byte
 
     return path
+
+def _zipf_weights(count: int, skew: float) -> list[float]:
+    # cumulative weights where rank r is picked with probability ~ 1 / r ** skew (skew 0 is uniform)
+    cumulative, total = [], 0.0
+    for rank in range(1, count + 1):
+        total += 1 / rank ** skew
+        cumulative.append(total)
+    return cumulative
+
+def generate_scaled(filename: str, target_size_mb: float = 20, hosts: int = 200, ports: int = 1000, skew: float = 1.0,
+                    nodata: float = 0.1, interfaces: int = 4, duration: int = 3600, seed: int = 0, directory: str = None) -> str:
+    # Benchmark input with controllable cardinality: `hosts` distinct IPs, `ports` distinct destination ports,
+    # and Zipf-skewed popularity for both (a few talkers carry most flows, like real VPC traffic).
+    # Uses its own Random so it does not disturb the seeded test cases above. Files go to ../data unless
+    # another directory is given.
+    rng = random.Random(seed)
+    target_size = int(target_size_mb * 1024 * 1024)
+    path = os.path.join(directory or os.path.join(os.getcwd(), "..", "data"), filename)
+    host_pool = [str(ipaddress.IPv4Address(0x0A000000 + rng.randrange(1 << 20))) for _ in range(hosts)]
+    port_pool = rng.sample(range(1, 65536), min(ports, 65535))
+    eni_pool = [f"eni-{rng.getrandbits(68):017x}" for _ in range(interfaces)]
+    host_weights, port_weights = _zipf_weights(len(host_pool), skew), _zipf_weights(len(port_pool), skew)
+    base = 1732930000
+    with open(path, "w") as f:
+        size = 0
+        while size < target_size:
+            batch = []
+            srcs = rng.choices(host_pool, cum_weights=host_weights, k=1000)
+            dsts = rng.choices(host_pool, cum_weights=host_weights, k=1000)
+            dst_ports = rng.choices(port_pool, cum_weights=port_weights, k=1000)
+            for src, dst, dst_port in zip(srcs, dsts, dst_ports):
+                start = base + rng.randrange(duration)
+                end = start + rng.randint(1, 60)
+                eni = rng.choice(eni_pool)
+                if rng.random() < nodata:
+                    batch.append(f"2 123456789010 {eni} - - - - - - - {start} {end} - NODATA\n")
+                    continue
+                packets = rng.randint(1, 50)
+                batch.append(
+                    f"2 123456789010 {eni} {src} {dst} {rng.randint(1024, 65535)} {dst_port} 6 "
+                    f"{packets} {packets * rng.randint(40, 1500)} {start} {end} {rng.choice(actions)} OK\n"
+                )
+            chunk = "".join(batch)
+            f.write(chunk)
+            size += len(chunk)
+    return path
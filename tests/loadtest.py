@@ -0,0 +1,153 @@
+# Load test for the query server: concurrent clients replay a mix of searches, queries, aggregates
+# and connection counts, and report throughput and latency percentiles per request type.
+# Run from tests/ against a generated file:  python3 loadtest.py --size-mb 20 --concurrency 16 --duration 30
+# or against a running server:              python3 loadtest.py --port 8765
+import argparse
+import datetime
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+if os.path.join(os.getcwd(), "src") not in sys.path:
+    sys.path.append(os.path.join(os.getcwd(), "..", "src"))
+
+from flowparser.client import QueryClient
+from flowparser.server import DEFAULT_PORT
+from generator import generate_scaled
+
+def start_server(path: str, port: int) -> subprocess.Popen:
+    # python3 main.py serve in its own process, returns once it accepts connections
+    root = os.path.join(os.getcwd(), "..")
+    server = subprocess.Popen([sys.executable, "main.py", "serve", os.path.abspath(path), f"port={port}"], cwd=root, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 600
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+def workload(client: QueryClient, limit: int) -> list[tuple[str, dict]]:
+    # Requests built from the loaded data: its top talkers, pairs, ports and connections
+    sources = [row["srcaddr"] for row in client.aggregate(["srcaddr"], top=20) if row["srcaddr"]]
+    pairs = [(row["srcaddr"], row["dstaddr"]) for row in client.aggregate(["srcaddr", "dstaddr"], top=20) if row["srcaddr"]]
+    ports = [row["dstport"] for row in client.aggregate(["dstport"], top=20) if row["dstport"] is not None]
+    connections = [row for row in client.aggregate(["srcaddr", "dstaddr", "srcport", "dstport", "protocol"], top=20) if row["srcaddr"]]
+    start = int(next(client.query("start>0", limit=1))["start"])
+    requests = []
+    for i in range(20):
+        source, (src, dst), port, connection = sources[i % len(sources)], pairs[i % len(pairs)], ports[i % len(ports)], connections[i % len(connections)]
+        requests += [
+            ("search_src", {"ip": source, "limit": limit}),
+            ("search_src_cidr", {"ip": source.rsplit(".", 1)[0] + ".0/24", "limit": limit}),
+            ("search_src_dst", {"src": src, "dst": dst, "limit": limit}),
+            ("search_time", {"from": start + i * 60, "to": start + i * 60 + 300, "src": source, "limit": limit}),
+            ("query", {"q": f"dstport={port} AND action=REJECT", "limit": limit}),
+            ("aggregate", {"by": "dstport", "metrics": "count,sum(bytes)", "top": 10, "where": f"srcaddr={source}"}),
+            ("get_connection_count", {key.replace("addr", "_ip").replace("port", "_port"): value for key, value in connection.items() if key != "count"}),
+        ]
+    return requests
+
+def run_client(host: str, port: int, requests: list, offset: int, deadline: float, samples: dict, errors: list) -> None:
+    with QueryClient(host, port) as client:
+        i = offset
+        while time.time() < deadline:
+            kind, params = requests[i % len(requests)]
+            command = "search_src" if kind == "search_src_cidr" else kind
+            started = time.perf_counter()
+            try:
+                if command in ("aggregate", "get_connection_count"):
+                    client.call(command, **params)
+                else:
+                    for _ in client.rows(command, **params):
+                        pass
+            except Exception as e:
+                errors.append(f"{kind}: {e}")
+                continue
+            finally:
+                i += 1
+            samples.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+
+def summarize(samples: list[float]) -> dict:
+    cuts = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    return {"requests": len(samples), "p50_ms": statistics.median(samples), "p99_ms": cuts[98], "max_ms": max(samples)}
+
+def main(argv: list[str]) -> dict:
+    arguments = argparse.ArgumentParser(prog="loadtest.py", description="Concurrent query throughput and tail latency of the query server")
+    arguments.add_argument("--host", default="127.0.0.1")
+    arguments.add_argument("--port", type=int, help="test a running server instead of starting one")
+    arguments.add_argument("--path", help="flow log to serve, generated with --size-mb if omitted")
+    arguments.add_argument("--size-mb", type=float, default=20)
+    arguments.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    arguments.add_argument("--duration", type=float, default=10, help="seconds")
+    arguments.add_argument("--limit", type=int, default=100, help="rows per search/query response")
+    arguments.add_argument("--output", help="write the results as JSON to this file")
+    options = arguments.parse_args(argv)
+
+    server = None
+    # generated input goes to a temporary directory, removed afterwards
+    directory = None
+    port = options.port
+    if port is None:
+        port = DEFAULT_PORT + 1
+        path = options.path
+        if path is None:
+            directory = tempfile.mkdtemp(prefix="flowlogs_loadtest_")
+            path = generate_scaled("loadtest_flowlogs.txt", target_size_mb=options.size_mb, directory=directory)
+        print(f"starting server on {path}...")
+        server = start_server(path, port)
+    try:
+        with QueryClient(options.host, port) as client:
+            requests = workload(client, options.limit)
+        samples, errors = {}, []
+        deadline = time.time() + options.duration
+        clients = [
+            threading.Thread(target=run_client, args=(options.host, port, requests, i * len(requests) // options.concurrency, deadline, samples, errors))
+            for i in range(options.concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    every = [sample for kind_samples in samples.values() for sample in kind_samples]
+    results = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "concurrency": options.concurrency,
+        "seconds": elapsed,
+        "requests_per_second": len(every) / elapsed,
+        "errors": len(errors),
+        "overall": summarize(every),
+        "requests": {kind: summarize(kind_samples) for kind, kind_samples in sorted(samples.items())},
+    }
+    print(f"{len(every)} requests in {elapsed:.1f}s from {options.concurrency} clients: {results['requests_per_second']:.0f} req/s, {len(errors)} errors")
+    for kind, summary in [("overall", results["overall"])] + list(results["requests"].items()):
+        print(f"  {kind:<22} {summary['requests']:7d}  p50 {summary['p50_ms']:8.2f} ms  p99 {summary['p99_ms']:8.2f} ms  max {summary['max_ms']:8.2f} ms")
+    for error in errors[:5]:
+        print(f"  error: {error}")
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
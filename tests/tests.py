@@ -1,17 +1,33 @@
 # Integration tests for CLI commands (assuming random.seed(0))
+import asyncio
+import collections
+import contextlib
 import os
 import json
+import gzip
+import pickle
 import io
+import random
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import sys
 
 if os.path.join(os.getcwd(), "src") not in sys.path:
     sys.path.append(os.path.join(os.getcwd(), "..", "src"))
 
 from cli.cli import FlowlogParserCLI
+from flowparser.client import QueryClient, ServerError
+from flowparser.parser import MalformedLineError, Parser
+from flowparser.server import QueryServer
+import flowparser.batch as batch
+import flowparser.index as index
+import flowparser.snapshot as snapshot
+from flowparser.sketch import CountMinSketch, HyperLogLog
 import flowparser.constants as constants
-from generator import generate_testcase
+from generator import generate_scaled, generate_testcase
 
 class TestParserCLI(unittest.TestCase):
     def setUp(self):
@@ -257,5 +273,1492 @@ class TestParserCLI(unittest.TestCase):
             except OSError:
                 pass
 
+    def test_columnar_store_round_trip(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1732930480 1732930522 - SKIPDATA\n")
+
+            self.cli.onecmd(f"load {path}")
+            store = self.cli.parser.store
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.row(0).to_dict(), {
+                "row_idx": 0, "version": "2", "account-id": "123456", "interface-id": "eni-1",
+                "srcaddr": "10.0.0.1", "dstaddr": "10.0.0.2", "srcport": "1000", "dstport": "2000",
+                "protocol": "6", "packets": "1", "bytes": "100", "start": "1600000000",
+                "end": "1600000001", "action": "ACCEPT", "log-status": "OK",
+            })
+            nodata = store.row(1)
+            self.assertIsNone(nodata.srcaddr)
+            self.assertIsNone(nodata.action)
+            self.assertEqual(getattr(nodata, "log-status"), "SKIPDATA")
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_dictionary_codes_widen_with_cardinality(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                for i in range(600):
+                    f.write(f"2 123456 eni-{i % 300} 10.0.{i % 3}.1 10.0.1.{i % 5} {1000 + i % 7} 443 6 1 100 1600000000 1600000001 {'ACCEPT' if i % 3 else 'REJECT'} OK\n")
+                    if i % 50 == 0:
+                        f.write("2 123456 eni-0 - - - - - - - 1600000000 1600000001 - NODATA\n")
+
+            parser = Parser(path=path)
+            parser.deserialize()
+            store = parser.store
+            # low-cardinality fields keep one byte per row, interface-id widened past 255 symbols
+            self.assertEqual(store.columns["action"].codes.typecode, "B")
+            self.assertEqual(store.columns["interface-id"].codes.typecode, "H")
+            self.assertEqual(store.row(611).to_dict()["interface-id"], "eni-299")
+            self.assertIs(store.row(2).action, store.row(3).action)
+
+            # shards are merged into the widened columns
+            sharded = Parser(path=path)
+            sharded.deserialize(workers=3)
+            self.assertEqual(sharded.store.columns["interface-id"].codes.typecode, "H")
+            self.assertEqual([sharded.store.get(row_idx, "interface-id") for row_idx in range(len(sharded.store))], [store.get(row_idx, "interface-id") for row_idx in range(len(store))])
+
+            for expression in ("interface-id=eni-299", "interface-id=eni-7", "interface-id=eni-1000", "action=REJECT", "srcport=1003", "srcport=-1", "dstaddr=10.0.1.4", "log-status=NODATA"):
+                field, value = expression.split("=")
+                expected = [row_idx for row_idx in range(len(store)) if store.get(row_idx, field) == value]
+                self.assertEqual(list(parser.query(expression).row_ids), expected, expression)
+                self.assertEqual(list(sharded.query(expression).row_ids), expected, expression)
+        finally:
+            os.remove(path)
+
+    def test_lazy_load_slices_fields_from_mapping(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1732930480 1732930522 - SKIPDATA\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK")
+
+            eager = Parser(path=path)
+            eager.deserialize()
+            self.cli.onecmd(f"load {path} lazy")
+            lazy = self.cli.parser
+            self.assertTrue(lazy.store.lazy)
+            self.assertNotIn("action", lazy.store.columns)
+            self.assertEqual(len(lazy.store), 3)
+            for row_idx in range(3):
+                self.assertEqual(lazy.store.row(row_idx).to_dict(), eager.store.row(row_idx).to_dict())
+            self.assertEqual(lazy.search_by_destination_ip("10.0.0.2")[1].action, "REJECT")
+            self.assertEqual(lazy.get_connection_count("10.0.0.1", "1000", "10.0.0.2", "2000", "6"), 1)
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_generated_row_class_and_decoder(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1732930480 1732930522 - SKIPDATA\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK")
+
+            eager = Parser(path=path)
+            eager.deserialize()
+            lazy = Parser(path=path, lazy=True)
+            lazy.deserialize()
+
+            # rows are slotted views of a class generated per store, with a property per field
+            row = lazy.store.row(2)
+            self.assertFalse(hasattr(row, "__dict__"))
+            self.assertIsNot(type(row), type(eager.store.row(2)))
+            self.assertEqual((row.srcaddr, row.srcport, getattr(row, "log-status"), row.packets), ("10.0.0.3", "1500", "OK", "2"))
+            self.assertEqual(getattr(eager.store.row(1), "account-id"), "123456789010")
+            with self.assertRaises(AttributeError):
+                row.vpc_id
+            # the generated functions are rebuilt when a store crosses a process boundary
+            copy = pickle.loads(pickle.dumps(eager.store))
+            self.assertEqual([copy.row(row_idx).to_dict() for row_idx in range(3)], [eager.store.row(row_idx).to_dict() for row_idx in range(3)])
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_stream_counts_only_from_gzip(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt.gz")
+        os.close(fd)
+        try:
+            with gzip.open(path, "wt") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 300 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1732930480 1732930522 - SKIPDATA\n")
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"stream {path} top=1")
+            out = self._out()
+            self.assertIn("Rows: 4 (1 without addresses)", out)
+            self.assertIn("Distinct connections: 2", out)
+            self.assertIn("10.0.0.1        400", out)
+            self.assertEqual(len(self.cli.parser.store), 0)
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("get_connection_count 10.0.0.1 1000 10.0.0.2 2000 6")
+            self.assertIn("Connection count: 2", self._out())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_follow_ingests_appended_lines(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                # an incomplete line is left for the next poll
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500")
+
+            parser = Parser(path=path)
+            self.assertEqual(parser.ingest_appended(), 1)
+            self.assertEqual(len(parser.search_by_destination_ip("10.0.0.2")), 1)
+
+            with open(path, "a") as f:
+                f.write(" 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+            self.assertEqual(parser.ingest_appended(), 2)
+            self.assertEqual(parser.ingest_appended(), 0)
+            self.assertEqual(len(parser.search_by_destination_ip("10.0.0.2")), 3)
+            self.assertEqual(list(parser.search_by_source_and_destination_ip("10.0.0.1", "10.0.0.2").row_ids), [0, 2])
+            self.assertEqual(parser.get_connection_count("10.0.0.1", "1000", "10.0.0.2", "2000", "6"), 2)
+            self.assertEqual(parser.store.row(1).to_dict()["action"], "REJECT")
+
+            # the CLI command polls in the background
+            self.cli.onecmd(f"follow {path} interval=0.01")
+            self.assertIn("Following", self._out())
+            with open(path, "a") as f:
+                f.write("2 123456 eni-1 10.0.0.9 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+            for _ in range(200):
+                if len(self.cli.parser.store) == 4:
+                    break
+                time.sleep(0.01)
+            self.cli.onecmd("unfollow")
+            self.assertEqual(len(self.cli.parser.search_by_source_ip("10.0.0.9")), 1)
+        finally:
+            self.cli.onecmd("unfollow")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_follow_after_partial_last_line(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        good = "2 123456 eni-1 10.0.0.{} 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n"
+        try:
+            for workers, skip_malformed in ((1, False), (1, True), (2, False)):
+                with open(path, "w") as f:
+                    f.write(good.format(1) + good.format(2))
+                    f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500")
+
+                parser = Parser(path=path, skip_malformed=skip_malformed)
+                parser.deserialize(workers=workers)
+                self.assertEqual(len(parser.store), 2)
+                self.assertEqual(parser.rejects, [])
+                self.assertEqual(parser.stats.errors, [])
+                with open(path, "a") as f:
+                    f.write(" 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                self.assertEqual(parser.ingest_appended(), 1)
+                self.assertEqual(parser.ingest_appended(), 0)
+                self.assertEqual([parser.store.row(row_idx).srcaddr for row_idx in range(3)], ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+                self.assertEqual(parser.lines, 3)
+                self.assertEqual(parser.rejects, [])
+
+            # a snapshot resumes before the partial line too
+            with open(path, "w") as f:
+                f.write(good.format(1) + "2 123456 eni-1 10.0.0.3 10.0.0.2 1500")
+            parser = Parser(path=path)
+            parser.deserialize()
+            parser.save_index()
+            restored = Parser(path=path)
+            self.assertTrue(restored.load_index())
+            self.assertEqual((len(restored.store), restored.offset), (1, len(good.format(1))))
+            with open(path, "a") as f:
+                f.write(" 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+            self.assertEqual(restored.ingest_appended(), 1)
+            self.assertEqual(restored.store.row(1).action, "REJECT")
+
+            # a last line that fits the schema is kept
+            with open(path, "w") as f:
+                f.write(good.format(1) + good.format(2).rstrip("\n"))
+            parser = Parser(path=path)
+            parser.deserialize()
+            self.assertEqual(len(parser.store), 2)
+            self.assertEqual(parser.ingest_appended(), 0)
+        finally:
+            os.remove(path)
+            if os.path.exists(path + ".idx"):
+                os.remove(path + ".idx")
+
+    def test_follow_stops_at_malformed_line(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        good = "2 123456 eni-1 10.0.0.{} 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n"
+        bad = "2 123456 eni-1 10.0.0.4 10.0.0.2 x 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n"
+        try:
+            with open(path, "w") as f:
+                f.write(good.format(1) + good.format(2))
+            parser = Parser(path=path)
+            parser.deserialize()
+            with open(path, "a") as f:
+                f.write(good.format(3) + bad + good.format(5))
+
+            # the rows before the bad line are kept and polls don't read them again
+            for _ in range(2):
+                with self.assertRaises(MalformedLineError) as raised:
+                    parser.ingest_appended()
+                self.assertEqual(raised.exception.line_number, 4)
+                self.assertEqual(len(parser.store), 3)
+                self.assertEqual(len(parser.search_by_destination_ip("10.0.0.2")), 3)
+
+            # the follower reports it and stops
+            self.cli.onecmd(f"load {path}")
+            self.assertEqual(self.cli.parser.stats.errors, [f"{path} line 4: invalid literal for int() with base 10: b'x'"])
+            self.assertEqual(len(self.cli.parser.store), 3)
+            self.cli.onecmd(f"follow {path} interval=0.01")
+            self.assertIn(f"Could not follow {path}: {path} line 4: ", self._out())
+            self.assertEqual(len(self.cli.parser.store), 3)
+
+            # once the line is fixed the next poll picks up from it
+            with open(path, "w") as f:
+                f.write(good.format(1) + good.format(2) + good.format(3) + bad.replace(" x ", " 1000 ") + good.format(5))
+            self.assertEqual(parser.ingest_appended(), 2)
+            self.assertEqual([parser.store.row(row_idx).srcaddr for row_idx in range(5)], [f"10.0.0.{i}" for i in range(1, 6)])
+            self.assertEqual(parser.lines, 5)
+        finally:
+            self.cli.onecmd("unfollow")
+            os.remove(path)
+
+    def test_index_snapshot_round_trip(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1732930480 1732930522 - SKIPDATA\n")
+
+            self.cli.onecmd(f"load {path}")
+            self.cli.onecmd("save_index")
+            self.assertTrue(os.path.exists(path + ".idx"))
+            loaded = self.cli.parser
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"load {path}")
+            self.assertIn("Loaded index snapshot", self._out())
+            restored = self.cli.parser
+            self.assertEqual(dict(restored.connection_counts), dict(loaded.connection_counts))
+            self.assertEqual((restored.lines, restored.offset), (3, os.path.getsize(path)))
+            self.assertEqual(dict(restored.source_and_destination_ip_index), dict(loaded.source_and_destination_ip_index))
+            for row_idx in range(3):
+                self.assertEqual(restored.store.row(row_idx).to_dict(), loaded.store.row(row_idx).to_dict())
+
+            # nor is one written in an older layout
+            with open(path + ".idx", "r+b") as f:
+                f.seek(len(snapshot.MAGIC))
+                f.write((snapshot.VERSION - 1).to_bytes(4, "little"))
+            self.assertFalse(Parser(path=path).load_index())
+            with open(path + ".idx", "r+b") as f:
+                f.seek(len(snapshot.MAGIC))
+                f.write(snapshot.VERSION.to_bytes(4, "little"))
+
+            # a snapshot for another schema or a changed file is not used
+            self.cli.onecmd("set_schema all")
+            self.assertFalse(Parser(path=path, schema=self.cli.schema).load_index())
+            with open(path, "a") as f:
+                f.write("2 123456 eni-1 10.0.0.5 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"load_index {path}")
+            self.assertIn("No valid index snapshot", self._out())
+        finally:
+            for leftover in (path, path + ".idx"):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+
+    def test_search_by_time_window(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                # long flow that started before the window and is still running inside it
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000500 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000300 1600000310 REJECT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.4 1000 2000 6 1 100 1600000350 1600000360 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000900 1600000901 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1600000320 1600000330 - NODATA\n")
+
+            self.cli.onecmd(f"load {path}")
+            parser = self.cli.parser
+            self.assertEqual(list(parser.time_postings(1600000290, 1600000400)), [0, 1, 2, 4])
+            self.assertEqual(list(parser.time_postings(1600000501, 1600000899)), [])
+            self.assertEqual(list(parser.time_postings(1600000360, 1600000360)), [0, 2])
+            # windows wider than the index walk its buckets rather than every minute in between
+            self.assertEqual(list(parser.time_postings(0, 2000000000)), [0, 1, 2, 3, 4])
+            self.assertEqual(list(parser.time_postings(1600000400, 2000000000)), [0, 3])
+            self.assertEqual(list(parser.search_by_time(1600000290, 1600000400, src_ip="10.0.0.1").row_ids), [0, 2])
+            self.assertEqual(list(parser.search_by_time(1600000000, 1600001000, src_ip="10.0.0.0/24", dst_ip="10.0.0.2").row_ids), [0, 1, 3])
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_time 2020-09-13T12:31:30 2020-09-13T12:33:20 src=10.0.0.1")
+            self.assertIn("Total results: 2", self._out())
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_time yesterday 1600000400")
+            self.assertIn("Invalid arguments", self._out())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_search_by_time_rows_out_of_start_order(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(11)
+        try:
+            flows = []
+            with open(path, "w") as f:
+                for _ in range(3000):
+                    start = 1600000000 + rng.randint(0, 20000)
+                    flows.append((f"10.2.1.{rng.randint(1, 3)}", start, start + rng.randint(0, 30)))
+                    f.write(f"2 123456 eni-1 {flows[-1][0]} 10.0.0.2 1000 2000 6 1 100 {start} {flows[-1][2]} ACCEPT OK\n")
+            parser = Parser(path=path)
+            parser.deserialize()
+            parser.cache.resize(max_entries=0)
+            for attempt in range(300):
+                low = 1600000000 + rng.randint(0, 20000)
+                high = low + (rng.randint(0, 50) if attempt % 10 else rng.randint(0, 100000))
+                expected = [row_idx for row_idx, (src, start, end) in enumerate(flows) if start <= high and end >= low]
+                self.assertEqual(list(parser.time_postings(low, high)), expected)
+                self.assertEqual(
+                    list(parser.search_by_time(low, high, src_ip="10.2.1.2").row_ids),
+                    [row_idx for row_idx in expected if flows[row_idx][0] == "10.2.1.2"], (low, high),
+                )
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_search_by_cidr_block(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.1.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.1.200 10.0.2.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                f.write("2 123456 eni-1 10.0.2.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.1.7 10.0.2.9 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+
+            self.cli.onecmd(f"load {path}")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_src 10.0.1.0/24")
+            self.assertIn("Total results: 3", self._out())
+
+            parser = self.cli.parser
+            self.assertEqual(list(parser.source_postings("10.0.1.128/25")), [1])
+            self.assertEqual(list(parser.source_postings("10.0.0.0/16")), [0, 1, 2, 3])
+            self.assertEqual(list(parser.destination_postings("10.0.2.0/24")), [1, 3])
+            self.assertEqual(list(parser.search_by_source_and_destination_ip("10.0.1.0/24", "10.0.2.0/24").row_ids), [1, 3])
+            self.assertEqual(len(parser.search_by_source_ip("192.168.0.0/16")), 0)
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_dst 10.0.2.0/33")
+            self.assertIn("Invalid IP address", self._out())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_pair_query_by_postings_intersection(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6 2 200 1600000100 1600000110 REJECT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.4 1000 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1001 2000 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+
+            with_pairs = Parser(path=path)
+            with_pairs.deserialize()
+            without_pairs = Parser(path=path, pair_index=False)
+            without_pairs.deserialize()
+            self.assertEqual(len(without_pairs.source_and_destination_ip_index), 0)
+            for src, dst in [("10.0.0.1", "10.0.0.2"), ("10.0.0.3", "10.0.0.2"), ("10.0.0.3", "10.0.0.4")]:
+                self.assertEqual(
+                    list(with_pairs.search_by_source_and_destination_ip(src, dst).row_ids),
+                    list(without_pairs.search_by_source_and_destination_ip(src, dst).row_ids),
+                )
+            self.assertEqual(list(with_pairs.search_by_source_and_destination_ip("10.0.0.1", "10.0.0.2").row_ids), [0, 3])
+            self.assertEqual(list(index.union(with_pairs.source_postings("10.0.0.3"), with_pairs.destination_postings("10.0.0.4"))), [1, 2])
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_parallel_load_matches_single_process(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(1)
+        try:
+            with open(path, "w") as f:
+                for _ in range(2000):
+                    src, dst = f"10.0.0.{rng.randint(1, 20)}", f"10.0.1.{rng.randint(1, 20)}"
+                    f.write(f"2 123456 eni-{rng.randint(1, 3)} {src} {dst} {rng.randint(1, 5)} 443 6 1 100 1600000000 1600000001 {rng.choice(['ACCEPT', 'REJECT'])} OK\n")
+
+            single = Parser(path=path)
+            single.deserialize()
+            self.cli.onecmd(f"load {path} workers=3")
+            parallel = self.cli.parser
+            self.assertEqual(len(parallel.store), 2000)
+            self.assertEqual(dict(parallel.connection_counts), dict(single.connection_counts))
+            for key, postings in single.source_and_destination_ip_index.items():
+                self.assertEqual(parallel.source_and_destination_ip_index[key], postings)
+            for row_idx in range(0, 2000, 97):
+                self.assertEqual(parallel.store.row(row_idx).to_dict(), single.store.row(row_idx).to_dict())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_query_matches_brute_force_filter(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(2)
+        try:
+            with open(path, "w") as f:
+                for _ in range(3000):
+                    if rng.random() < 0.05:
+                        f.write("2 123456 eni-1 - - - - - - - 1600000100 1600000160 - NODATA\n")
+                        continue
+                    start = 1600000000 + rng.randint(0, 3600)
+                    f.write(
+                        f"2 123456 eni-{rng.randint(1, 3)} 10.0.{rng.randint(0, 3)}.{rng.randint(1, 30)} 10.0.{rng.randint(0, 3)}.{rng.randint(1, 30)} "
+                        f"{rng.randint(1000, 1010)} {rng.choice([22, 80, 443, 8080])} 6 {rng.randint(1, 50)} 100 {start} {start + rng.randint(1, 90)} "
+                        f"{rng.choice(['ACCEPT', 'REJECT'])} OK\n"
+                    )
+
+            queries = {
+                "srcaddr=10.0.1.0/24 AND dstport=443 AND action=REJECT":
+                    lambda row: row["srcaddr"] and row["srcaddr"].startswith("10.0.1.") and row["dstport"] == "443" and row["action"] == "REJECT",
+                "srcaddr=10.0.2.7 AND dstaddr=10.0.3.9":
+                    lambda row: row["srcaddr"] == "10.0.2.7" and row["dstaddr"] == "10.0.3.9",
+                "start>=1600001000 AND start<1600001200 AND dstport!=22":
+                    lambda row: 1600001000 <= int(row["start"]) < 1600001200 and row["dstport"] not in (None, "22"),
+                "packets>45 OR interface-id=eni-2 AND action=ACCEPT":
+                    lambda row: (row["packets"] is not None and int(row["packets"]) > 45) or (row["interface-id"] == "eni-2" and row["action"] == "ACCEPT"),
+                "dstaddr!=10.0.0.0/23 AND log-status=OK":
+                    lambda row: row["dstaddr"] is not None and not row["dstaddr"].startswith(("10.0.0.", "10.0.1.")),
+                "action=DROP": lambda row: False,
+            }
+            for lazy in (False, True):
+                parser = Parser(path=path, lazy=lazy)
+                parser.deserialize()
+                rows = [parser.store.row(row_idx).to_dict() for row_idx in range(len(parser.store))]
+                for expression, predicate in queries.items():
+                    expected = [row["row_idx"] for row in rows if predicate(row)]
+                    self.assertEqual(list(parser.query(expression).row_ids), expected, expression)
+
+            parser = Parser(path=path)
+            parser.deserialize()
+            plan = parser.explain("srcaddr=10.0.1.5 AND dstaddr=10.0.2.0/24 AND action=REJECT")
+            self.assertIn("index source_ip_index srcaddr=10.0.1.5", plan[0])
+            self.assertIn("filter action=REJECT (column)", plan[-1])
+
+            self.cli.onecmd(f"load {path}")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("query dstport=443 AND srcaddr=10.0.0.0/24 and action=ACCEPT")
+            expected = sum(1 for row in rows if row["dstport"] == "443" and row["srcaddr"] and row["srcaddr"].startswith("10.0.0.") and row["action"] == "ACCEPT")
+            self.assertIn(f"Total results: {expected}", self._out())
+
+            for bad in ("dstport>>443", "nonsense=1", "srcaddr<10.0.0.0/8", "dstport=https", ""):
+                self.stdout.truncate(0); self.stdout.seek(0)
+                self.cli.onecmd(f"query {bad}")
+                self.assertIn("Invalid query", self._out())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_aggregate_group_by_top_n(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(3)
+        try:
+            with open(path, "w") as f:
+                for _ in range(2000):
+                    if rng.random() < 0.05:
+                        f.write("2 123456 eni-1 - - - - - - - 1600000100 1600000160 - NODATA\n")
+                        continue
+                    f.write(
+                        f"2 123456 eni-{rng.randint(1, 3)} 10.0.0.{rng.randint(1, 10)} 10.0.1.{rng.randint(1, 10)} "
+                        f"{rng.randint(1000, 1010)} {rng.choice([22, 80, 443, 8080, 3306])} 6 {rng.randint(1, 50)} {rng.randint(40, 9000)} "
+                        f"1600000000 1600000010 {rng.choice(['ACCEPT', 'REJECT'])} OK\n"
+                    )
+
+            for lazy in (False, True):
+                parser = Parser(path=path, lazy=lazy)
+                parser.deserialize()
+                rows = [parser.store.row(row_idx).to_dict() for row_idx in range(len(parser.store))]
+
+                expected = collections.defaultdict(int)
+                for row in rows:
+                    if row["action"] == "REJECT":
+                        expected[int(row["dstport"])] += int(row["bytes"])
+                top = parser.aggregate(["dstport"], ["sum(bytes)"], where="action=REJECT", top=3)
+                self.assertEqual([(row["dstport"], row["sum(bytes)"]) for row in top], sorted(expected.items(), key=lambda item: -item[1])[:3])
+
+                groups = collections.defaultdict(list)
+                for row in rows:
+                    groups[(row["srcaddr"], row["action"])].append(row["packets"])
+                results = parser.aggregate(["srcaddr", "action"], ["count", "min(packets)", "max(packets)"])
+                self.assertEqual(len(results), len(groups))
+                for result in results:
+                    packets = [int(value) for value in groups[(result["srcaddr"], result["action"])] if value is not None]
+                    self.assertEqual(result["count"], len(groups[(result["srcaddr"], result["action"])]))
+                    self.assertEqual(result["min(packets)"], min(packets) if packets else None)
+                    self.assertEqual(result["max(packets)"], max(packets) if packets else None)
+                self.assertEqual([result["count"] for result in results], sorted((result["count"] for result in results), reverse=True))
+
+            self.cli.onecmd(f"load {path}")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("aggregate dstport sum(bytes) top=2 where action=REJECT")
+            self.assertIn("Total groups: 2", self._out())
+            for bad in ("aggregate dstport sum(action)", "aggregate nonsense", "aggregate dstport count order=sum(bytes)"):
+                self.stdout.truncate(0); self.stdout.seek(0)
+                self.cli.onecmd(bad)
+                self.assertIn("Invalid arguments", self._out())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_search_output_formats_and_paging(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        out_dir = tempfile.mkdtemp()
+        try:
+            with open(path, "w") as f:
+                for i in range(50):
+                    f.write(f"2 123456 eni-1 10.0.0.1 10.0.1.{i % 5} {1000 + i} 443 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+                f.write("2 123456 eni-1 10.0.0.2 10.0.1.1 999 443 6 1 100 1600000000 1600000001 REJECT OK\n")
+            self.cli.onecmd(f"load {path}")
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            ndjson_path = os.path.join(out_dir, "rows.ndjson")
+            self.cli.onecmd(f"search_src 10.0.0.1 {ndjson_path} quiet")
+            self.assertNotIn("srcport", self._out())
+            self.assertIn("Total results: 50", self._out())
+            with open(ndjson_path) as f:
+                rows = [json.loads(line) for line in f]
+            self.assertEqual([row["srcport"] for row in rows], [str(1000 + i) for i in range(50)])
+
+            csv_path = os.path.join(out_dir, "rows.out")
+            self.cli.onecmd(f"search_src_dst 10.0.0.1 10.0.1.0/24 {csv_path} format=csv offset=10 limit=5 quiet")
+            with open(csv_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0].split(",")[:4], ["row_idx", "version", "account-id", "interface-id"])
+            self.assertEqual([line.split(",")[0] for line in lines[1:]], ["10", "11", "12", "13", "14"])
+
+            json_path = os.path.join(out_dir, "rows.json")
+            self.cli.onecmd(f"query dstport=443 AND action=REJECT INTO {json_path} quiet")
+            with open(json_path) as f:
+                self.assertEqual([row["srcaddr"] for row in json.load(f)], ["10.0.0.2"])
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_dst 10.0.1.1 count")
+            self.assertEqual(self._out().strip(), "Total results: 11")
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_dst 10.0.1.1 limit=2")
+            self.assertIn("Returned: 2 (offset 0)", self._out())
+            self.assertEqual(self._out().count("row_idx"), 2)
+
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_dst 10.0.1.1 format=xml")
+            self.assertIn("Invalid arguments", self._out())
+        finally:
+            for name in os.listdir(out_dir):
+                os.remove(os.path.join(out_dir, name))
+            os.rmdir(out_dir)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_load_compressed_input(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(4)
+        try:
+            lines = [
+                f"2 123456 eni-1 10.0.0.{rng.randint(1, 20)} 10.0.1.{rng.randint(1, 20)} {rng.randint(1000, 1100)} 443 6 1 100 1600000000 1600000001 {rng.choice(['ACCEPT', 'REJECT'])} OK\n"
+                for _ in range(3000)
+            ]
+            with open(path, "w") as f:
+                f.writelines(lines)
+            plain = Parser(path=path)
+            plain.deserialize()
+
+            # one member, and many members (as written by concatenating hourly exports) whose first
+            # header carries a file name containing a fake member signature
+            single = path + ".gz"
+            with gzip.open(single, "wb") as f:
+                f.write("".join(lines).encode())
+            multi = path + ".multi"
+            with open(multi, "wb") as f:
+                for i in range(0, len(lines), 500):
+                    member = io.BytesIO()
+                    with gzip.GzipFile(filename="hour\x1f\x8b\x08\x04" if i == 0 else "", mode="wb", fileobj=member) as gz:
+                        # members split lines mid-way too
+                        gz.write("".join(lines[i:i + 500]).encode()[:-7] if i + 500 < len(lines) else "".join(lines[i:i + 500]).encode())
+                        if i + 500 < len(lines):
+                            gz.write("".join(lines[i:i + 500]).encode()[-7:])
+                    f.write(member.getvalue())
+
+            for compressed, workers in ((single, 1), (multi, 1), (multi, 3)):
+                parser = Parser(path=compressed, lazy=True)
+                self.assertEqual(parser.compression, "gzip")
+                self.assertFalse(parser.lazy)
+                parser.deserialize(workers=workers)
+                self.assertEqual(len(parser.store), 3000)
+                self.assertEqual(dict(parser.connection_counts), dict(plain.connection_counts))
+                for row_idx in range(0, 3000, 199):
+                    self.assertEqual(parser.store.row(row_idx).to_dict(), plain.store.row(row_idx).to_dict())
+
+            # a truncated file is reported and leaves no partial rows
+            with open(single, "rb") as f:
+                data = f.read()
+            with open(single, "wb") as f:
+                f.write(data[:len(data) // 2])
+            parser = Parser(path=single)
+            parser.deserialize()
+            self.assertEqual(len(parser.store), len(parser.store.columns["srcaddr"]))
+            with self.assertRaises(ValueError):
+                parser.ingest_appended()
+        finally:
+            for name in (path, path + ".gz", path + ".multi"):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+    def test_load_directory_and_glob(self):
+        directory = tempfile.mkdtemp()
+        rng = random.Random(5)
+        try:
+            all_lines = []
+            for eni in range(1, 4):
+                for interval in range(3):
+                    start = 1600000000 + interval * 300
+                    lines = [
+                        f"2 123456 eni-{eni} 10.0.0.{rng.randint(1, 9)} 10.0.1.{rng.randint(1, 9)} {rng.randint(1000, 1100)} 443 6 1 100 "
+                        f"{start + rng.randint(0, 290)} {start + 299} {rng.choice(['ACCEPT', 'REJECT'])} OK\n"
+                        for _ in range(40)
+                    ]
+                    name = os.path.join(directory, f"eni-{eni}_{interval}.log")
+                    if eni == 3 and interval == 2:
+                        with gzip.open(name + ".gz", "wb") as f:
+                            f.write("".join(lines).encode())
+                    else:
+                        with open(name, "w") as f:
+                            f.writelines(lines)
+                    all_lines.extend(lines)
+            combined = os.path.join(directory, "combined.txt")
+            with open(combined, "w") as f:
+                f.writelines(all_lines)
+            single = Parser(path=combined)
+            single.deserialize()
+            os.remove(combined)
+
+            for lazy, workers in ((False, 1), (True, 2)):
+                parser = Parser(path=directory, lazy=lazy)
+                parser.deserialize(workers=workers)
+                self.assertEqual(len(parser.files), 9)
+                self.assertEqual(len(parser.store), 360)
+                self.assertEqual(dict(parser.connection_counts), dict(single.connection_counts))
+                self.assertEqual(list(parser.search_by_source_ip("10.0.0.3").row_ids), list(single.search_by_source_ip("10.0.0.3").row_ids))
+                row = parser.store.row(130).to_dict()
+                self.assertEqual(row["file"], os.path.join(directory, "eni-2_0.log"))
+                self.assertEqual(row["srcaddr"], single.store.row(130).srcaddr)
+
+                for expression in ("interface-id=eni-2 AND action=REJECT", "start>=1600000600 AND dstport=443", "end<1600000300 OR interface-id=eni-3"):
+                    self.assertEqual(list(parser.query(expression).row_ids), list(single.query(expression).row_ids), expression)
+                self.assertIn("scan 3 of 9 files (120 rows)", parser.explain("interface-id=eni-2 AND action=REJECT")[0])
+                self.assertIn("restrict to 1 of 9 files (40 rows)", parser.explain("interface-id=eni-1 AND start>=1600000600")[1])
+
+            # lazy loads of more files than LAZY_MAX_FILES are decoded eagerly rather than kept mapped
+            for max_files, lazy in ((3, True), (2, False)):
+                with mock.patch("flowparser.parser.LAZY_MAX_FILES", max_files):
+                    parser = Parser(path=os.path.join(directory, "eni-1_*"), lazy=True)
+                    parser.deserialize()
+                self.assertEqual((parser.lazy, parser.store.lazy), (lazy, lazy))
+                self.assertEqual(parser.store.sources.count(None), 0 if lazy else 3)
+                self.assertEqual([parser.store.get(row_idx, "action") for row_idx in range(120)], [single.store.get(row_idx, "action") for row_idx in range(120)])
+
+            self.cli.onecmd(f"load {os.path.join(directory, 'eni-1_*')}")
+            self.assertIn("Loaded 3 files (120 rows)", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("files")
+            self.assertRegex(self._out(), r"eni-1_2.log  rows 80..119  time 16000006\d\d..1600000899  eni-1")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("save_index")
+            self.assertIn("Could not write index snapshot", self._out())
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_scaled_generator_cardinality_and_skew(self):
+        path = generate_scaled("temp_scaled_flowlogs.txt", target_size_mb=0.2, hosts=20, ports=5, skew=1.5, nodata=0.0)
+        try:
+            parser = Parser(path=path)
+            parser.deserialize()
+            self.assertLessEqual(len(parser.source_ip_index), 20)
+            self.assertLessEqual(len(set(parser.store.columns["dstport"].values)), 5)
+            sizes = sorted((len(postings) for postings in parser.source_ip_index.values()), reverse=True)
+            # with skew 1.5 the most popular host sees far more flows than the median one
+            self.assertGreater(sizes[0], 5 * sizes[len(sizes) // 2])
+            # same seed, same file
+            with open(path) as f:
+                first = f.read()
+            generate_scaled("temp_scaled_flowlogs.txt", target_size_mb=0.2, hosts=20, ports=5, skew=1.5, nodata=0.0)
+            with open(path) as f:
+                self.assertEqual(f.read(), first)
+        finally:
+            os.remove(path)
+
+    def test_stats_and_profile_commands(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                for i in range(200):
+                    f.write(f"2 123456 eni-1 10.0.0.{i % 7} 10.0.1.{i % 5} {1000 + i} 443 6 1 100 1600000000 1600000060 ACCEPT OK\n")
+                f.write("2 123456789010 eni-ab12cd34ef5678901 - - - - - - - 1600000320 1600000330 - NODATA\n")
+
+            self.cli.onecmd("stats")
+            self.assertIn("No flow logs loaded", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            self.cli.onecmd(f"profile top=5 load {path}")
+            output = self._out()
+            self.assertIn("Parsed 201 rows", output)
+            self.assertIn("Hottest functions of 'load", output)
+            self.assertIn("Ordered by: internal time", output)
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            stats = self.cli.parser.stats
+            self.assertEqual(stats.counters["rows"], 201)
+            self.assertEqual(stats.counters["rows_without_addresses"], 1)
+            self.assertEqual(stats.counters["bytes"], os.path.getsize(path))
+            self.assertGreater(stats.phases["load"], 0)
+            # rows 0, 64, 128 and 192 are timed
+            self.assertEqual(stats.samples, 4)
+
+            self.cli.onecmd("stats")
+            output = self._out()
+            self.assertIn("Rows parsed: 201 (1 without addresses, 0 malformed)", output)
+            self.assertRegex(output, r"tokenize +~")
+            self.assertIn("source_ip_index", output)
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            self.cli.onecmd("stats json")
+            report = json.loads(self._out())
+            self.assertEqual(report["counters"]["rows"], 201)
+            self.assertGreater(report["memory_bytes"]["column.srcaddr"], 0)
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            self.cli.onecmd("profile tracemalloc top=3 search_src 10.0.0.0/24 quiet")
+            output = self._out()
+            self.assertIn("Total results: 200", output)
+            self.assertIn("Memory of 'search_src 10.0.0.0/24 quiet'", output)
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            self.cli.onecmd("profile top=3")
+            self.assertIn("Invalid arguments", self._out())
+        finally:
+            os.remove(path)
+
+    def test_skip_malformed_lines(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rejects = path + ".rejects"
+        good = "2 123456 eni-1 10.0.0.{} 10.0.0.2 1000 2000 6 1 100 1600000000 1600000500 ACCEPT OK\n"
+        try:
+            with open(path, "w") as f:
+                for i in range(100):
+                    f.write(good.format(i % 5))
+                    if i == 10:
+                        f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500\n")
+                    elif i == 20:
+                        f.write("\n")
+                    elif i == 30:
+                        f.write("2 123456 eni-1 10.0.0.999 10.0.0.4 1000 2000 6 1 100 1600000350 1600000360 ACCEPT OK\n")
+                    elif i == 40:
+                        f.write("2 123456 eni-1 10.0.0.1 10.0.0.4 abc 2000 6 1 100 1600000350 1600000360 ACCEPT OK\n")
+                # still being written: left for follow rather than rejected
+                f.write("2 123456 eni-1 10.0.0.1 10.0.0.2 1000 2000 6 1 100 16000")
+
+            # without skip_malformed the load stops at the first bad line
+            self.cli.onecmd(f"load {path}")
+            self.assertEqual(self.cli.parser.stats.errors, [f"{path} line 12: not enough fields in line"])
+            self.assertEqual(len(self.cli.parser.store), 11)
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            for workers in (1, 3):
+                self.cli.onecmd(f"load {path} workers={workers} rejects={rejects}")
+                output = self._out()
+                self.assertIn("Parsed 100 rows", output)
+                self.assertIn(f"Skipped 3 malformed lines, the first at {path} line 12", output)
+                self.stdout.truncate(0); self.stdout.seek(0)
+                parser = self.cli.parser
+                self.assertEqual(parser.lines, 104)
+                self.assertEqual(parser.stats.counters["blank_lines"], 1)
+                self.assertEqual({len(column) for column in parser.store.columns.values()}, {100})
+                self.assertEqual(len(parser.search_by_source_ip("10.0.0.1")), 20)
+                self.assertEqual(sum(parser.connection_counts.values()), 100)
+                with open(rejects) as f:
+                    rows = [line.rstrip("\n").split("\t") for line in f]
+                self.assertEqual([row[1] for row in rows], ["12", "34", "45"])
+                self.assertEqual(rows[1][2], "illegal IP address string passed to inet_aton")
+                self.assertTrue(rows[2][3].startswith("2 123456 eni-1 10.0.0.1 10.0.0.4 abc"))
+                self.assertEqual({row[0] for row in rows}, {path})
+
+            # a snapshot holds no rejected lines, so rejects= reparses instead of loading it
+            self.cli.onecmd("save_index")
+            os.remove(rejects)
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"load {path} rejects={rejects}")
+            output = self._out()
+            self.assertNotIn("Loaded index snapshot", output)
+            self.assertIn(f"Wrote 3 rejected lines to {rejects}", output)
+            with open(rejects) as f:
+                self.assertEqual(len(f.readlines()), 3)
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"load {path}")
+            self.assertIn("Loaded index snapshot", self._out())
+        finally:
+            os.remove(path)
+            if os.path.exists(rejects):
+                os.remove(rejects)
+            if os.path.exists(path + ".idx"):
+                os.remove(path + ".idx")
+
+    def test_ipv6_addresses_are_loaded(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "dual_stack.log")
+        lines = [
+            "2 123456 eni-1 10.0.0.1 10.0.0.2 1000 443 6 1 100 1600000000 1600000001 ACCEPT OK\n",
+            "2 123456 eni-1 2001:db8::1 2001:db8::2 1000 443 6 2 200 1600000010 1600000011 ACCEPT OK\n",
+            "2 123456 eni-1 10.0.0.1 2001:db8::2 1000 443 6 3 300 1600000020 1600000021 REJECT OK\n",
+            "2 123456 eni-1 2001:db8::1 10.0.0.2 1000 443 6 4 400 1600000030 1600000031 ACCEPT OK\n",
+        ]
+        try:
+            with open(path, "w") as f:
+                f.writelines(lines)
+
+            for lazy, workers in ((False, 1), (True, 1), (False, 2)):
+                parser = Parser(path=path, lazy=lazy, rollups=["srcaddr"])
+                parser.deserialize(workers=workers)
+                self.assertEqual(parser.stats.errors, [])
+                self.assertEqual([parser.store.row(row_idx).srcaddr for row_idx in range(4)], ["10.0.0.1", "2001:db8::1", "10.0.0.1", "2001:db8::1"])
+                self.assertEqual(parser.store.row(2).to_dict()["dstaddr"], "2001:db8::2")
+
+                # the IPv4 indexes and connection counts leave them out, searches scan the column instead
+                self.assertEqual((len(parser.source_ip_index), len(parser.destination_ip_index)), (1, 1))
+                self.assertEqual(parser.get_connection_count("10.0.0.1", "1000", "10.0.0.2", "443", "6"), 1)
+                self.assertEqual(sum(parser.connection_counts.values()), 1)
+                self.assertEqual(list(parser.search_by_source_ip("2001:db8::1").row_ids), [1, 3])
+                self.assertEqual(list(parser.search_by_destination_ip("2001:db8::2").row_ids), [1, 2])
+                self.assertEqual(list(parser.search_by_source_and_destination_ip("10.0.0.1", "2001:db8::2").row_ids), [2])
+                self.assertEqual(list(parser.search_by_source_ip("2001:db8::9").row_ids), [])
+
+                self.assertEqual(list(parser.query("srcaddr=2001:db8::1").row_ids), [1, 3])
+                self.assertEqual(list(parser.query("srcaddr!=2001:db8::1").row_ids), [0, 2])
+                self.assertEqual(list(parser.query("dstaddr=0.0.0.0/0").row_ids), [0, 3])
+                self.assertEqual(list(parser.query("dstaddr!=10.0.0.0/8").row_ids), [1, 2])
+                self.assertEqual(list(parser.query("srcaddr>=10.0.0.0").row_ids), [0, 2])
+                self.assertEqual(
+                    parser.aggregate(["srcaddr"], ["sum(bytes)"]),
+                    [{"srcaddr": "2001:db8::1", "sum(bytes)": 600}, {"srcaddr": "10.0.0.1", "sum(bytes)": 400}],
+                )
+                self.assertEqual(
+                    [(total["srcaddr"], total["bytes"]) for total in parser.get_rollup("srcaddr").totals()],
+                    [("2001:db8::1", 600), ("10.0.0.1", 400)],
+                )
+
+            # snapshots keep them
+            parser.save_index()
+            restored = Parser(path=path)
+            self.assertTrue(restored.load_index())
+            self.assertEqual(restored.store.row(3).srcaddr, "2001:db8::1")
+            self.assertEqual(list(restored.search_by_source_ip("2001:db8::1").row_ids), [1, 3])
+            os.remove(path + ".idx")
+
+            # merged files share one table of IPv6 addresses
+            with open(os.path.join(directory, "other.log"), "w") as f:
+                f.write("2 123456 eni-2 2001:db8::3 2001:db8::1 1000 443 6 1 100 1600000040 1600000041 ACCEPT OK\n")
+                f.write(lines[1])
+            parser = Parser(path=os.path.join(directory, "*.log"))
+            parser.deserialize()
+            self.assertEqual([parser.store.row(row_idx).srcaddr for row_idx in range(6)], ["10.0.0.1", "2001:db8::1", "10.0.0.1", "2001:db8::1", "2001:db8::3", "2001:db8::1"])
+            self.assertEqual(list(parser.search_by_source_ip("2001:db8::1").row_ids), [1, 3, 5])
+            self.assertEqual(list(parser.search_by_destination_ip("2001:db8::1").row_ids), [4])
+
+            self.cli.onecmd(f"stream {path}")
+            self.assertIn("Rows: 4 (3 without addresses)", self._out())
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_field_count_checked_per_line(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        good = "2 123456 eni-1 10.0.0.{} 10.0.0.2 1000 2000 6 1 100 1600000000 1600000500 ACCEPT OK\n"
+        try:
+            with open(path, "w") as f:
+                f.write(good.format(1))
+                # cut off right after the indexed fields, which is all a lazy load splits out
+                f.write("2 123456 eni-1 10.0.0.3 10.0.0.2 1500 2500 6\n")
+                f.write(good.format(2))
+                f.write(good.format(3).replace(" OK", " OK EXTRA"))
+                f.write(good.format(3))
+
+            for lazy in (False, True):
+                parser = Parser(path=path, lazy=lazy, skip_malformed=True)
+                parser.deserialize()
+                self.assertEqual([(line_number, reason) for _, line_number, reason, _ in parser.rejects], [(2, "not enough fields in line"), (4, "too many fields in line")])
+                self.assertEqual([parser.store.row(row_idx).to_dict()["srcaddr"] for row_idx in range(len(parser.store))], ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+
+            self.cli.onecmd(f"load {path} lazy skip_malformed")
+            self.assertIn("Skipped 2 malformed lines", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("search_src 10.0.0.3")
+            self.assertIn("Total results: 1", self._out())
+        finally:
+            os.remove(path)
+
+    def test_schema_from_header_line(self):
+        fields = ["version", "vpc-id", "srcaddr", "dstaddr", "srcport", "dstport", "protocol", "start", "end", "action", "tcp-flags"]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "custom.log")
+        lines = ["version vpc-id srcaddr dstaddr srcport dstport protocol start end action tcp-flags\n"]
+        for i in range(300):
+            lines.append(f"5 vpc-{i % 3} 10.0.0.{i % 7} 10.0.1.{i % 11} {1000 + i} 443 6 1600000000 1600000060 {'REJECT' if i % 4 else 'ACCEPT'} {i % 32}\n")
+        lines.insert(101, "5 vpc-0 10.0.0.1\n")
+        try:
+            with open(path, "w") as f:
+                f.writelines(lines)
+            with gzip.open(path + ".gz", "wb") as f:
+                f.write("".join(lines).encode())
+
+            # the header wins over the schema set on the CLI
+            self.cli.onecmd("set_schema default")
+            self.cli.onecmd(f"load {path} skip_malformed")
+            self.assertIn("Schema read from header: " + " ".join(fields), self._out())
+            self.assertIn("Parsed 300 rows", self._out())
+            self.assertIn(f"{path} line 102: not enough fields in line", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+            expected = dict(self.cli.parser.connection_counts)
+            self.assertEqual(self.cli.parser.store.row(0).to_dict()["vpc-id"], "vpc-0")
+
+            for source, options in ((path, "workers=3 lazy"), (path + ".gz", "")):
+                parser = Parser(path=source, lazy="lazy" in options, skip_malformed=True)
+                parser.deserialize(workers=3 if "workers" in options else 1)
+                self.assertEqual(parser.schema, fields)
+                self.assertEqual(len(parser.store), 300)
+                self.assertEqual([reject[1] for reject in parser.rejects], [102])
+                self.assertEqual(dict(parser.connection_counts), expected)
+                self.assertEqual(list(parser.query("vpc-id=vpc-1 AND action=ACCEPT AND tcp-flags<8").row_ids), list(self.cli.parser.query("vpc-id=vpc-1 AND action=ACCEPT AND tcp-flags<8").row_ids))
+                self.assertEqual(parser.store.row(299).to_dict()["tcp-flags"], "11")
+
+            os.remove(path + ".gz")
+            del lines[101]
+            with open(path, "w") as f:
+                f.writelines(lines)
+            self.cli.onecmd(f"stream {path}")
+            self.assertIn("Rows: 300 (0 without addresses)", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+
+            # files of one load must share their fields
+            with open(os.path.join(directory, "other.log"), "w") as f:
+                f.write("srcaddr dstaddr srcport dstport protocol\n10.0.0.1 10.0.0.2 1000 2000 6\n")
+            parser = Parser(path=directory)
+            parser.deserialize()
+            self.assertIn("other.log has fields srcaddr dstaddr srcport dstport protocol, expected version vpc-id", parser.stats.errors[0])
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_query_server_and_client(self):
+        directory = tempfile.mkdtemp()
+        first, second = os.path.join(directory, "first.log"), os.path.join(directory, "second.log")
+        with open(first, "w") as f:
+            for i in range(2500):
+                f.write(f"2 123456 eni-1 10.0.0.{i % 3} 10.0.1.{i % 7} {1000 + i % 11} {443 if i % 2 else 80} 6 1 {i} {1600000000 + i} {1600000010 + i} {'REJECT' if i % 5 else 'ACCEPT'} OK\n")
+        with open(second, "w") as f:
+            f.write("2 123456 eni-1 10.0.9.9 10.0.1.1 1000 443 6 1 100 1600000000 1600000010 ACCEPT OK\n")
+        parser = Parser(path=first, rollups=["dstport"])
+        parser.deserialize()
+        loop = asyncio.new_event_loop()
+        server = QueryServer(parser)
+        listener = loop.run_until_complete(server.start("127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            with QueryClient("127.0.0.1", listener.sockets[0].getsockname()[1]) as client:
+                # 1667 rows are streamed back in two chunks
+                rows = list(client.search_src("10.0.0.0/24", limit=2000, offset=833))
+                self.assertEqual([row["row_idx"] for row in rows], list(parser.search_by_source_ip("10.0.0.0/24").row_ids[833:]))
+                self.assertEqual(rows[0], parser.store.row(rows[0]["row_idx"]).to_dict())
+                self.assertEqual(len(list(client.search_src_dst("10.0.0.1", "10.0.1.3"))), len(parser.search_by_source_and_destination_ip("10.0.0.1", "10.0.1.3")))
+                self.assertEqual(len(list(client.search_time(1600000100, 1600000200, src="10.0.0.2"))), len(parser.search_by_time(1600000100, 1600000200, src_ip="10.0.0.2")))
+                expression = "dstport=443 AND action=ACCEPT AND bytes<1000"
+                self.assertEqual([row["row_idx"] for row in client.query(expression)], list(parser.query(expression).row_ids))
+                self.assertEqual(client.aggregate(["dstport"], ["count", "sum(bytes)"], where="action=REJECT", top=1), parser.aggregate(["dstport"], ["count", "sum(bytes)"], where="action=REJECT", top=1))
+                self.assertEqual(client.get_connection_count("10.0.0.1", 1001, "10.0.1.1", 443, 6), parser.get_connection_count("10.0.0.1", "1001", "10.0.1.1", "443", "6"))
+                self.assertIn("index source_ip_index", client.explain("srcaddr=10.0.0.1 AND dstport=80")[0])
+                self.assertEqual(client.rollup("dstport", last=600, order="flows"), parser.get_rollup("dstport").totals(*parser.get_rollup("dstport").last_window(600), order_by="flows"))
+
+                with self.assertRaises(ServerError) as error:
+                    list(client.query("nosuchfield=1"))
+                self.assertEqual(error.exception.status, 400)
+                with self.assertRaises(ServerError) as error:
+                    list(client.search_src("10.0.0.300"))
+                self.assertIn("invalid IP address", str(error.exception))
+                with self.assertRaises(ServerError) as error:
+                    client.rollup("srcaddr")
+                self.assertIn("no rollup 'srcaddr'", str(error.exception))
+                # an unexpected error in a handler is answered with a 500
+                explain, parser.explain = parser.explain, lambda expression: {}[expression]
+                with self.assertRaises(ServerError) as error:
+                    client.explain("dstport=80")
+                parser.explain = explain
+                self.assertEqual((error.exception.status, str(error.exception)), (500, "500: KeyError: 'dstport=80'"))
+                # the connection is still usable after errors
+                self.assertEqual(client.stats()["rows"], 2500)
+
+                self.assertEqual(client.load(second)["rows"], 1)
+                self.assertEqual([row["srcaddr"] for row in client.query("dstport=443")], ["10.0.9.9"])
+                # the new file keeps the server's rollups
+                self.assertEqual(client.rollup("dstport", by="time"), [{"start": 1600000000 // 60 * 60, "time": "2020-09-13T12:26:00Z", "flows": 1, "packets": 1, "bytes": 100}])
+                self.assertEqual(client.stats()["requests"], 17)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+            loop.close()
+            server.executor.shutdown()
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_result_cache(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        out_path = path + ".json"
+        try:
+            with open(path, "w") as f:
+                for i in range(300):
+                    f.write(f"2 123456 eni-1 10.0.0.{i % 5} 10.0.1.{i % 3} 1000 {443 if i % 2 else 80} 6 1 {i} {1600000000 + i} {1600000010 + i} {'REJECT' if i % 7 else 'ACCEPT'} OK\n")
+            parser = Parser(path=path)
+            parser.deserialize()
+
+            # equivalent arguments and expressions share an entry
+            first = parser.search_by_source_ip("10.0.0.0/24")
+            self.assertIs(parser.search_by_source_ip("10.0.0.77/24"), first)
+            self.assertEqual(len(first), 300)
+            rejected = parser.query("dstport=443 AND action=REJECT")
+            self.assertIs(parser.query("action=REJECT  and dstport=443"), rejected)
+            self.assertIsNot(parser.query("dstport=443 AND action=ACCEPT"), rejected)
+            self.assertIs(parser.search_by_time(1600000050, 1600000100), parser.search_by_time(1600000050, 1600000100))
+            self.assertEqual(parser.cache.to_dict()["hits"], 3)
+            self.assertEqual(len(parser.cache), 4)
+
+            # least recently used entries go first, by count and by bytes
+            parser.cache.resize(max_entries=2)
+            self.assertEqual(len(parser.cache), 2)
+            self.assertIsNot(parser.search_by_source_ip("10.0.0.0/24"), first)
+            parser.cache.resize(max_entries=256, max_bytes=1)
+            self.assertEqual((len(parser.cache), parser.cache.bytes), (0, 0))
+            self.assertEqual(parser.cache.to_dict()["evictions"], 5)
+            parser.cache.resize(max_bytes=2**20)
+
+            # appended rows empty the cache, results reflect them
+            pair = parser.search_by_source_and_destination_ip("10.0.0.1", "10.0.1.1")
+            with open(path, "a") as f:
+                f.write("2 123456 eni-1 10.0.0.1 10.0.1.1 1000 443 6 1 5 1600000000 1600000010 REJECT OK\n")
+            self.assertEqual(parser.ingest_appended(), 1)
+            self.assertEqual(len(parser.cache), 0)
+            self.assertEqual(len(parser.search_by_source_and_destination_ip("10.0.0.1", "10.0.1.1")), len(pair) + 1)
+            self.assertEqual(len(parser.query("dstport=443 AND action=REJECT")), len(rejected) + 1)
+
+            # printed and exported rows are cached with the result and match the uncached output
+            self.cli.onecmd(f"load {path}")
+            self.cli.onecmd("cache entries=0")
+            self.stdout.seek(0)
+            self.stdout.truncate()
+            self.cli.onecmd("search_src 10.0.0.3 limit=5 offset=2")
+            self.cli.onecmd(f"query srcaddr=10.0.0.3 AND dstport=80 INTO {out_path} format=csv quiet")
+            with open(out_path) as f:
+                exported = f.read()
+            uncached = self._out()
+            self.stdout.seek(0)
+            self.stdout.truncate()
+            self.cli.onecmd("cache entries=100")
+            self.stdout.seek(0)
+            self.stdout.truncate()
+            for _ in range(2):
+                self.cli.onecmd("search_src 10.0.0.3 limit=5 offset=2")
+                self.cli.onecmd(f"query srcaddr=10.0.0.3 AND dstport=80 INTO {out_path} format=csv quiet")
+                with open(out_path) as f:
+                    self.assertEqual(f.read(), exported)
+            self.assertEqual(self._out(), uncached * 2)
+            self.assertEqual(sorted(key[0] for key in self.cli.parser.cache.entries), ["exported", "printed", "query", "search_src"])
+            self.cli.onecmd("cache")
+            self.assertIn("Hits: 4, misses: 8 (hit rate 33.3%)", self._out())
+
+            # a new load starts with an empty cache of the configured size
+            self.cli.onecmd(f"load {path}")
+            self.assertEqual((len(self.cli.parser.cache), self.cli.parser.cache.max_entries), (0, 100))
+            self.cli.onecmd("cache clear entries=-1")
+            self.assertIn("Invalid arguments", self._out())
+        finally:
+            for name in (path, out_path):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def test_batch_queries_from_file(self):
+        directory = tempfile.mkdtemp()
+        path, queries_path, out_dir = (os.path.join(directory, name) for name in ("flow.log", "queries.txt", "out"))
+        try:
+            with open(path, "w") as f:
+                for i in range(400):
+                    f.write(f"2 123456 eni-1 10.0.{i % 2}.{i % 9} 10.0.1.{i % 4} {1000 + i % 40} {i % 25} 6 1 {i} {1600000000 + i} {1600000010 + i} {'REJECT' if i % 3 else 'ACCEPT'} OK\n")
+            self.cli.onecmd(f"load {path}")
+            parser = self.cli.parser
+            queries = [
+                "search_src 10.0.0.4",
+                "search_dst 10.0.1.0/30",
+                "# comments and blank lines are skipped",
+                "",
+                "search_src 10.0.1.0/24",
+                "search_src_dst 10.0.0.2 10.0.1.2",
+                "search_src_dst 10.0.0.0/24 10.0.1.2",
+                "search_time 1600000100 1600000150 src=10.0.1.0/24",
+                "get_connection_count 10.0.0.4 1004 10.0.1.0 4 6",
+                "query action=REJECT AND dstport<10 OR srcport=1003",
+                "search_src   10.0.0.4",
+                "query dstport<10 AND action=REJECT OR srcport=1003",
+                "search_src 10.0.0.300",
+                "query tcp-flags=2",
+            ]
+            # enough equality scans of one column to share a pass over it
+            queries += [f"query dstport={port}" for port in range(20)] + ["query dstport=3 AND action=ACCEPT"]
+            with open(queries_path, "w") as f:
+                f.write("\n".join(queries) + "\n")
+
+            self.cli.onecmd(f"batch {queries_path} {out_dir} format=ndjson")
+            self.assertIn(f"Answered {len(queries) - 4} of {len(queries) - 2} queries ({len(queries) - 5} distinct)", self._out())
+            self.assertIn("2 queries failed", self._out())
+            with open(os.path.join(out_dir, "summary.tsv")) as f:
+                summary = [line.rstrip("\n").split("\t") for line in f][1:]
+            self.assertEqual([int(entry[0]) for entry in summary], [i + 1 for i, line in enumerate(queries) if line and not line.startswith("#")])
+            files = {int(entry[0]): entry[3] for entry in summary}
+            # repeated queries share one answer
+            self.assertEqual(files[11], files[1])
+            self.assertEqual(files[12], files[10])
+            self.assertIn("invalid IP address", summary[10][2])
+            self.assertIn("not in the loaded schema", summary[11][2])
+
+            def rows_of(line_number):
+                with open(os.path.join(out_dir, files[line_number])) as f:
+                    return [json.loads(line)["row_idx"] for line in f]
+
+            expected = {
+                1: parser.search_by_source_ip("10.0.0.4"),
+                2: parser.search_by_destination_ip("10.0.1.0/30"),
+                5: parser.search_by_source_ip("10.0.1.0/24"),
+                6: parser.search_by_source_and_destination_ip("10.0.0.2", "10.0.1.2"),
+                7: parser.search_by_source_and_destination_ip("10.0.0.0/24", "10.0.1.2"),
+                8: parser.search_by_time(1600000100, 1600000150, src_ip="10.0.1.0/24"),
+                10: parser.query("action=REJECT AND dstport<10 OR srcport=1003"),
+            }
+            for port in range(20):
+                expected[15 + port] = parser.query(f"dstport={port}")
+            expected[35] = parser.query("dstport=3 AND action=ACCEPT")
+            for line_number, results in expected.items():
+                self.assertEqual(rows_of(line_number), list(results.row_ids), queries[line_number - 1])
+                self.assertTrue(results, queries[line_number - 1])
+            with open(os.path.join(out_dir, files[9])) as f:
+                self.assertEqual(json.load(f), {"count": parser.get_connection_count("10.0.0.4", "1004", "10.0.1.0", "4", "6")})
+            self.assertEqual(len(os.listdir(out_dir)), len(queries) - 5)
+
+            self.cli.onecmd(f"batch {queries_path}")
+            self.assertIn("Invalid arguments", self._out())
+        finally:
+            for root, _, names in os.walk(directory, topdown=False):
+                for name in names:
+                    os.remove(os.path.join(root, name))
+                os.rmdir(root)
+
+    def test_rollups_match_rows(self):
+        directory = tempfile.mkdtemp()
+        rng = random.Random(7)
+        try:
+            lines = []
+            for _ in range(900):
+                if rng.random() < 0.05:
+                    lines.append("2 123456 eni-1 - - - - - - - 1600000100 1600000160 - NODATA\n")
+                    continue
+                lines.append(
+                    f"2 123456 eni-1 10.0.0.{rng.randint(1, 6)} 10.0.1.{rng.randint(1, 6)} {rng.randint(1000, 1100)} "
+                    f"{rng.choice([22, 80, 443])} 6 {rng.randint(1, 50)} {rng.randint(40, 9000)} {1600000000 + rng.randint(0, 7200)} 1600007300 "
+                    f"{rng.choice(['ACCEPT', 'REJECT'])} OK\n"
+                )
+            for i in range(3):
+                with open(os.path.join(directory, f"part-{i}.log"), "w") as f:
+                    f.writelines(lines[i * 300:(i + 1) * 300])
+            path = os.path.join(directory, "flow.txt")
+            with open(path, "w") as f:
+                f.writelines(lines)
+            specs = ["srcaddr", "dstport,action@300", "total@3600"]
+
+            single = Parser(path=path)
+            single.deserialize()
+            rows = [
+                {field: int(value) if value is not None and field in constants.FLOW_LOG_INT_FIELDS else value for field, value in single.store.row(row_idx).to_dict().items()}
+                for row_idx in range(len(single.store))
+            ]
+
+            def expected_totals(fields, start=None, end=None, seconds=60):
+                sums = collections.defaultdict(lambda: [0, 0, 0])
+                for row in rows:
+                    bucket = row["start"] // seconds
+                    if (start is not None and bucket < start // seconds) or (end is not None and bucket > end // seconds):
+                        continue
+                    entry = sums[tuple(row[field] for field in fields)]
+                    entry[0] += 1
+                    entry[1] += row["packets"] or 0
+                    entry[2] += row["bytes"] or 0
+                return sums
+
+            def totals(summary, *window):
+                return {tuple(result[field] for field in summary.fields): [result["flows"], result["packets"], result["bytes"]] for result in summary.totals(*window)}
+
+            def check(parser):
+                self.assertEqual([summary.name for summary in parser.rollups], specs)
+                self.assertEqual(totals(parser.get_rollup("srcaddr")), expected_totals(["srcaddr"]))
+                self.assertEqual(totals(parser.get_rollup("dstport,action")), expected_totals(["dstport", "action"]))
+                self.assertEqual(totals(parser.get_rollup("srcaddr"), 1600003600, 1600004199), expected_totals(["srcaddr"], 1600003600, 1600004199))
+                hours = parser.get_rollup("total").series()
+                self.assertEqual([(hour["start"], hour["flows"]) for hour in hours], sorted(collections.Counter(row["start"] // 3600 * 3600 for row in rows).items()))
+
+            loads = []
+            for source, workers in ((path, 1), (path, 2), (directory + "/part-*.log", 2)):
+                parser = Parser(path=source, rollups=specs)
+                parser.deserialize(workers=workers)
+                check(parser)
+                loads.append(parser)
+            # the rollups are summed again from a snapshot's columns
+            loads[0].save_index()
+            parser = Parser(path=path, rollups=specs)
+            self.assertTrue(parser.load_index())
+            check(parser)
+            os.remove(path + ".idx")
+
+            # rollups follow appended lines
+            with open(path, "w") as f:
+                f.writelines(lines[:500])
+            parser = Parser(path=path, rollups=specs)
+            self.assertEqual(parser.ingest_appended(), 500)
+            with open(path, "a") as f:
+                f.writelines(lines[500:])
+            self.assertEqual(parser.ingest_appended(), 400)
+            check(parser)
+            with self.assertRaises(ValueError):
+                parser.get_rollup("dstport")
+
+            self.cli.onecmd("set_rollups srcaddr bogus")
+            self.assertIn("Invalid arguments: unknown field 'bogus'", self._out())
+            self.cli.onecmd("set_rollups default total@3600")
+            self.assertEqual(self.cli.rollups, ["srcaddr", "dstport", "action", "total@3600"])
+            self.cli.onecmd(f"load {path}")
+            self.assertIn("Built rollups srcaddr, dstport, action, total@3600", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("rollup dstport last=3600 top=2 order=flows")
+            expected = sorted(expected_totals(["dstport"], 1600003660, 1600007259).items(), key=lambda item: -item[1][0])[:2]
+            self.assertRegex(self._out(), rf"dstport  flows  packets  bytes\n{expected[0][0][0]} +{expected[0][1][0]} ")
+            self.assertIn("Total groups: 2 from rollup dstport", self._out())
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("rollup srcaddr by=time key=10.0.0.3 from=1600000000 to=1600000599")
+            minutes = collections.Counter(row["start"] // 60 * 60 for row in rows if row["srcaddr"] == "10.0.0.3" and 1600000000 // 60 <= row["start"] // 60 <= 1600000599 // 60)
+            self.assertIn(f"Total buckets: {len(minutes)} from rollup srcaddr", self._out())
+            self.assertRegex(self._out(), rf"\n{min(minutes)}  2020-09-13T12:\d\d:00Z  {minutes[min(minutes)]} ")
+            for bad in ("rollup srcaddr,dstport", "rollup action by=port", "rollup action last=60 from=1600000000", "rollup srcaddr by=time key=10.0.0.3,80"):
+                self.stdout.truncate(0); self.stdout.seek(0)
+                self.cli.onecmd(bad)
+                self.assertIn("Invalid arguments", self._out())
+
+            # rollups on fields the schema lacks are skipped and reported by the shell, not printed by Parser
+            schema = [field if field != "dstport" else "tcp-flags" for field in constants.FLOW_LOG_SCHEMA_DEFAULT]
+            printed = io.StringIO()
+            with contextlib.redirect_stdout(printed):
+                parser = Parser(path=path, schema=schema, rollups=["dstport,action", "total"])
+            self.assertEqual(printed.getvalue(), "")
+            self.assertEqual([summary.name for summary in parser.rollups], ["total"])
+            self.assertEqual(parser.skipped_rollups, [("dstport,action", "dstport not in the schema")])
+            self.cli.onecmd(f"set_schema {' '.join(schema)}")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"load {path}")
+            self.assertIn("Skipped rollup dstport: dstport not in the schema.", self._out())
+            self.assertIn("Built rollups srcaddr, action, total@3600", self._out())
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_batch_search_time_rows_out_of_start_order(self):
+        directory = tempfile.mkdtemp()
+        path, queries_path, out_dir = (os.path.join(directory, name) for name in ("flow.log", "queries.txt", "out"))
+        rng = random.Random(12)
+        try:
+            with open(path, "w") as f:
+                for _ in range(3000):
+                    start = 1600000000 + rng.randint(0, 20000)
+                    f.write(f"2 123456 eni-1 10.2.1.{rng.randint(1, 3)} 10.0.0.2 1000 2000 6 1 100 {start} {start + rng.randint(0, 30)} ACCEPT OK\n")
+            self.cli.onecmd(f"load {path}")
+            parser = self.cli.parser
+            parser.cache.resize(max_entries=0)
+            windows = [(low, low + rng.randint(0, 50)) for low in (1600000000 + rng.randint(0, 20000) for _ in range(200))]
+            with open(queries_path, "w") as f:
+                f.writelines(f"search_time {low} {high} src=10.2.1.2\n" for low, high in windows)
+
+            self.cli.onecmd(f"batch {queries_path} {out_dir} format=ndjson")
+            with open(os.path.join(out_dir, "summary.tsv")) as f:
+                files = {int(entry[0]): entry[3] for entry in (line.rstrip("\n").split("\t") for line in list(f)[1:])}
+            rows = [parser.store.row(row_idx).to_dict() for row_idx in range(len(parser.store))]
+            for line_number, (low, high) in enumerate(windows, 1):
+                expected = [row["row_idx"] for row in rows if row["srcaddr"] == "10.2.1.2" and int(row["start"]) <= high and int(row["end"]) >= low]
+                with open(os.path.join(out_dir, files[line_number])) as f:
+                    self.assertEqual([json.loads(line)["row_idx"] for line in f], expected, (low, high))
+        finally:
+            for root, _, names in os.walk(directory, topdown=False):
+                for name in names:
+                    os.remove(os.path.join(root, name))
+                os.rmdir(root)
+
+    def test_batch_addresses_match_the_shell(self):
+        for address in ("10.1", "0x0a.0.0.1", "010.0.0.1", "10.0.0.256", "10.0.0.1.", "1.2.3.-4", "10.0.0.١"):
+            _, errors = batch.read_batch([f"search_src {address}", f"search_src_dst 10.0.0.1 {address}"])
+            self.assertEqual([reason for _, _, reason in errors], [f"invalid IP address {address!r}"] * 2)
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd(f"search_src {address}")
+            self.assertIn("Invalid", self._out())
+        queries, errors = batch.read_batch(["search_src 10.0.0.1", "search_dst 0.0.0.0", "search_src 255.255.255.255"])
+        self.assertEqual((len(queries), errors), (3, []))
+
+    def test_distinct_ports_without_dstport(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        try:
+            with open(path, "w") as f:
+                f.write("2 10.0.0.1 10.0.1.1 1000 6 1600000000 1600000001 ACCEPT\n")
+            self.cli.onecmd("set_schema version srcaddr dstaddr srcport protocol start end action")
+            self.cli.onecmd(f"load {path}")
+            self.stdout.truncate(0); self.stdout.seek(0)
+            self.cli.onecmd("distinct 10.0.1.1")
+            self.assertIn("Cannot count destination ports: field 'dstport' is not in the loaded schema.", self._out())
+        finally:
+            os.remove(path)
+
+class TestSketches(unittest.TestCase):
+    def test_count_min_sketch_never_undercounts(self):
+        rng = random.Random(2)
+        exact = collections.Counter(
+            (rng.randint(0, 50), rng.randint(0, 50), rng.randint(1, 65535), 443, 6) for _ in range(20000)
+        )
+        sketch = CountMinSketch(epsilon=0.001, delta=0.01)
+        for key, count in exact.items():
+            for _ in range(count):
+                sketch[key] += 1
+        self.assertEqual(sketch.total, 20000)
+        for key, count in exact.items():
+            self.assertGreaterEqual(sketch.get(key), count)
+            self.assertLessEqual(sketch.get(key), count + sketch.error_bound())
+        self.assertLessEqual(sketch.get((999, 999, 1, 1, 6)), sketch.error_bound())
+
+    def test_hyperloglog_estimate(self):
+        hll = HyperLogLog(12)
+        for value in range(50000):
+            hll.add(value)
+            hll.add(value)
+        self.assertLess(abs(hll.count() - 50000) / 50000, 0.05)
+        other = HyperLogLog(12)
+        for value in range(50000, 60000):
+            other.add(value)
+        hll.merge(other)
+        self.assertLess(abs(hll.count() - 60000) / 60000, 0.05)
+
+    def test_approximate_parser_matches_exact_on_small_input(self):
+        fd, path = tempfile.mkstemp(prefix="flowlogs_", suffix=".txt")
+        os.close(fd)
+        rng = random.Random(3)
+        try:
+            with open(path, "w") as f:
+                for _ in range(500):
+                    f.write(f"2 123456 eni-1 10.0.0.{rng.randint(1, 30)} 10.0.1.{rng.randint(1, 5)} {rng.randint(1, 3)} {rng.randint(1, 40)} 6 1 100 1600000000 1600000001 ACCEPT OK\n")
+
+            exact = Parser(path=path)
+            exact.deserialize()
+            approximate = Parser(path=path, epsilon=0.001)
+            approximate.deserialize(workers=2)
+            for key, count in exact.connection_counts.items():
+                self.assertEqual(approximate.connection_counts.get(key), count)
+            self.assertEqual(approximate.count_distinct_sources(), exact.count_distinct_sources())
+            ports = exact.count_distinct_destination_ports("10.0.1.1")
+            self.assertLessEqual(abs(approximate.count_distinct_destination_ports("10.0.1.1") - ports), 0.15 * ports)
+
+            approximate.save_index()
+            restored = Parser(path=path, epsilon=0.001)
+            self.assertTrue(restored.load_index())
+            self.assertEqual(restored.get_connection_count("10.0.0.1", "1", "10.0.1.1", "1", "6"), exact.get_connection_count("10.0.0.1", "1", "10.0.1.1", "1", "6"))
+            self.assertFalse(Parser(path=path).load_index())
+        finally:
+            for leftover in (path, path + ".idx"):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+
 if __name__ == "__main__":
     unittest.main()